@@ -0,0 +1,551 @@
+#########################################################################
+#                                                                       #
+# Name:      AsyncServer                                                #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    AsyncServer                                                #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Event-driven server for teFS speaking the FUSE kernel protocol on /dev/fuse
+
+fuse-python serves one request at a time or gives every request its own
+thread. Here one thread reads the requests from the kernel and answers
+the ones which don't touch the disk (forget, interrupt, opendir...), the
+rest are queued for a small pool of threads which call the same teFS
+methods and reply in any order. Any number of requests can be in flight
+with a few threads, interrupted requests still waiting are dropped.
+
+The filesystem is mounted with mount(2), so it must run as root.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['AsyncServer']
+
+import os
+import stat
+import errno
+import signal
+import struct
+import threading
+import Queue
+import ctypes
+import ctypes.util
+
+from debugger import Debugger, lineno
+
+# Version of the kernel protocol we speak
+FUSE_MAJOR = 7
+FUSE_MINOR = 28
+
+# Node of the root directory
+FUSE_ROOT_ID = 1
+
+# Operations
+FUSE_LOOKUP = 1
+FUSE_FORGET = 2
+FUSE_GETATTR = 3
+FUSE_OPEN = 14
+FUSE_READ = 15
+FUSE_STATFS = 17
+FUSE_RELEASE = 18
+FUSE_FLUSH = 25
+FUSE_INIT = 26
+FUSE_OPENDIR = 27
+FUSE_READDIR = 28
+FUSE_RELEASEDIR = 29
+FUSE_INTERRUPT = 36
+FUSE_DESTROY = 38
+FUSE_BATCH_FORGET = 42
+
+# Flags
+FUSE_ASYNC_READ = 1
+FUSE_AUTO_INVAL_DATA = 1 << 12
+FUSE_MAX_PAGES = 1 << 22
+FUSE_GETATTR_FH = 1
+FOPEN_DIRECT_IO = 1
+FOPEN_KEEP_CACHE = 2
+
+# Structures of the protocol (same layout as <linux/fuse.h>, native byte order)
+IN_HEADER = struct.Struct('=IIQQIIII')          # len, opcode, unique, nodeid, uid, gid, pid, padding
+OUT_HEADER = struct.Struct('=IiQ')              # len, error, unique
+INIT_IN = struct.Struct('=IIII')                # major, minor, max_readahead, flags
+INIT_OUT = struct.Struct('=IIIIHHI')            # major, minor, max_readahead, flags, max_background, congestion_threshold, max_write
+INIT_OUT_23 = struct.Struct('=IHH32x')          # time_gran, max_pages, padding, unused (kernels speaking 7.23 or newer)
+ATTR = struct.Struct('=QQQQQQIIIIIIIIII')       # ino, size, blocks, atime, mtime, ctime, nsecs, mode, nlink, uid, gid, rdev, blksize, padding
+ENTRY_OUT = struct.Struct('=QQQQII')            # nodeid, generation, entry_valid, attr_valid, nsecs (ATTR follows)
+ATTR_OUT = struct.Struct('=QII')                # attr_valid, nsec, dummy (ATTR follows)
+GETATTR_IN = struct.Struct('=IIQ')              # flags, dummy, fh
+OPEN_IN = struct.Struct('=II')                  # flags, unused
+OPEN_OUT = struct.Struct('=QII')                # fh, open_flags, padding
+READ_IN = struct.Struct('=QQI')                 # fh, offset, size (the rest is not used)
+RELEASE_IN = struct.Struct('=QII')              # fh, flags, release_flags (the rest is not used)
+FORGET_IN = struct.Struct('=Q')                 # nlookup
+BATCH_FORGET_IN = struct.Struct('=II')          # count, dummy (count FORGET_ONE follow)
+FORGET_ONE = struct.Struct('=QQ')               # nodeid, nlookup
+INTERRUPT_IN = struct.Struct('=Q')              # unique
+DIRENT = struct.Struct('=QQII')                 # ino, offset, namelen, type (the name follows, padded to 8 bytes)
+STATFS_OUT = struct.Struct('=QQQQQIIII24x')     # blocks, bfree, bavail, files, ffree, bsize, namelen, frsize, padding, spare
+
+# Size of the buffer for the requests (bigger than any request we allow)
+REQUEST_BUFFER = 135168
+
+# Biggest write the kernel may send (this is a readonly filesystem)
+MAX_WRITE = 4096
+
+# Requests in background (readahead and asynchronous reads) the kernel keeps in flight
+MAX_BACKGROUND = 128
+
+# Seconds the kernel may keep names, attributes and missing names (same as fuse-python)
+ENTRY_TIMEOUT = 1.0
+ATTR_TIMEOUT = 1.0
+NEGATIVE_TIMEOUT = 0.0
+
+# Pages of a request (the kernel takes up to 256 of them when we ask for bigger reads)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MAX_PAGES = 256
+
+# Inode given in the listings (the real one comes with lookup)
+UNKNOWN_INO = 0xffffffff
+
+# Mount options passed to the kernel, the rest are for fuse-python only
+MOUNT_OPTIONS = ('allow_other', 'default_permissions')
+
+# mount(2) flags and umount2(2) flags
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MNT_DETACH = 2
+
+# Unsigned 64 bits (times before 1970 go as the kernel expects them)
+MASK64 = 0xffffffffffffffff
+
+
+def timespec(when):
+    '''
+    Split a time in seconds and nanoseconds
+    '''
+    seconds = int(when // 1)
+    return (seconds & MASK64, int((when - seconds) * 1000000000))
+
+
+class AsyncServer(Debugger):
+    '''
+    Serve a teFS at the mount point with one thread reading requests and a pool of threads answering them
+    '''
+    
+    def __init__(self, tefs, mountpoint, threads=4, options=(), entry_timeout=ENTRY_TIMEOUT, attr_timeout=ATTR_TIMEOUT, negative_timeout=NEGATIVE_TIMEOUT, max_read=None):
+        '''
+        Prepare the server, options are mount options (only allow_other and default_permissions are used). Timeouts
+        are the seconds the kernel keeps names, attributes and missing names, max_read the biggest read it sends
+        '''
+        self.tefs = tefs
+        self.mountpoint = os.path.abspath(mountpoint)
+        self.threads = max(threads, 1)
+        self.options = [option for option in options if option in MOUNT_OPTIONS]
+        self.entry_timeout = entry_timeout
+        self.attr_timeout = attr_timeout
+        self.negative_timeout = negative_timeout
+        self.max_read = max_read
+        self.set_debug(tefs.get_debug())
+        
+        # Nodes known by the kernel: nodeid -> [virtual path, lookups] and back
+        self.__nodes = {FUSE_ROOT_ID: ['/', 1]}
+        self.__ids = {'/': FUSE_ROOT_ID}
+        self.__next = FUSE_ROOT_ID + 1
+        
+        # Open files: fh -> (virtual path, handle built by teFS)
+        self.__handles = {}
+        self.__nextfh = 1
+        
+        # Requests waiting for a thread and the ones interrupted meanwhile
+        self.__queue = Queue.Queue()
+        self.__queued = set()
+        self.__interrupted = set()
+        self.__lock = threading.Lock()
+        self.__workers = []
+        self.__fd = None
+        
+        # Operations answered by the reader and by the pool
+        self.inline = {FUSE_INIT: self.init, FUSE_DESTROY: self.destroy, FUSE_FORGET: self.forget, FUSE_BATCH_FORGET: self.batch_forget, FUSE_INTERRUPT: self.interrupt, FUSE_OPENDIR: self.opendir, FUSE_RELEASEDIR: self.done, FUSE_FLUSH: self.done, FUSE_RELEASE: self.release, FUSE_STATFS: self.statfs}
+        self.pooled = {FUSE_LOOKUP: self.lookup, FUSE_GETATTR: self.getattr, FUSE_OPEN: self.open, FUSE_READ: self.read, FUSE_READDIR: self.readdir}
+    
+    def mount(self):
+        '''
+        Open /dev/fuse and mount it readonly at the mount point
+        '''
+        self.__fd = os.open('/dev/fuse', os.O_RDWR)
+        mode = os.stat(self.mountpoint).st_mode
+        data = "fd=%d,rootmode=%o,user_id=%d,group_id=%d" % (self.__fd, stat.S_IFMT(mode), os.getuid(), os.getgid())
+        if self.options:
+            data += ",%s" % (",".join(self.options))
+        if self.max_read:
+            data += ",max_read=%d" % (self.max_read)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.mount("tefs", self.mountpoint, "fuse.tefs", MS_RDONLY | MS_NOSUID | MS_NODEV, data) != 0:
+            error = ctypes.get_errno()
+            os.close(self.__fd)
+            self.__fd = None
+            raise IOError,"Can't mount '%s': %s (the asynchronous server must run as root)" % (self.mountpoint, os.strerror(error))
+    
+    def umount(self):
+        '''
+        Detach the filesystem (nothing happens if it was unmounted already)
+        '''
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.umount2(self.mountpoint, MNT_DETACH)
+    
+    def serve(self, foreground=True):
+        '''
+        Mount the filesystem and serve it until it is unmounted (going to background unless asked to stay)
+        '''
+        self.mount()
+        try:
+            if not foreground:
+                self.daemonize()
+            
+            # Stop cleanly with the usual signals
+            for signum in (signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, self.stop)
+            
+            # Same start as with fuse-python
+            self.tefs.fsinit()
+            for i in xrange(self.threads):
+                worker = threading.Thread(target=self.worker, name="teFS-server-%s" % (i))
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+            
+            # Read requests until the kernel says it was unmounted
+            try:
+                self.loop()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            for worker in self.__workers:
+                self.__queue.put(None)
+            for worker in self.__workers:
+                worker.join()
+            self.__workers = []
+            self.tefs.fsdestroy()
+            self.umount()
+            os.close(self.__fd)
+            self.__fd = None
+    
+    def daemonize(self):
+        '''
+        Go to background as fuse-python does: new session, no terminal
+        '''
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        os.chdir('/')
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        os.close(null)
+    
+    def stop(self, signum, frame):
+        '''
+        Leave the loop when a signal arrives
+        '''
+        raise KeyboardInterrupt
+    
+    def loop(self):
+        '''
+        Read the requests, answer the quick ones and queue the rest for the pool
+        '''
+        while True:
+            try:
+                request = os.read(self.__fd, REQUEST_BUFFER)
+            except OSError, e:
+                # Signals and requests interrupted before we read them
+                if e.errno in (errno.EINTR, errno.EAGAIN, errno.ENOENT):
+                    continue
+                
+                # Unmounted
+                if e.errno == errno.ENODEV:
+                    return
+                raise
+            
+            (length, opcode, unique, nodeid, uid, gid, pid, padding) = IN_HEADER.unpack_from(request)
+            body = request[IN_HEADER.size:length]
+            
+            # Quick ones
+            method = self.inline.get(opcode)
+            if method:
+                try:
+                    method(unique, nodeid, body)
+                except Exception, e:
+                    self.error("EXCEPTION at line %s: %s\n", lineno(), e)
+                    self.reply(unique, error=-errno.EIO)
+                if opcode == FUSE_DESTROY:
+                    return
+                continue
+            
+            # The ones going to the disk wait for a thread of the pool
+            method = self.pooled.get(opcode)
+            if method:
+                with self.__lock:
+                    self.__queued.add(unique)
+                self.__queue.put((method, unique, nodeid, body))
+            else:
+                self.reply(unique, error=-errno.ENOSYS)
+    
+    def worker(self):
+        '''
+        Answer queued requests
+        '''
+        while True:
+            task = self.__queue.get()
+            if task is None:
+                return
+            (method, unique, nodeid, body) = task
+            
+            # Forget it if it was interrupted while waiting
+            with self.__lock:
+                self.__queued.discard(unique)
+                interrupted = unique in self.__interrupted
+                self.__interrupted.discard(unique)
+            if interrupted:
+                self.reply(unique, error=-errno.EINTR)
+                continue
+            
+            try:
+                method(unique, nodeid, body)
+            except Exception, e:
+                self.error("EXCEPTION at line %s: %s\n", lineno(), e)
+                self.reply(unique, error=-errno.EIO)
+    
+    def reply(self, unique, data='', error=0):
+        '''
+        Send the answer of the request (error is -errno)
+        '''
+        try:
+            os.write(self.__fd, OUT_HEADER.pack(OUT_HEADER.size + len(data), error, unique) + data)
+        except OSError, e:
+            # The request was interrupted and the kernel doesn't wait for it anymore
+            if e.errno != errno.ENOENT:
+                self.error("Reply to request %s: %s\n", unique, e)
+    
+    def vpath(self, nodeid):
+        '''
+        Virtual path of the node
+        '''
+        with self.__lock:
+            node = self.__nodes.get(nodeid)
+        if node is None:
+            raise KeyError("Unknown node %s" % (nodeid))
+        return node[0]
+    
+    def attr(self, st, nodeid):
+        '''
+        Pack the attributes of a file
+        '''
+        size = st.st_size or 0
+        (atime, atimensec) = timespec(st.st_atime or 0)
+        (mtime, mtimensec) = timespec(st.st_mtime or 0)
+        (ctime, ctimensec) = timespec(st.st_ctime or 0)
+        return ATTR.pack(st.st_ino or nodeid, size, (size + 511) // 512, atime, mtime, ctime, atimensec, mtimensec, ctimensec, st.st_mode, st.st_nlink or 1, st.st_uid or 0, st.st_gid or 0, getattr(st, 'st_rdev', 0) or 0, 0, 0)
+    
+    def init(self, unique, nodeid, body):
+        '''
+        Agree the version of the protocol
+        '''
+        (major, minor, readahead, flags) = INIT_IN.unpack_from(body)
+        if major < FUSE_MAJOR:
+            self.reply(unique, error=-errno.EPROTO)
+            return
+        
+        # The kernel drops the cached pages of a file when its modification time or size change
+        wanted = flags & (FUSE_ASYNC_READ | FUSE_AUTO_INVAL_DATA)
+        
+        # Reads bigger than 32 pages must be asked for
+        pages = 0
+        if self.max_read and flags & FUSE_MAX_PAGES:
+            wanted |= FUSE_MAX_PAGES
+            pages = min((self.max_read + PAGE_SIZE - 1) // PAGE_SIZE, MAX_PAGES)
+        
+        # Newer kernels take our version (and ask again if they are bigger), older ones want the short answer
+        answer = INIT_OUT.pack(FUSE_MAJOR, FUSE_MINOR, readahead, wanted, MAX_BACKGROUND, MAX_BACKGROUND * 3 // 4, MAX_WRITE)
+        if minor >= 23:
+            answer += INIT_OUT_23.pack(0, pages, 0)
+        self.reply(unique, answer)
+    
+    def destroy(self, unique, nodeid, body):
+        self.reply(unique)
+    
+    def done(self, unique, nodeid, body):
+        '''
+        Nothing to do (releasedir, flush)
+        '''
+        self.reply(unique)
+    
+    def drop(self, nodeid, lookups):
+        '''
+        The kernel forgot some lookups of the node (the lock must be held)
+        '''
+        node = self.__nodes.get(nodeid)
+        if node is None or nodeid == FUSE_ROOT_ID:
+            return
+        node[1] -= lookups
+        if node[1] <= 0:
+            del self.__nodes[nodeid]
+            del self.__ids[node[0]]
+    
+    def forget(self, unique, nodeid, body):
+        (lookups,) = FORGET_IN.unpack_from(body)
+        with self.__lock:
+            self.drop(nodeid, lookups)
+    
+    def batch_forget(self, unique, nodeid, body):
+        (count, dummy) = BATCH_FORGET_IN.unpack_from(body)
+        with self.__lock:
+            for index in xrange(count):
+                (nodeid, lookups) = FORGET_ONE.unpack_from(body, BATCH_FORGET_IN.size + index * FORGET_ONE.size)
+                self.drop(nodeid, lookups)
+    
+    def interrupt(self, unique, nodeid, body):
+        '''
+        Drop the interrupted request if it is still waiting (the running ones just finish)
+        '''
+        (target,) = INTERRUPT_IN.unpack_from(body)
+        with self.__lock:
+            if target in self.__queued:
+                self.__interrupted.add(target)
+    
+    def opendir(self, unique, nodeid, body):
+        '''
+        Directories have no handle, readdir works with the node
+        '''
+        self.reply(unique, OPEN_OUT.pack(0, 0, 0))
+    
+    def statfs(self, unique, nodeid, body):
+        '''
+        Same answer as fuse-python gives when statfs is not implemented
+        '''
+        self.reply(unique, STATFS_OUT.pack(0, 0, 0, 0, 0, 512, 255, 0, 0))
+    
+    def lookup(self, unique, nodeid, body):
+        '''
+        Find a name inside a directory, the kernel gets a node for it
+        '''
+        parent = self.vpath(nodeid)
+        name = body.split('\0', 1)[0]
+        vpath = "%s/%s" % (parent.rstrip("/"), name)
+        st = self.tefs.getattr(vpath)
+        if isinstance(st, int):
+            
+            # The kernel may remember the missing name (as node 0) for a while
+            if st == -errno.ENOENT and self.negative_timeout:
+                (entry, entrynsec) = timespec(self.negative_timeout)
+                self.reply(unique, ENTRY_OUT.pack(0, 0, entry, 0, entrynsec, 0) + '\0' * ATTR.size)
+            else:
+                self.reply(unique, error=st)
+            return
+        
+        # Count the lookup of the node
+        with self.__lock:
+            found = self.__ids.get(vpath)
+            if found is None:
+                found = self.__next
+                self.__next += 1
+                self.__ids[vpath] = found
+                self.__nodes[found] = [vpath, 0]
+            self.__nodes[found][1] += 1
+        
+        (entry, entrynsec) = timespec(self.entry_timeout)
+        (valid, validnsec) = timespec(self.attr_timeout)
+        self.reply(unique, ENTRY_OUT.pack(found, 0, entry, valid, entrynsec, validnsec) + self.attr(st, found))
+    
+    def getattr(self, unique, nodeid, body):
+        '''
+        Attributes of a node, from its open file when the kernel gives one
+        '''
+        vpath = self.vpath(nodeid)
+        (flags, dummy, fh) = GETATTR_IN.unpack_from(body)
+        if flags & FUSE_GETATTR_FH and fh in self.__handles:
+            st = self.tefs.fgetattr(vpath, self.__handles[fh][1])
+        else:
+            st = self.tefs.getattr(vpath)
+        if isinstance(st, int):
+            self.reply(unique, error=st)
+            return
+        (valid, validnsec) = timespec(self.attr_timeout)
+        self.reply(unique, ATTR_OUT.pack(valid, validnsec, 0) + self.attr(st, nodeid))
+    
+    def open(self, unique, nodeid, body):
+        '''
+        Open a file, the handle built by teFS is kept until release
+        '''
+        vpath = self.vpath(nodeid)
+        (flags, unused) = OPEN_IN.unpack_from(body)
+        handle = self.tefs.open(vpath, flags)
+        if isinstance(handle, int):
+            self.reply(unique, error=handle)
+            return
+        
+        # Same options fuse-python takes from the handle
+        options = 0
+        if getattr(handle, 'direct_io', False):
+            options |= FOPEN_DIRECT_IO
+        if getattr(handle, 'keep_cache', False):
+            options |= FOPEN_KEEP_CACHE
+        with self.__lock:
+            fh = self.__nextfh
+            self.__nextfh += 1
+            self.__handles[fh] = (vpath, handle)
+        self.reply(unique, OPEN_OUT.pack(fh, options, 0))
+    
+    def read(self, unique, nodeid, body):
+        '''
+        Read from an open file
+        '''
+        (fh, offset, size) = READ_IN.unpack_from(body)
+        (vpath, handle) = self.__handles[fh]
+        data = self.tefs.read(vpath, size, offset, handle)
+        if isinstance(data, int):
+            self.reply(unique, error=data)
+        else:
+            self.reply(unique, str(data))
+    
+    def release(self, unique, nodeid, body):
+        '''
+        Close an open file (the kernel sends it once every read finished)
+        '''
+        (fh, flags, releaseflags) = RELEASE_IN.unpack_from(body)
+        with self.__lock:
+            (vpath, handle) = self.__handles.pop(fh)
+        self.tefs.release(vpath, flags, handle)
+        self.reply(unique)
+    
+    def readdir(self, unique, nodeid, body):
+        '''
+        List a directory from the offset, as many entries as fit in the size asked
+        '''
+        vpath = self.vpath(nodeid)
+        (fh, offset, size) = READ_IN.unpack_from(body)
+        data = []
+        used = 0
+        entries = self.tefs.readdir(vpath, offset)
+        try:
+            for entry in entries:
+                name = entry.name
+                length = (DIRENT.size + len(name) + 7) & ~7
+                if used + length > size:
+                    break
+                data.append(DIRENT.pack(UNKNOWN_INO, entry.offset, len(name), entry.type or 0))
+                data.append(name)
+                data.append('\0' * (length - DIRENT.size - len(name)))
+                used += length
+        finally:
+            entries.close()
+        self.reply(unique, "".join(data))
@@ -0,0 +1,452 @@
+#!/usr/bin/python
+#########################################################################
+#                                                                       #
+# Name:      Benchmark                                                  #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Benchmark                                                  #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+teFS benchmarks: runs the teFS methods straight (nothing is mounted)
+against generated trees and reports MB/s and ops/s as JSON.
+
+Every case runs for a minimum time several times and the best run is
+kept. Results can be compared with a previous run (--baseline), then
+the cases which got slower than the tolerance are reported and the exit
+status is 1, so it can be used to catch regressions before deploying.
+'''
+
+__version__ = "201109111103"
+
+__all__ = []
+
+# Import the rest of libraries
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+from options import getargv, getargvalue, checkblocksize, checkbackend
+from tefs import teFS, teFSstat
+from engine import CipherEngine, ALGORITHMS, available_backends
+from transcode import walk
+
+# Version of the results file
+RESULTS_VERSION = 1
+
+# Keys for every cipher (each one has its own valid lengths)
+KEYS = {'AES': 'CIt16CXA9j73Yx1jCCMH6CXvS8DwHQuR', 'ARC2': 'CIt16CXA9j73Yx1j', 'Blowfish': 'CIt16CXA9j73Yx1j', 'CAST': 'CIt16CXA9j73Yx1j', 'DES': 'CIt16CXA'}
+
+# Algorithm used by every case which is not about algorithms (and the one of the stream format)
+DEFAULT_ALGORITHM = 'AESECB'
+STREAM_ALGORITHM = 'AESCTR'
+
+# Size of the buffers ciphered by the engine cases
+CIPHER_CHUNK = 65536
+
+# Depths of the paths used by the realpath cases
+DEPTHS = [1, 4, 16]
+
+
+def measure(function, mintime, repeat):
+    '''
+    Call the function (it returns the bytes it processed) again and again for at least mintime seconds,
+    repeat times, returns the best (ops/s, MB/s)
+    '''
+    best = (0.0, 0.0)
+    for i in xrange(repeat):
+        calls = 0
+        processed = 0
+        start = time.time()
+        elapsed = 0.0
+        while elapsed < mintime:
+            processed += function()
+            calls += 1
+            elapsed = time.time() - start
+        best = max(best, (calls / elapsed, processed / elapsed / 1048576.0))
+    return best
+
+
+class Benchmark(object):
+    '''
+    Build the trees and run the cases
+    '''
+    
+    def __init__(self, workdir, backend, blocksize, mintime, repeat):
+        self.workdir = workdir
+        self.backend = backend
+        self.blocksize = blocksize
+        self.mintime = mintime
+        self.repeat = repeat
+        self.results = {}
+        self.mirrors = {}
+        
+        # Nothing inside the trees is the mount point
+        self.mountpoint = os.path.join(workdir, 'mnt')
+    
+    def tefs(self, datapath, action, algorithm=DEFAULT_ALGORITHM, blocksize=None, **options):
+        '''
+        Build a teFS over the datapath, without caches unless they are asked for
+        '''
+        settings = {'debugger': {}, 'backend': self.backend, 'blocksize': blocksize, 'blockcache': 0, 'dircache': 0, 'readahead': 0, 'workers': None}
+        settings.update(options)
+        key = "%s$%s" % (algorithm, KEYS[ALGORITHMS[algorithm][0]])
+        return teFS(key, datapath, action, self.mountpoint, **settings)
+    
+    def run(self, name, function, unit):
+        '''
+        Measure a case and remember it, unit says which figure matters ('mbps' or 'ops')
+        '''
+        (ops, mbps) = measure(function, self.mintime, self.repeat)
+        result = {'ops': ops, 'unit': unit}
+        if unit == 'mbps':
+            result['mbps'] = mbps
+        self.results[name] = result
+        if unit == 'mbps':
+            print "%-60s %12.1f MB/s %12.0f ops/s" % (name, mbps, ops)
+        else:
+            print "%-60s %12.0f ops/s" % (name, ops)
+        sys.stdout.flush()
+    
+    def generate(self, sizes, entries):
+        '''
+        Build the plain tree: one file for every size, nested directories for realpath and a big directory
+        '''
+        plain = os.path.join(self.workdir, 'plain')
+        
+        # Files
+        os.makedirs(os.path.join(plain, 'files'))
+        for size in sizes:
+            f = open(os.path.join(plain, 'files', "file%s" % (size)), 'wb')
+            f.write(os.urandom(size))
+            f.close()
+        
+        # Nested directories (d1/d2/.../dN)
+        os.makedirs(os.path.join(plain, *["d%s" % (depth) for depth in xrange(1, max(DEPTHS) + 1)]))
+        
+        # Big directory
+        big = os.path.join(plain, 'big')
+        os.makedirs(big)
+        for entry in xrange(entries):
+            open(os.path.join(big, "entry-%08d.txt" % (entry)), 'wb').close()
+        
+        return plain
+    
+    def formats(self):
+        '''
+        Formats of the encrypted files as (name, algorithm, block size): legacy, version 1 and stream
+        '''
+        return [('legacy', DEFAULT_ALGORITHM, None), ('v1', DEFAULT_ALGORITHM, self.blocksize), ('stream', STREAM_ALGORITHM, None)]
+    
+    def mirror(self, plain, algorithm=DEFAULT_ALGORITHM, blocksize=None):
+        '''
+        Write the encrypted mirror of the files (to benchmark decryption)
+        '''
+        tag = "%s-%s" % (algorithm, blocksize or 'legacy')
+        if tag in self.mirrors:
+            return self.mirrors[tag]
+        target = os.path.join(self.workdir, "mirror-%s" % (tag))
+        tefs = self.tefs(os.path.join(plain, 'files'), 'encrypt', algorithm, blocksize)
+        for (vpath, ttarget, st) in walk(tefs, '/', target):
+            fh = tefs.open(vpath, os.O_RDONLY)
+            output = open(ttarget, 'wb')
+            offset = 0
+            while offset < st.st_size:
+                buf = tefs.read(vpath, 1048576, offset, fh)
+                output.write(buf)
+                offset += len(buf)
+            output.close()
+            tefs.release(vpath, os.O_RDONLY, fh)
+        self.mirrors[tag] = target
+        return target
+    
+    def cipher(self, algorithms):
+        '''
+        encrypt()/decrypt() of names and the engine over big buffers for every algorithm
+        '''
+        data = os.urandom(CIPHER_CHUNK)
+        for algorithm in algorithms:
+            (cipher, mode, blocksize) = ALGORITHMS[algorithm]
+            try:
+                engine = CipherEngine(algorithm, KEYS[cipher], self.backend)
+                tefs = self.tefs(self.workdir, 'encrypt', algorithm)
+            except Exception, e:
+                print "%-60s skipped: %s" % ("cipher/%s" % (algorithm), e)
+                continue
+            
+            # Names (base64 and padding included)
+            name = "some-file-name.txt"
+            encrypted = tefs.encrypt(name)
+            self.run("cipher/%s/name/encrypt" % (algorithm), lambda: tefs.encrypt(name) and 0, 'ops')
+            self.run("cipher/%s/name/decrypt" % (algorithm), lambda: tefs.decrypt(encrypted) and 0, 'ops')
+            
+            # Bulk data straight through the engine
+            ciphered = engine.encrypt(data)
+            self.run("cipher/%s/engine/encrypt" % (algorithm), lambda: len(engine.encrypt(data)), 'mbps')
+            self.run("cipher/%s/engine/decrypt" % (algorithm), lambda: len(engine.decrypt(ciphered)), 'mbps')
+    
+    def read(self, plain, sizes, lengths):
+        '''
+        read() (read_and_encrypt/read_and_decrypt) for every format, file size, read length and access pattern
+        '''
+        for (fmt, algorithm, blocksize) in self.formats():
+            for action in ('encrypt', 'decrypt'):
+                
+                # Decrypting reads the encrypted mirror
+                if action == 'encrypt':
+                    tefs = self.tefs(os.path.join(plain, 'files'), action, algorithm, blocksize)
+                else:
+                    tefs = self.tefs(self.mirror(plain, algorithm, blocksize), action, algorithm, blocksize)
+                
+                for size in sizes:
+                    if action == 'encrypt':
+                        vpath = "/%s" % (tefs.virtualname("file%s" % (size)))
+                    else:
+                        vpath = "/file%s" % (size)
+                    fh = tefs.open(vpath, os.O_RDONLY)
+                    vsize = fh.st.st_size
+                    for length in lengths:
+                        for (pattern, offsets) in self.offsets(vsize, length):
+                            self.run("read/%s/%s/%s/%s/%s" % (action, fmt, size, length, pattern), self.reader(tefs, vpath, fh, length, offsets), 'mbps')
+                    tefs.release(vpath, os.O_RDONLY, fh)
+    
+    def offsets(self, size, length):
+        '''
+        Offsets for every access pattern: sequential, random aligned to the length and random anywhere
+        '''
+        rnd = random.Random(size + length)
+        count = max(1, min(size / length, 1024))
+        last = max(size - length, 0)
+        return [
+            ('sequential', [offset for offset in xrange(0, max(size, 1), length)]),
+            ('aligned', [rnd.randint(0, last / length) * length for i in xrange(count)]),
+            ('unaligned', [rnd.randint(0, last) for i in xrange(count)]),
+        ]
+    
+    def reader(self, tefs, vpath, fh, length, offsets):
+        '''
+        Function reading the next offset of the list every time it is called
+        '''
+        state = {'next': 0}
+        def function():
+            offset = offsets[state['next']]
+            state['next'] = (state['next'] + 1) % len(offsets)
+            return len(tefs.read(vpath, length, offset, fh))
+        return function
+    
+    def stat(self, plain):
+        '''
+        teFSstat with the size calculated, encrypting (only arithmetic) and decrypting (the header or the last block is read)
+        '''
+        for (fmt, algorithm, blocksize) in self.formats():
+            for action in ('encrypt', 'decrypt'):
+                if action == 'encrypt':
+                    folder = os.path.join(plain, 'files')
+                else:
+                    folder = self.mirror(plain, algorithm, blocksize)
+                tefs = self.tefs(folder, action, algorithm, blocksize)
+                paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+                state = {'next': 0}
+                def function():
+                    path = paths[state['next']]
+                    state['next'] = (state['next'] + 1) % len(paths)
+                    return teFSstat(path, tefs.probe).st_size and 0
+                self.run("stat/%s/%s" % (action, fmt), function, 'ops')
+    
+    def realpath(self, plain):
+        '''
+        realpath() at several depths, without cache (every name is deciphered) and from the cache
+        '''
+        for (cache, pathcache) in (('cold', 0), ('warm', 65536)):
+            tefs = self.tefs(plain, 'encrypt', pathcache=pathcache)
+            for depth in DEPTHS:
+                vpath = "/%s" % ("/".join([tefs.encrypt("d%s" % (step)) for step in xrange(1, depth + 1)]))
+                if tefs.realpath(vpath) != os.path.join(plain, *["d%s" % (step) for step in xrange(1, depth + 1)]):
+                    raise IOError,"realpath() gave a wrong answer for depth %s" % (depth)
+                self.run("realpath/%s/depth%s" % (cache, depth), lambda: tefs.realpath(vpath) and 0, 'ops')
+    
+    def readdir(self, plain, entries):
+        '''
+        readdir() of the big directory, listed from the disk and from the cache of listings (ops are entries)
+        '''
+        for (cache, dircache) in (('cold', 0), ('warm', 32 * 1024 * 1024)):
+            tefs = self.tefs(plain, 'encrypt', dircache=dircache)
+            vpath = "/%s" % (tefs.encrypt('big'))
+            def function():
+                for entry in tefs.readdir(vpath, 0):
+                    pass
+                return 0
+            (ops, mbps) = measure(function, self.mintime, self.repeat)
+            self.results["readdir/%s/%s" % (cache, entries)] = {'ops': ops * (entries + 2), 'unit': 'ops'}
+            print "%-60s %12.0f entries/s" % ("readdir/%s/%s" % (cache, entries), ops * (entries + 2))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare the results with the baseline, returns the names of the cases which got slower than the tolerance (percentage)
+    '''
+    slower = []
+    print
+    print "%-60s %12s %12s %8s" % ("Case", "Baseline", "Now", "Change")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        unit = results[name]['unit']
+        before = baseline[name].get(unit)
+        now = results[name][unit]
+        if not before:
+            continue
+        change = (now - before) * 100.0 / before
+        if change < -tolerance:
+            slower.append(name)
+            mark = " <<"
+        else:
+            mark = ""
+        print "%-60s %12.1f %12.1f %+7.1f%%%s" % (name, before, now, change, mark)
+    return slower
+
+
+def main():
+    usage  = ""
+    usage += "Usage: %s [options]\n" % (sys.argv[0])
+    usage += "Options:\n"
+    
+    # ONLY: groups of cases to run
+    usage += "    --only=LIST       Groups to run: cipher, read, stat, realpath, readdir (default: all of them)\n"
+    
+    # ALGORITHMS: algorithms for the cipher cases (the rest use AESECB)
+    usage += "    --algorithms=LIST Algorithms for the cipher cases (default: all of them)\n"
+    
+    # BACKEND/BLOCKSIZE: same as in main.py, the block size is the one used by the version 1 format cases
+    usage += "    --backend=NAME    Cipher backend: auto, openssl or pycrypto (default: auto)\n"
+    usage += "    --blocksize=N     Block size of the version 1 format cases (default: 65536)\n"
+    
+    # SIZES/LENGTHS/ENTRIES: generated tree
+    usage += "    --sizes=LIST      File sizes for the read cases (default: 4096,1048576,16777216)\n"
+    usage += "    --lengths=LIST    Read lengths (default: 4096,131072)\n"
+    usage += "    --entries=N       Entries of the big directory for the readdir cases (default: 10000)\n"
+    
+    # TIME/REPEAT: every case runs repeat times for at least time seconds, the best run is kept
+    usage += "    --time=SECS       Minimum time of every run (default: 0.5)\n"
+    usage += "    --repeat=N        Runs of every case (default: 3)\n"
+    
+    # OUTPUT/BASELINE: results as JSON and comparison with a previous run
+    usage += "    --output=FILE     Write the results as JSON\n"
+    usage += "    --baseline=FILE   Compare with the results of a previous run, exit with 1 if something got slower\n"
+    usage += "    --tolerance=PCT   Percentage a case may get slower before being reported (default: 10)\n"
+    usage += "    --workdir=DIR     Where the trees are generated (default: a temporal directory)\n"
+    usage += "    --quick           Small files and a single short run (to check the suite works)\n"
+    
+    # Process options
+    quick = getargv('--quick')
+    only = getargvalue('--only', 'cipher,read,stat,realpath,readdir').split(",")
+    algorithms = getargvalue('--algorithms', ",".join(sorted(ALGORITHMS))).split(",")
+    backend = getargvalue('--backend', 'auto')
+    output = getargvalue('--output')
+    baseline_path = getargvalue('--baseline')
+    workdir = getargvalue('--workdir')
+    try:
+        blocksize = int(getargvalue('--blocksize', '65536'))
+        if quick:
+            sizes = [int(size) for size in getargvalue('--sizes', '4096,131072').split(",")]
+            entries = int(getargvalue('--entries', '1000'))
+            mintime = float(getargvalue('--time', '0.05'))
+            repeat = int(getargvalue('--repeat', '1'))
+        else:
+            sizes = [int(size) for size in getargvalue('--sizes', '4096,1048576,16777216').split(",")]
+            entries = int(getargvalue('--entries', '10000'))
+            mintime = float(getargvalue('--time', '0.5'))
+            repeat = int(getargvalue('--repeat', '3'))
+        lengths = [int(length) for length in getargvalue('--lengths', '4096,131072').split(",")]
+        tolerance = float(getargvalue('--tolerance', '10'))
+    except ValueError:
+        print "Warning: --blocksize, --sizes, --lengths, --entries, --time, --repeat and --tolerance must be numbers"
+        print
+        print usage
+        sys.exit()
+    
+    # Values teFS can't use would leave it half built
+    error = checkblocksize(blocksize) or checkbackend(backend)
+    if error:
+        print "Warning: %s" % (error)
+        print
+        print usage
+        sys.exit()
+    
+    # Unknown options
+    if len(sys.argv) > 1:
+        print "Warning: unknown options %s" % (", ".join(sys.argv[1:]))
+        print
+        print usage
+        sys.exit()
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            print "Warning: unknown algorithm '%s'" % (algorithm)
+            print
+            print usage
+            sys.exit()
+    
+    # Load the baseline first, so a wrong file is found out before running anything
+    baseline = None
+    if baseline_path:
+        f = open(baseline_path, 'rb')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline.get('version') != RESULTS_VERSION:
+            print "Warning: '%s' is not a results file of this version" % (baseline_path)
+            sys.exit()
+    
+    # Generate the trees in a temporal directory
+    if workdir:
+        workdir = tempfile.mkdtemp(prefix='tefs-benchmark-', dir=workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='tefs-benchmark-')
+    try:
+        benchmark = Benchmark(workdir, backend, blocksize, mintime, repeat)
+        plain = benchmark.generate(sizes, entries)
+        
+        # Run the cases
+        if 'cipher' in only:
+            benchmark.cipher(algorithms)
+        if 'read' in only:
+            benchmark.read(plain, sizes, lengths)
+        if 'stat' in only:
+            benchmark.stat(plain)
+        if 'realpath' in only:
+            benchmark.realpath(plain)
+        if 'readdir' in only:
+            benchmark.readdir(plain, entries)
+    finally:
+        shutil.rmtree(workdir, True)
+    
+    # Save the results with what is needed to compare them
+    settings = {'backend': backend, 'backends': available_backends(), 'blocksize': blocksize, 'time': mintime, 'repeat': repeat, 'python': sys.version.split()[0]}
+    if output:
+        f = open(output, 'wb')
+        try:
+            json.dump({'version': RESULTS_VERSION, 'settings': settings, 'results': benchmark.results}, f, sort_keys=True, indent=1)
+        finally:
+            f.close()
+    
+    # Compare with the baseline
+    if baseline is not None:
+        slower = compare(benchmark.results, baseline.get('results', {}), tolerance)
+        if slower:
+            print
+            print "%s cases are more than %s%% slower than the baseline" % (len(slower), tolerance)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
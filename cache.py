@@ -0,0 +1,164 @@
+#########################################################################
+#                                                                       #
+# Name:      Cache                                                      #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Cache                                                      #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Caches used by teFS
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['LRUCache', 'CacheView']
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Bounded cache which forgets the least recently used entries first, safe to use from many threads
+    '''
+    
+    def __init__(self, size, budget=None, weight=len):
+        '''
+        Build a cache for up to size entries and budget bytes of values (None means no limit, 0 disables the cache),
+        weight tells the bytes used by a value
+        '''
+        self.size = size
+        self.budget = budget
+        self.weight = weight
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.__data)
+    
+    def __contains__(self, key):
+        return key in self.__data
+    
+    def get(self, key, default=None):
+        '''
+        Get the value for the key and mark it as recently used
+        '''
+        with self.__lock:
+            try:
+                value = self.__data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            
+            # Put it back at the end
+            self.__data[key] = value
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        '''
+        Save the value for the key, forgetting old entries when full
+        '''
+        if self.size == 0 or self.budget == 0:
+            return
+        
+        # Values bigger than the budget are not saved
+        if self.budget is not None:
+            weight = self.weight(value)
+            if weight > self.budget:
+                return
+        
+        with self.__lock:
+            
+            # Save it at the end
+            self.forget(key)
+            self.__data[key] = value
+            if self.budget is not None:
+                self.bytes += weight
+            
+            # Forget the oldest ones
+            while (self.size is not None and len(self.__data) > self.size) or (self.budget is not None and self.bytes > self.budget):
+                self.forget(next(iter(self.__data)))
+    
+    def forget(self, key, default=None):
+        '''
+        Remove the key keeping the count of bytes (the lock must be held)
+        '''
+        value = self.__data.pop(key, default)
+        if self.budget is not None and value is not default:
+            self.bytes -= self.weight(value)
+        return value
+    
+    def pop(self, key, default=None):
+        '''
+        Forget the key
+        '''
+        with self.__lock:
+            return self.forget(key, default)
+    
+    def clear(self):
+        '''
+        Forget everything
+        '''
+        with self.__lock:
+            self.__data.clear()
+            self.bytes = 0
+    
+    def stats(self):
+        '''
+        Return a dictionary with the statistics of the cache
+        '''
+        total = self.hits + self.misses
+        if total:
+            ratio = float(self.hits) / total
+        else:
+            ratio = 0.0
+        return {'entries': len(self.__data), 'size': self.size, 'bytes': self.bytes, 'budget': self.budget, 'hits': self.hits, 'misses': self.misses, 'ratio': ratio}
+
+
+class CacheView(object):
+    '''
+    Part of a cache shared by several users: the keys of every view are kept apart from the keys of
+    the rest, while the size and the budget are the ones of the whole cache
+    '''
+    
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+    
+    @property
+    def size(self):
+        return self.cache.size
+    
+    @property
+    def budget(self):
+        return self.cache.budget
+    
+    def __contains__(self, key):
+        return (self.namespace, key) in self.cache
+    
+    def get(self, key, default=None):
+        return self.cache.get((self.namespace, key), default)
+    
+    def set(self, key, value):
+        self.cache.set((self.namespace, key), value)
+    
+    def pop(self, key, default=None):
+        return self.cache.pop((self.namespace, key), default)
+    
+    def stats(self):
+        '''
+        Statistics of the whole cache
+        '''
+        return self.cache.stats()
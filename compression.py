@@ -0,0 +1,118 @@
+#########################################################################
+#                                                                       #
+# Name:      Compression                                                #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Compression                                                #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Codecs compressing the blocks of the compressed format
+
+zlib is always available, lz4 and zstd are used when their modules are
+installed. Every codec has a number which is saved in the header of the
+files, so decrypting doesn't need to be told which one was used.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['Codec', 'CODECS', 'available_codecs']
+
+import zlib
+import threading
+
+# LZ4 (very fast, less compression)
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# Zstandard (fast and good compression)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Supported codecs: name -> number saved in the files
+CODECS = {'zlib': 1, 'lz4': 2, 'zstd': 3}
+
+# Default level of every codec (lz4 has only one)
+LEVELS = {'zlib': 6, 'lz4': None, 'zstd': 3}
+
+
+def available_codecs():
+    '''
+    Return the names of the codecs available in this system
+    '''
+    found = ['zlib']
+    if lz4:
+        found.append('lz4')
+    if zstandard:
+        found.append('zstd')
+    return found
+
+
+class Codec(object):
+    '''
+    Compress and decompress blocks with one of the codecs, safe to use from many threads
+    '''
+    
+    def __init__(self, name, level=None):
+        '''
+        Prepare the codec, given by its name or by its number
+        '''
+        
+        # Numbers come from the header of the files
+        for (known, number) in CODECS.items():
+            if name == number:
+                name = known
+        if name not in CODECS:
+            raise IOError,"Unknown compression '%s', use one of: %s" % (name, ", ".join(sorted(CODECS)))
+        if name not in available_codecs():
+            raise IOError,"Compression '%s' is not available in this system (install its Python module)" % (name)
+        
+        self.name = name
+        self.number = CODECS[name]
+        if level is None:
+            level = LEVELS[name]
+        self.level = level
+        
+        # Zstandard contexts can't be shared by threads, every thread builds its own ones
+        self.__local = threading.local()
+    
+    def compress(self, data):
+        '''
+        Compress a block
+        '''
+        if self.name == 'zlib':
+            return zlib.compress(data, self.level)
+        elif self.name == 'lz4':
+            return lz4.block.compress(data, store_size=False)
+        else:
+            try:
+                compressor = self.__local.compressor
+            except AttributeError:
+                compressor = self.__local.compressor = zstandard.ZstdCompressor(level=self.level)
+            return compressor.compress(data)
+    
+    def decompress(self, data, size):
+        '''
+        Decompress a block which had size bytes
+        '''
+        if self.name == 'zlib':
+            return zlib.decompress(data)
+        elif self.name == 'lz4':
+            return lz4.block.decompress(data, uncompressed_size=size)
+        else:
+            try:
+                decompressor = self.__local.decompressor
+            except AttributeError:
+                decompressor = self.__local.decompressor = zstandard.ZstdDecompressor()
+            return decompressor.decompress(data, max_output_size=size)
@@ -15,109 +15,292 @@
 #########################################################################
 '''
 Debugger helps to debug the system
+
+Messages are queued and written by a background thread, so the caller
+never waits for the disk. The sinks and the level for every class are
+worked out once in set_debug(), a message below that level is dropped
+before anything is built.
 '''
 
 __version__ = "201109142036"
 
-__all__ = ['Debugger','lineno']
+__all__ = ['Debugger', 'LogWriter', 'lineno', 'DEBUG', 'WARNING', 'ERROR', 'LEVELS']
 
+import os
+import sys
 import time
-import datetime
-import inspect
+import atexit
+import threading
+import Queue
 
 from colors import colors
 
+# Levels of the messages
+DEBUG = 10
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'warning': WARNING, 'error': ERROR}
+
+# Messages waiting to be written (when full, debug messages are dropped and the rest wait)
+LOG_QUEUE = 4096
+
+# Messages written together before flushing the handlers
+LOG_BATCH = 256
+
 def lineno():
     '''
     Returns the current line number in our program.
     '''
-    return inspect.currentframe().f_back.f_lineno
+    return sys._getframe(1).f_lineno
 
-class Debugger:
-    
-    __indebug={}
+def colorcode(color):
+    '''
+    Terminal escape sequence for the color
+    '''
+    (darkbit,subcolor)=colors[color]
+    return "\033[%1d;%02dm" % (darkbit,subcolor)
+
+# Escape sequences are built only once
+codes=dict([(color, colorcode(color)) for color in colors])
+
+
+class LogWriter(object):
+    '''
+    Background thread writing the queued messages. There is one per process, it is started
+    with the first message (after FUSE went to background or the process was forked)
+    '''
     
-    def set_debug(self,debug):
-        if type(debug) is dict:
-            self.__indebug=debug
-        else:
-            raise IOError("Argument is not a dictionary")
+    # Sinks used for messages of the writer itself (filled by the debuggers)
+    sinks = []
     
-    def get_debug(self):
-        return self.__indebug
+    def __init__(self, size=LOG_QUEUE, batch=LOG_BATCH):
+        '''
+        Prepare the writer
+        '''
+        self.size = size
+        self.batch = batch
+        self.dropped = 0
+        self.__lock = threading.Lock()
+        self.__queue = None
+        self.__thread = None
+        self.__pid = None
     
-    def color(self,color):
-        # Colors$
-        if color in colors:
-            (darkbit,subcolor)=colors[color]
-            return "\033[%1d;%02dm" % (darkbit,subcolor)
-        else:
-            if color:
-                self.debug("\033[1;31mColor '%s' unknown\033[1;00m\n" % (color))
-            return ''
+    def start(self):
+        '''
+        Start the thread of this process (the lock must be held)
+        '''
+        self.__queue = Queue.Queue(self.size)
+        self.__pid = os.getpid()
+        self.__thread = threading.Thread(target=self.worker, name="teFS-log")
+        self.__thread.daemon = True
+        self.__thread.start()
     
-    def debug(self,msg,header=True,color=None):
+    def submit(self, record, wait):
+        '''
+        Queue a message, when the queue is full wait only if asked to
+        '''
         
-        # Retrieve the name of the class
-        clname=self.__class__.__name__
+        # Threads don't survive a fork, start a new one in this process
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self.start()
         
-        # For each element inside indebug
-        for name in self.__indebug:
+        try:
+            self.__queue.put(record, wait)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def flush(self):
+        '''
+        Wait until every queued message was written
+        '''
+        if self.__pid == os.getpid():
+            self.__queue.join()
+    
+    def worker(self):
+        '''
+        Write the queued messages, flushing once for every batch
+        '''
+        queue = self.__queue
+        while True:
+            records = [queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            queued = len(records)
             
-            # Get color
-            if name!='screen': color=None
-            color_ini=self.color(color)
-            color_end=self.color('close')
+            # Say how many messages were lost
+            if self.dropped:
+                (dropped, self.dropped) = (self.dropped, 0)
+                records.append((None, ERROR, 'LogWriter', time.time(), "%s debug messages dropped, the log queue was full\n", (dropped,), True, 'red'))
             
-            # Get file output handler and indebug list
-            (handler,indebug)=self.__indebug[name]
+            # Write them all
+            handlers = []
+            for record in records:
+                for handler in self.write(record):
+                    if handler not in handlers:
+                        handlers.append(handler)
+            for handler in handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
             
-            # Look up if the name of the class is inside indebug
-            if (clname in indebug) or (('*' in indebug) and ('-%s' % (clname) not in indebug)):
-                
-                # Build the message
-                message=color_ini
-                if header:
-                    now=datetime.datetime.fromtimestamp(time.time())
-                    message+="%02d/%02d/%d %02d:%02d:%02d %-10s - " % (now.day, now.month, now.year, now.hour, now.minute, now.second, clname)
-                message+=str(msg)
-                message+=color_end
-                
-                # Print it on the file handler
+            for record in xrange(queued):
+                queue.task_done()
+    
+    def write(self, record):
+        '''
+        Format the message and write it on its sinks, returns the handlers used
+        '''
+        (sinks, level, clname, when, msg, args, header, color) = record
+        if sinks is None:
+            sinks = self.sinks
+        
+        # Build the message
+        try:
+            if args:
+                msg = msg % args
+            else:
+                msg = str(msg)
+        except Exception, e:
+            msg = "%r %% %r (%s)\n" % (msg, args, e)
+        if header:
+            now = time.localtime(when)
+            stamp = "%02d/%02d/%d %02d:%02d:%02d %-10s - " % (now.tm_mday, now.tm_mon, now.tm_year, now.tm_hour, now.tm_min, now.tm_sec, clname)
+            if level >= ERROR:
+                stamp = "\nERROR - %s" % (stamp)
+            elif level >= WARNING:
+                stamp = "\nWARNING - %s" % (stamp)
+            msg = stamp + msg
+        
+        # Print it on the file handlers (only the screen gets colors)
+        handlers = []
+        for (handler, colored) in sinks:
+            if colored and color:
+                message = "%s%s%s" % (codes.get(color, ''), msg, codes['close'])
+            else:
+                message = msg
+            try:
                 handler.write(message)
-                handler.flush()
+                handlers.append(handler)
+            except Exception:
+                pass
+        return handlers
+
+# Writer of this process, wait for the queued messages before leaving
+writer = LogWriter()
+atexit.register(writer.flush)
+
+
+class Debugger:
     
-    def warning(self,msg,header=True):
-        self.warningerror(msg,header,'WARNING','yellow')
+    __indebug={}
+    __sinks={}
     
-    def error(self,msg,header=True):
-        self.warningerror(msg,header,'ERROR','red')
+    # Nothing is written until set_debug() is called
+    debug_level=ERROR+1
+    log_level=ERROR+1
     
-    def warningerror(self,msg,header,prefix,color):
+    def set_debug(self,debug):
+        '''
+        Configure the sinks: a dictionary of name -> (handler, classes) or (handler, classes, level), where
+        classes is a list of class names, '*' for all of them and '-name' to leave one out. Only the sink
+        called 'screen' gets colors. Warnings and errors go to every sink with a level low enough
+        '''
+        if type(debug) is not dict:
+            raise IOError("Argument is not a dictionary")
         
         # Retrieve the name of the class
         clname=self.__class__.__name__
         
-        # For each element inside indebug
-        for name in self.__indebug:
+        # Find out once the sinks for every level
+        sinks={DEBUG: [], WARNING: [], ERROR: []}
+        for name in debug:
             
-            # Get file output handler and indebug list
-            (handler,indebug)=self.__indebug[name]
+            # Get file output handler, indebug list and level
+            config=debug[name]
+            (handler,indebug)=config[:2]
+            if len(config)>2:
+                level=config[2]
+            else:
+                level=DEBUG
+            sink=(handler,name=='screen')
             
-            # Get color
-            if name!='screen': color=None
-            color_ini=self.color(color)
-            color_end=self.color('close')
-            
-            # Build the message
-            message=color_ini
-            if header:
-                now=datetime.datetime.fromtimestamp(time.time())
-                message+="\n%s - %02d/%02d/%d %02d:%02d:%02d %-10s - " % (prefix,now.day, now.month, now.year, now.hour, now.minute, now.second, clname)
-            message+=str(msg)
-            message+=color_end
-            
-            # Print it on the file handler
-            handler.write(message)
-            handler.flush()
-
+            # Debug messages only when the name of the class is inside indebug
+            if level<=DEBUG and ((clname in indebug) or (('*' in indebug) and ('-%s' % (clname) not in indebug))):
+                sinks[DEBUG].append(sink)
+            if level<=WARNING:
+                sinks[WARNING].append(sink)
+            if level<=ERROR:
+                sinks[ERROR].append(sink)
+        
+        self.__indebug=debug
+        self.__sinks=sinks
+        
+        # Lowest level with somewhere to go
+        self.debug_level=ERROR+1
+        self.log_level=ERROR+1
+        for level in (ERROR, WARNING, DEBUG):
+            if sinks[level]:
+                self.log_level=level
+        if sinks[DEBUG]:
+            self.debug_level=DEBUG
+        
+        # The writer reports its own problems with the errors
+        if sinks[ERROR]:
+            LogWriter.sinks=sinks[ERROR]
+    
+    def get_debug(self):
+        return self.__indebug
+    
+    def color(self,color):
+        # Colors
+        if color in codes:
+            return codes[color]
+        else:
+            if color:
+                self.debug("\033[1;31mColor '%s' unknown\033[1;00m\n", color)
+            return ''
+    
+    def debug(self,msg,*args,**kargs):
+        '''
+        Queue a debug message, msg % args is built by the writer thread (keywords: header, color)
+        '''
+        if self.debug_level>DEBUG:
+            return
+        self.log(DEBUG,msg,args,kargs.get('header',True),kargs.get('color'))
+    
+    def warning(self,msg,*args,**kargs):
+        if self.log_level>WARNING:
+            return
+        self.log(WARNING,msg,args,kargs.get('header',True),'yellow')
+    
+    def error(self,msg,*args,**kargs):
+        if self.log_level>ERROR:
+            return
+        self.log(ERROR,msg,args,kargs.get('header',True),'red')
+    
+    def warningerror(self,msg,header,prefix,color):
+        # Kept for old callers, prefix is WARNING or ERROR
+        if prefix=='WARNING':
+            self.warning(msg,header=header)
+        else:
+            self.error(msg,header=header)
+    
+    def log(self,level,msg,args,header=True,color=None):
+        '''
+        Queue the message for the sinks of its level, debug messages are dropped if the queue is full
+        '''
+        sinks=self.__sinks.get(level)
+        if sinks:
+            writer.submit((sinks,level,self.__class__.__name__,time.time(),msg,args,header,color),level>DEBUG)
+    
+    def flush_log(self):
+        '''
+        Wait until every queued message was written
+        '''
+        writer.flush()
@@ -0,0 +1,468 @@
+#########################################################################
+#                                                                       #
+# Name:      Engine                                                     #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Engine                                                     #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Cipher engine for teFS: resolves the algorithm once and keeps reusable
+cipher contexts for every thread using one of the available backends
+
+CTR algorithms cipher names like ECB ones (padded blocks) and contents as
+a seekable stream: the counter of every file starts with its nonce (12
+bytes followed by zeroes) and the number of the cipher block is added to
+it, so any offset can be ciphered straight.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['CipherEngine', 'ALGORITHMS', 'BACKENDS', 'available_backends']
+
+import time
+import threading
+
+# PyCrypto backend (the reference one, every algorithm is available)
+try:
+    from Crypto.Cipher import AES, ARC2, Blowfish, CAST, DES
+    from Crypto.Util import Counter
+    pycrypto = {'AES': AES, 'ARC2': ARC2, 'Blowfish': Blowfish, 'CAST': CAST, 'DES': DES}
+except ImportError:
+    pycrypto = None
+
+# OpenSSL backend through cryptography (uses AES-NI when the CPU has it)
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+    openssl = {'AES': algorithms.AES, 'Blowfish': algorithms.Blowfish, 'CAST': algorithms.CAST5, 'DES': algorithms.TripleDES}
+except ImportError:
+    openssl = None
+
+# Supported algorithms: name -> (cipher, mode, cipher block size)
+ALGORITHMS = {}
+ALGORITHMS['AESCFB']      = ('AES', 'CFB', 16)
+ALGORITHMS['AESCTR']      = ('AES', 'CTR', 16)
+ALGORITHMS['AESECB']      = ('AES', 'ECB', 16)
+ALGORITHMS['ARC2CFB']     = ('ARC2', 'CFB', 8)
+ALGORITHMS['ARC2ECB']     = ('ARC2', 'ECB', 8)
+ALGORITHMS['BlowfishCFB'] = ('Blowfish', 'CFB', 8)
+ALGORITHMS['BlowfishECB'] = ('Blowfish', 'ECB', 8)
+ALGORITHMS['CASTCFB']     = ('CAST', 'CFB', 8)
+ALGORITHMS['CASTECB']     = ('CAST', 'ECB', 8)
+ALGORITHMS['DESCFB']      = ('DES', 'CFB', 8)
+ALGORITHMS['DESECB']      = ('DES', 'ECB', 8)
+
+# Backends sorted by preference
+BACKENDS = ['openssl', 'pycrypto']
+
+# Counters of the streams are 128 bits
+MASK128 = (1 << 128) - 1
+
+
+def counter(nonce, block):
+    '''
+    Counter (a number) of the given cipher block of the stream of the nonce: the nonce fills the first bytes
+    of the counter and the number of the block is added to it
+    '''
+    return (int((nonce + '\0' * (16 - len(nonce))).encode('hex'), 16) + block) & MASK128
+
+
+def counter_block(nonce, block):
+    '''
+    Counter of the given cipher block of the stream of the nonce as 16 bytes
+    '''
+    return ('%032x' % (counter(nonce, block))).decode('hex')
+
+
+class PyCryptoContext(object):
+    '''
+    Cipher contexts built with PyCrypto
+    '''
+    
+    name = 'pycrypto'
+    
+    def __init__(self, cipher, mode, blocksize, key):
+        '''
+        Prepare the factory for the cipher objects
+        '''
+        if not pycrypto:
+            raise IOError,"PyCrypto is not available in this system"
+        
+        self.__module = pycrypto[cipher]
+        self.__key = key
+        # PyCrypto 2.x used an IV full of zeroes when none was given, keep it explicit
+        self.__iv = '\0' * blocksize
+        # CTR algorithms use ECB for everything but the streams
+        self.__ecb = (mode in ('ECB', 'CTR'))
+        
+        # Build one context to check the key
+        context = self.new()
+        
+        # PyCryptodome can write the result in a given buffer, PyCrypto 2.x can't
+        try:
+            sample = bytearray(blocksize)
+            context.encrypt(sample, output=sample)
+            self.__into = True
+        except TypeError:
+            self.__into = False
+        
+        # Spare bytes the buffers need after the data to cipher them in place
+        self.slack = 0
+    
+    def new(self):
+        '''
+        Build a new cipher object
+        '''
+        if self.__ecb:
+            return self.__module.new(self.__key, self.__module.MODE_ECB)
+        else:
+            return self.__module.new(self.__key, self.__module.MODE_CFB, self.__iv)
+    
+    def reusable(self):
+        '''
+        ECB objects have no state between calls and can be reused
+        '''
+        return self.__ecb
+    
+    def stream_into(self, nonce, block, buf, start, end):
+        '''
+        XOR in place buf[start:end] with the CTR keystream of the nonce starting at the given cipher block
+        '''
+        context = self.__module.new(self.__key, self.__module.MODE_CTR, counter=Counter.new(128, initial_value=counter(nonce, block)))
+        if self.__into:
+            view = memoryview(buf)[start:end]
+            context.encrypt(view, output=view)
+        else:
+            buf[start:end] = context.encrypt(str(buffer(buf, start, end - start)))
+    
+    def encryptor(self, context):
+        '''
+        Get the encryption function from the context
+        '''
+        return context.encrypt
+    
+    def decryptor(self, context):
+        '''
+        Get the decryption function from the context
+        '''
+        return context.decrypt
+    
+    def encryptor_into(self, context):
+        '''
+        Get the function encrypting in place the start of a bytearray (None if the library can't)
+        '''
+        if not self.__into:
+            return None
+        encrypt = context.encrypt
+        def into(buf, length):
+            view = memoryview(buf)[:length]
+            encrypt(view, output=view)
+        return into
+    
+    def decryptor_into(self, context):
+        '''
+        Get the function decrypting in place the start of a bytearray (None if the library can't)
+        '''
+        if not self.__into:
+            return None
+        decrypt = context.decrypt
+        def into(buf, length):
+            view = memoryview(buf)[:length]
+            decrypt(view, output=view)
+        return into
+
+
+class OpenSSLContext(object):
+    '''
+    Cipher contexts built with cryptography (OpenSSL)
+    '''
+    
+    name = 'openssl'
+    
+    def __init__(self, cipher, mode, blocksize, key):
+        '''
+        Prepare the factory for the cipher objects
+        '''
+        if not openssl:
+            raise IOError,"cryptography (OpenSSL) is not available in this system"
+        if cipher not in openssl:
+            raise IOError,"Cipher %s is not available in OpenSSL backend" % (cipher)
+        
+        # CFB in PyCrypto is CFB8 with an IV full of zeroes, CTR algorithms use ECB for everything but the streams
+        if mode in ('ECB', 'CTR'):
+            self.__mode = modes.ECB()
+        else:
+            self.__mode = modes.CFB8('\0' * blocksize)
+        self.__ecb = (mode in ('ECB', 'CTR'))
+        self.__algorithm = openssl[cipher](key)
+        self.__cipher = Cipher(self.__algorithm, self.__mode, backend=default_backend())
+        
+        # Build one context to check the cipher is supported
+        context = self.new()
+        
+        # update_into() (cryptography 1.8 and later) writes the result in a given buffer, it asks
+        # for one cipher block less one spare bytes after the data to cipher them in place
+        self.__into = hasattr(context[0], 'update_into')
+        self.slack = blocksize - 1
+    
+    def new(self):
+        '''
+        Build a new pair of encryptor/decryptor objects
+        '''
+        return (self.__cipher.encryptor(), self.__cipher.decryptor())
+    
+    def reusable(self):
+        '''
+        ECB objects have no state between calls and can be reused
+        '''
+        return self.__ecb
+    
+    def stream_into(self, nonce, block, buf, start, end):
+        '''
+        XOR in place buf[start:end] with the CTR keystream of the nonce starting at the given cipher block
+        (buf needs self.slack spare bytes after end)
+        '''
+        context = Cipher(self.__algorithm, modes.CTR(counter_block(nonce, block)), backend=default_backend()).encryptor()
+        if self.__into:
+            context.update_into(memoryview(buf)[start:end], memoryview(buf)[start:])
+        else:
+            buf[start:end] = context.update(str(buffer(buf, start, end - start)))
+    
+    def encryptor(self, context):
+        '''
+        Get the encryption function from the context
+        '''
+        return context[0].update
+    
+    def decryptor(self, context):
+        '''
+        Get the decryption function from the context
+        '''
+        return context[1].update
+    
+    def encryptor_into(self, context):
+        '''
+        Get the function encrypting in place the start of a bytearray (None if the library can't)
+        '''
+        if not self.__into:
+            return None
+        update_into = context[0].update_into
+        def into(buf, length):
+            update_into(memoryview(buf)[:length], buf)
+        return into
+    
+    def decryptor_into(self, context):
+        '''
+        Get the function decrypting in place the start of a bytearray (None if the library can't)
+        '''
+        if not self.__into:
+            return None
+        update_into = context[1].update_into
+        def into(buf, length):
+            update_into(memoryview(buf)[:length], buf)
+        return into
+
+
+# Backends by name
+CONTEXTS = {'pycrypto': PyCryptoContext, 'openssl': OpenSSLContext}
+
+
+def available_backends():
+    '''
+    Return the list of backends installed in this system
+    '''
+    available = []
+    if openssl:
+        available.append('openssl')
+    if pycrypto:
+        available.append('pycrypto')
+    return available
+
+
+class CipherEngine(object):
+    '''
+    Resolve the algorithm once and serve reusable cipher contexts per thread
+    '''
+    
+    def __init__(self, algorithm, key, backend='auto'):
+        '''
+        Build the engine for the given algorithm and key
+        '''
+        
+        # Check the algorithm
+        if algorithm not in ALGORITHMS:
+            raise IOError,"Specified encryption algorithm is unkown: %s" % (algorithm)
+        (cipher, mode, blocksize) = ALGORITHMS[algorithm]
+        
+        # Integrity of the key
+        if cipher == 'AES':
+            # The block size for the cipher object; must be 16, 24, or 32 for AES
+            if len(key) not in (16, 24, 32):
+                raise IOError,"Key length is '%s' and should be 16, 24 or 32" % (len(key))
+        
+        # Remember the configuration
+        self.algorithm = algorithm
+        self.cipher = cipher
+        self.mode = mode
+        self.cipher_blocksize = blocksize
+        
+        # Padding is only required by block modes (names of CTR algorithms are ciphered with ECB)
+        if mode in ('ECB', 'CTR'):
+            self.padding = blocksize
+        else:
+            self.padding = 0
+        
+        # Contents are ciphered as a seekable stream
+        self.stream = (mode == 'CTR')
+        
+        # Choose the backend
+        if backend == 'auto':
+            self.__factory = self.fastest(cipher, mode, blocksize, key)
+        elif backend in CONTEXTS:
+            self.__factory = CONTEXTS[backend](cipher, mode, blocksize, key)
+        else:
+            raise IOError,"Backend can be only %s or auto, you gave me '%s'" % (", ".join(BACKENDS), backend)
+        self.backend = self.__factory.name
+        self.__reusable = self.__factory.reusable()
+        
+        # Spare bytes buffers need after the data to cipher them in place
+        self.slack = self.__factory.slack
+        
+        # Contexts for every thread
+        self.__local = threading.local()
+    
+    def fastest(self, cipher, mode, blocksize, key):
+        '''
+        Try every available backend and return the fastest one which gives the same result as the rest
+        '''
+        
+        # Sample to calibrate with (a multiple of any cipher block size)
+        sample = ''.join([chr(i % 256) for i in xrange(65536)])
+        
+        best = None
+        reference = None
+        for name in BACKENDS:
+            
+            # Build the backend if it is available for this algorithm
+            try:
+                factory = CONTEXTS[name](cipher, mode, blocksize, key)
+            except Exception:
+                continue
+            
+            # Measure it
+            encryptor = factory.encryptor(factory.new())
+            start = time.time()
+            for i in xrange(4):
+                result = encryptor(sample)
+            elapsed = time.time() - start
+            
+            # All backends must give the same ciphertext, the first one found is the reference
+            if reference is None:
+                reference = result
+            elif result != reference:
+                continue
+            
+            # Keep the fastest
+            if best is None or elapsed < best[0]:
+                best = (elapsed, factory)
+        
+        # No backend at all
+        if best is None:
+            raise IOError,"No cipher backend is available for %s (install cryptography or PyCrypto)" % (cipher)
+        
+        return best[1]
+    
+    def context(self):
+        '''
+        Get the functions (encrypt, decrypt, encrypt in place, decrypt in place) for this thread
+        '''
+        
+        # CFB contexts have state, they must be new every time
+        if not self.__reusable:
+            return self.functions(self.__factory.new())
+        
+        # Reuse the context of this thread
+        try:
+            return self.__local.functions
+        except AttributeError:
+            self.__local.functions = self.functions(self.__factory.new())
+            return self.__local.functions
+    
+    def functions(self, context):
+        '''
+        Get the functions of a context
+        '''
+        factory = self.__factory
+        return (factory.encryptor(context), factory.decryptor(context), factory.encryptor_into(context), factory.decryptor_into(context))
+    
+    def check(self, length):
+        '''
+        ECB works with whole cipher blocks. OpenSSL would keep the bytes left over inside the context of the
+        thread (and spoil the next call), PyCrypto raises: both backends raise
+        '''
+        if self.padding and length % self.cipher_blocksize:
+            raise IOError,"%s needs whole blocks of %s bytes, it got %s bytes" % (self.algorithm, self.cipher_blocksize, length)
+    
+    def encrypt(self, string):
+        '''
+        Encrypt the string (it must be already padded when using ECB)
+        '''
+        self.check(len(string))
+        return self.context()[0](string)
+    
+    def decrypt(self, string):
+        '''
+        Decrypt the string
+        '''
+        self.check(len(string))
+        return self.context()[1](string)
+    
+    def encrypt_into(self, buf, length):
+        '''
+        Encrypt in place the first length bytes of the bytearray, it must have self.slack spare bytes after them
+        '''
+        self.check(length)
+        functions = self.context()
+        if functions[2]:
+            functions[2](buf, length)
+        else:
+            buf[:length] = functions[0](str(buffer(buf, 0, length)))
+    
+    def stream_into(self, buf, start, end, nonce, offset):
+        '''
+        Cipher in place buf[start:end], which is at the given offset of the stream of the nonce (CTR algorithms only,
+        encrypting and decrypting are the same). buf must have self.slack spare bytes after end
+        '''
+        (block, skip) = divmod(offset, self.cipher_blocksize)
+        
+        # The first block is not complete: XOR it with its keystream, built with ECB
+        if skip and start < end:
+            size = min(self.cipher_blocksize - skip, end - start)
+            keystream = bytearray(self.encrypt(counter_block(nonce, block)))
+            for position in xrange(size):
+                buf[start + position] ^= keystream[skip + position]
+            start += size
+            block += 1
+        
+        # The rest from the start of a block
+        if start < end:
+            self.__factory.stream_into(nonce, block, buf, start, end)
+    
+    def decrypt_into(self, buf, length):
+        '''
+        Decrypt in place the first length bytes of the bytearray, it must have self.slack spare bytes after them
+        '''
+        self.check(length)
+        functions = self.context()
+        if functions[3]:
+            functions[3](buf, length)
+        else:
+            buf[:length] = functions[1](str(buffer(buf, 0, length)))
@@ -0,0 +1,407 @@
+#########################################################################
+#                                                                       #
+# Name:      FileFormat                                                 #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    FileFormat                                                 #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+On-disk format of the encrypted files
+
+Legacy format (version 0): no header, blocks of 32 bytes and one
+trailing byte with the padder of the last block.
+
+Version 1: a header of 32 bytes with the magic, the version, the
+algorithm, the block size and the plaintext length followed by the
+blocks. There is no trailing byte because the header has the length.
+
+In both formats every block holds 'blocksize - 1' plaintext bytes padded
+up to 'blocksize' when the algorithm needs padding (ECB), or 'blocksize'
+plaintext bytes otherwise. The last block is padded to the next multiple
+of the cipher block size.
+
+Version 2 (stream format, CTR algorithms): a header of 32 bytes with the
+magic, the version, the algorithm and the nonce (12 bytes) of the file followed by
+the ciphertext, exactly as long as the plaintext. There are no blocks,
+any offset is ciphered straight.
+
+Version 3 (compressed format): a header of 32 bytes with the magic, the
+version, the codec, the algorithm, the block size and the plaintext
+length, then the index (4 bytes for every block with its size in the
+file) and the blocks. Every block of 'blocksize' plaintext bytes is
+compressed on its own and then padded and encrypted, or kept as it is
+(marked in the index) when compression doesn't make it smaller. The
+index is not encrypted, it only tells the size of every block.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['BlockFormat', 'StreamFormat', 'CompressedFormat', 'spread', 'gather', 'HEADER', 'STREAM_HEADER', 'COMPRESSED_HEADER', 'INDEX_ENTRY', 'MAGIC', 'VERSION', 'STREAM_VERSION', 'STREAM_NONCE', 'COMPRESSED_VERSION', 'LEGACY_BLOCKSIZE', 'MIN_BLOCKSIZE', 'MAX_BLOCKSIZE', 'COMPRESSED_BLOCKSIZE']
+
+import struct
+import bisect
+import array
+
+# NumPy makes block spreading a single reshape, without it bytearray strides are used
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Header: magic, version, algorithm, block size, plaintext length
+HEADER = struct.Struct('>4sB3x12sIQ')
+MAGIC = 'teFS'
+VERSION = 1
+
+# Header of the stream format: magic, version, algorithm, nonce (same size as the other one). The first
+# files had nonces of 8 bytes followed by 4 zeroes, they make the same counters
+STREAM_HEADER = struct.Struct('>4sB3x12s12s')
+STREAM_NONCE = 12
+STREAM_VERSION = 2
+
+# Header of the compressed format: magic, version, codec, algorithm, block size, plaintext length (same size too)
+COMPRESSED_HEADER = struct.Struct('>4sBB2x12sIQ')
+COMPRESSED_VERSION = 3
+
+# Entries of the index of the compressed format: size of the block in the file, the high bit marks stored blocks
+INDEX_ENTRY = struct.Struct('>I')
+STORED = 0x80000000
+
+# Block sizes
+LEGACY_BLOCKSIZE = 32
+MIN_BLOCKSIZE = 4096
+MAX_BLOCKSIZE = 1048576
+COMPRESSED_BLOCKSIZE = 65536
+
+
+class BlockFormat(object):
+    '''
+    Geometry of an encrypted file
+    '''
+    
+    # Contents are split in blocks of the same size
+    stream = False
+    compressed = False
+    
+    def __init__(self, blocksize, padding, algorithm=None, version=0):
+        '''
+        Build the geometry for the given block size and padding
+        '''
+        
+        # Adjust blocksize depending on padding
+        if padding:
+            blocksize = ( blocksize / padding ) * padding
+        
+        # Remember the configuration
+        self.blocksize = blocksize
+        self.padding = padding
+        self.algorithm = algorithm
+        self.version = version
+        
+        # Plaintext bytes inside every block (one byte is always used by padding)
+        if padding:
+            self.plain_blocksize = blocksize - 1
+        else:
+            self.plain_blocksize = blocksize
+        
+        # Size of the header and trailing metadata
+        if version:
+            self.header = HEADER.size
+            self.meta = 0
+        else:
+            self.header = 0
+            self.meta = padding and 1 or 0
+    
+    def lastblock(self, plainsize):
+        '''
+        Index of the last block for a plaintext of the given size
+        '''
+        if self.padding:
+            # The last block always exists, even if it has only padding
+            return plainsize / self.plain_blocksize
+        else:
+            return max(plainsize - 1, 0) / self.plain_blocksize
+    
+    def locate(self, position):
+        '''
+        Block holding the given position of the encrypted blocks (after the header)
+        '''
+        return position / self.blocksize
+    
+    def offset(self, block):
+        '''
+        Position where the block starts in the encrypted blocks (after the header)
+        '''
+        return block * self.blocksize
+    
+    def encrypted_size(self, plainsize):
+        '''
+        Size of the encrypted file for a plaintext of the given size
+        '''
+        if self.padding:
+            (blocks, left) = divmod(plainsize, self.plain_blocksize)
+            size = blocks * self.blocksize + ( left / self.padding + 1 ) * self.padding
+        else:
+            size = plainsize
+        return self.header + size + self.meta
+    
+    def pack(self, plainsize):
+        '''
+        Build the header for a plaintext of the given size
+        '''
+        return HEADER.pack(MAGIC, self.version, self.algorithm, self.blocksize, plainsize)
+    
+    @staticmethod
+    def unpack(string):
+        '''
+        Parse a header, returns (version, algorithm, blocksize, plainsize) or None if it is not a header
+        '''
+        if len(string) < HEADER.size:
+            return None
+        
+        (magic, version, algorithm, blocksize, plainsize) = HEADER.unpack(string[:HEADER.size])
+        if magic != MAGIC or version != VERSION:
+            return None
+        
+        return (version, algorithm.rstrip('\0'), blocksize, plainsize)
+
+
+class StreamFormat(object):
+    '''
+    Layout of a file in the stream format: the header and the ciphertext, there are no blocks
+    '''
+    
+    # Contents are a seekable stream
+    stream = True
+    compressed = False
+    padding = 0
+    meta = 0
+    
+    def __init__(self, algorithm):
+        '''
+        Build the layout for the given algorithm
+        '''
+        self.algorithm = algorithm
+        self.version = STREAM_VERSION
+        self.header = STREAM_HEADER.size
+    
+    def encrypted_size(self, plainsize):
+        '''
+        Size of the encrypted file for a plaintext of the given size
+        '''
+        return self.header + plainsize
+    
+    def plain_size(self, realsize):
+        '''
+        Size of the plaintext of an encrypted file of the given size
+        '''
+        return max(realsize - self.header, 0)
+    
+    def pack(self, nonce):
+        '''
+        Build the header for a file with the given nonce
+        '''
+        return STREAM_HEADER.pack(MAGIC, self.version, self.algorithm, nonce)
+    
+    @staticmethod
+    def unpack(string):
+        '''
+        Parse a header, returns (algorithm, nonce) or None if it is not a header of the stream format
+        '''
+        if len(string) < STREAM_HEADER.size:
+            return None
+        
+        (magic, version, algorithm, nonce) = STREAM_HEADER.unpack(str(string[:STREAM_HEADER.size]))
+        if magic != MAGIC or version != STREAM_VERSION:
+            return None
+        
+        return (algorithm.rstrip('\0'), nonce)
+
+
+class CompressedFormat(object):
+    '''
+    Layout of a file in the compressed format. Without sizes it only describes the filesystem, the layout
+    of a file has the size of every block in the file (see measure() and unpack())
+    '''
+    
+    # Contents are split in blocks of different sizes
+    stream = False
+    compressed = True
+    meta = 0
+    
+    def __init__(self, blocksize, padding, algorithm, codec, sizes=None):
+        '''
+        Build the layout for the given block size, padding, algorithm and codec with the sizes of the blocks in the file
+        '''
+        self.blocksize = blocksize
+        self.plain_blocksize = blocksize
+        self.padding = padding
+        self.algorithm = algorithm
+        self.codec = codec
+        self.version = COMPRESSED_VERSION
+        
+        # Index: sizes of the blocks (with the stored mark) and where every block starts after the index
+        self.sizes = array.array('L', sizes or [])
+        self.offsets = array.array('L', [0])
+        for size in self.sizes:
+            self.offsets.append(self.offsets[-1] + (size & ~STORED))
+        
+        # The header includes the index
+        self.header = COMPRESSED_HEADER.size + len(self.sizes) * INDEX_ENTRY.size
+    
+    def squeeze(self, block):
+        '''
+        Compress a block, returns (content, stored) where stored says if compression didn't help and the block is kept as it was
+        '''
+        content = self.codec.compress(block)
+        if len(content) < len(block):
+            return (content, False)
+        return (block, True)
+    
+    def entry(self, content, stored):
+        '''
+        Entry of the index for a block with the given content once encrypted
+        '''
+        if self.padding:
+            size = ( len(content) / self.padding + 1 ) * self.padding
+        else:
+            size = len(content)
+        if stored:
+            size |= STORED
+        return size
+    
+    def measure(self, blocks):
+        '''
+        Build the layout of a file with the given blocks of plaintext (any iterable)
+        '''
+        sizes = [self.entry(*self.squeeze(block)) for block in blocks]
+        return CompressedFormat(self.blocksize, self.padding, self.algorithm, self.codec, sizes)
+    
+    def lastblock(self, plainsize):
+        '''
+        Index of the last block for a plaintext of the given size
+        '''
+        return max(plainsize - 1, 0) / self.blocksize
+    
+    def locate(self, position):
+        '''
+        Block holding the given position of the encrypted blocks (after the index)
+        '''
+        return max(bisect.bisect_right(self.offsets, position) - 1, 0)
+    
+    def offset(self, block):
+        '''
+        Position where the block starts in the encrypted blocks (after the index)
+        '''
+        return self.offsets[block]
+    
+    def stored(self, block):
+        '''
+        Check if the block was kept without compression
+        '''
+        return bool(self.sizes[block] & STORED)
+    
+    def encrypted_size(self, plainsize):
+        '''
+        Size of the encrypted file (the layout must have the sizes of its blocks)
+        '''
+        return self.header + self.offsets[-1]
+    
+    def pack(self, plainsize):
+        '''
+        Build the header and the index for a plaintext of the given size
+        '''
+        header = COMPRESSED_HEADER.pack(MAGIC, self.version, self.codec.number, self.algorithm, self.blocksize, plainsize)
+        return header + self.entries()
+    
+    def entries(self):
+        '''
+        The index of blocks as it is saved in the files (see index())
+        '''
+        return struct.pack('>%sI' % (len(self.sizes)), *self.sizes)
+    
+    @staticmethod
+    def unpack(string):
+        '''
+        Parse a header, returns (codec number, algorithm, blocksize, plainsize, blocks) or None if it is not a header
+        of the compressed format. The index of blocks entries follows the header
+        '''
+        if len(string) < COMPRESSED_HEADER.size:
+            return None
+        
+        (magic, version, codec, algorithm, blocksize, plainsize) = COMPRESSED_HEADER.unpack(str(string[:COMPRESSED_HEADER.size]))
+        if magic != MAGIC or version != COMPRESSED_VERSION or not blocksize:
+            return None
+        
+        blocks = (plainsize + blocksize - 1) / blocksize
+        return (codec, algorithm.rstrip('\0'), blocksize, plainsize, blocks)
+    
+    @staticmethod
+    def index(string, blocks):
+        '''
+        Parse the index of the given number of blocks
+        '''
+        if len(string) < blocks * INDEX_ENTRY.size:
+            raise IOError,"The index of blocks is cut"
+        return struct.unpack('>%sI' % (blocks), str(string[:blocks * INDEX_ENTRY.size]))
+
+
+def spread(string, count, width, stride, fill, spare=0):
+    '''
+    Split the string in count chunks of width bytes and place each one at the start of
+    a block of stride bytes, the rest of every block is filled with the fill character.
+    The result is a new bytearray with spare bytes more at the end, the string can be
+    any buffer (only its start is used)
+    '''
+    blocks = bytearray(count * stride + spare)
+    if not count:
+        return blocks
+    
+    if numpy:
+        view = numpy.frombuffer(blocks, dtype=numpy.uint8, count=count * stride).reshape(count, stride)
+        view[:, :width] = numpy.frombuffer(string, dtype=numpy.uint8, count=count * width).reshape(count, width)
+        view[:, width:] = ord(fill)
+        return blocks
+    
+    # Copy with strides, using the shortest loop
+    if width < count:
+        for position in xrange(width):
+            blocks[position:count * stride:stride] = string[position:count * width:width]
+        for position in xrange(width, stride):
+            blocks[position:count * stride:stride] = fill * count
+    else:
+        for block in xrange(count):
+            blocks[block * stride:block * stride + width] = string[block * width:(block + 1) * width]
+            blocks[block * stride + width:(block + 1) * stride] = fill * (stride - width)
+    return blocks
+
+
+def gather(string, count, width, stride):
+    '''
+    Reverse of spread(): join the first width bytes of count blocks of stride bytes in a new bytearray
+    '''
+    chunks = bytearray(count * width)
+    if not count:
+        return chunks
+    
+    if numpy:
+        blocks = numpy.frombuffer(string, dtype=numpy.uint8, count=count * stride).reshape(count, stride)
+        numpy.frombuffer(chunks, dtype=numpy.uint8).reshape(count, width)[:] = blocks[:, :width]
+        return chunks
+    
+    # Copy with strides, using the shortest loop
+    if width < count:
+        for position in xrange(width):
+            chunks[position::width] = string[position:count * stride:stride]
+    else:
+        for block in xrange(count):
+            chunks[block * width:(block + 1) * width] = string[block * stride:block * stride + width]
+    return chunks
@@ -35,21 +35,26 @@ except:
 # Import the rest of libraries
 import os
 import sys
+import signal
+import multiprocessing
 import fuse
 from tefs import teFS
+from debugger import LEVELS
+from asyncserver import AsyncServer
+from multitree import teFSmulti, load_trees
+from options import getargv, getargvalue, getpatterns, checkblocksize, checkbackend, checkcompression
 
-def getargv(name):
-    if name in sys.argv:
-        sys.argv.pop(sys.argv.index(name))
-        return True
-    else:
-        return False
-    
 def main(key):
     usage  = ""
     usage += "Usage: %s PATH MOUNTPOINT [options] {encrypt|decrypt}\n" % (sys.argv[0])
+    usage += "       %s --trees=FILE MOUNTPOINT [options]\n" % (sys.argv[0])
     usage += "Options:\n"
     
+    # TREES: several source trees served from one daemon, every one as a directory at the root of the mount
+    # point. The file has one tree per line: NAME ACTION KEY PATH (KEY '-' uses the key of main.py, 'none'
+    # means no encryption). Caches are shared by all the trees, their sizes are for all of them together
+    usage += "    --trees=FILE  Serve the trees listed in the file (one per line: NAME ACTION KEY PATH)\n"
+    
     # ALLOWALL: allow to read /dev /proc /sys and the directory where teFS is mounted on
     # Allows recursive encryption but it can not be used with a recursive command or will
     # stack in a infinite loop
@@ -59,13 +64,94 @@ def main(key):
     # and nothing to the screen
     usage += "    --log         Everything is sent to files nothing to the screen\n"
     
-    if len(sys.argv) >= 4:
+    # LOGLEVEL: messages below this level are dropped before being built (debug, warning or error)
+    usage += "    --loglevel=LEVEL  Lowest level written: debug, warning or error (default: debug)\n"
+    
+    # INCLUDE/EXCLUDE: glob patterns (they can be given many times), patterns without a slash are matched
+    # against every name in the path, patterns with a slash against the path from the root of the tree. When
+    # some include is given only the regular files matching it are shown
+    usage += "    --include=GLOB  Show only the files matching the pattern (every directory is shown)\n"
+    usage += "    --exclude=GLOB  Hide the files and directories matching the pattern\n"
+    usage += "    --excludefrom=FILE  Read exclude patterns from the file, one per line\n"
+    
+    # BACKEND: cipher backend, by default the fastest one available is chosen at mount time
+    usage += "    --backend=NAME  Cipher backend: auto, openssl or pycrypto (default: auto)\n"
+    
+    # BLOCKSIZE: encrypt using the versioned format with the given block size, without it the
+    # legacy format (blocks of 32 bytes) is used so old mirrors stay the same. Decrypting, every
+    # file brings its own block size in its header
+    usage += "    --blocksize=N   Block size in bytes from 4096 to 1048576 (default: legacy 32 bytes)\n"
+    
+    # COMPRESS: compress every block before encrypting it, the files keep an index of their blocks so any
+    # offset can still be read (blocks of 64KB unless --blocksize is given). Decrypting, every file says
+    # how it was compressed
+    usage += "    --compress=CODEC  Compress the blocks with zlib, lz4 or zstd before encrypting them\n"
+    
+    # PATHCACHE: number of name and path translations kept in memory (0 disables the cache)
+    usage += "    --pathcache=N   Path translations to keep in memory (default: 65536)\n"
+    
+    # ATTRCACHE/ATTRTTL: attributes of files kept in memory and seconds before checking them again
+    usage += "    --attrcache=N   File attributes to keep in memory (default: 65536)\n"
+    usage += "    --attrttl=SECS  Seconds before checking cached attributes again (default: 1.0)\n"
+    
+    # ENTRYTIMEOUT/ATTRTIMEOUT/NEGATIVETIMEOUT: seconds the kernel keeps names, attributes and missing names
+    # without asking teFS again (files are opened keeping the pages the kernel cached while they don't change)
+    usage += "    --entrytimeout=SECS  Seconds the kernel keeps names (default: 1.0)\n"
+    usage += "    --attrtimeout=SECS   Seconds the kernel keeps attributes (default: 1.0)\n"
+    usage += "    --negativetimeout=SECS  Seconds the kernel remembers missing names (default: 0)\n"
+    
+    # MAXREAD: biggest read sent by the kernel, fuse-python speaks a protocol limited to 128KB, --async up to 1MB
+    usage += "    --maxread=KB    Biggest read the kernel sends in kilobytes (default: 128)\n"
+    
+    # DIRCACHE: memory used to keep transformed directory listings (0 disables the cache)
+    usage += "    --dircache=MB   Megabytes of directory listings to keep in memory (default: 32)\n"
+    
+    # METACACHE: with --trees, memory used by the names, paths and attributes of all the trees together,
+    # those caches are bounded by their number of entries and by this budget (0 disables them)
+    usage += "    --metacache=MB  With --trees, megabytes of names, paths and attributes to keep in memory (default: 32)\n"
+    
+    # INDEX: SQLite file remembering the translated names between mounts (outside the served tree)
+    usage += "    --index=FILE    Keep the translated names in this file, remounts skip the unchanged directories\n"
+    
+    # BLOCKCACHE: memory used to keep encrypted/decrypted blocks (0 disables the cache)
+    usage += "    --blockcache=MB Megabytes of transformed blocks to keep in memory (default: 64)\n"
+    
+    # READAHEAD: while a file is read sequentially the next chunks (64KB) are encrypted/decrypted
+    # in background, the window grows up to N chunks (0 disables it, it needs the block cache)
+    usage += "    --readahead=N   Maximum chunks of 64KB to prepare ahead of sequential reads (default: 16)\n"
+    
+    # WORKERS: FUSE serves every request in its own thread, this limits how many reads are
+    # encrypted/decrypted at the same time (caches, cipher contexts and logs are thread-safe)
+    usage += "    --workers=N     Reads processed at the same time (default: number of CPUs)\n"
+    
+    # CRYPTOTHREADS: reads of 256KB or more are split in groups of blocks ciphered by this number of threads
+    # at the same time (the cipher backends release the GIL), so one big file uses several cores
+    usage += "    --cryptothreads=N  Threads ciphering one big read (default: number of CPUs, 1 disables it)\n"
+    usage += "    -s              Single-threaded mode, serve one request at a time\n"
+    
+    # ASYNC: instead of fuse-python, one thread reads the requests from the kernel and N threads answer
+    # them in any order, so many requests can be in flight without a thread for each one (needs root)
+    usage += "    --async=N       Serve with the event-driven server and N threads (default: fuse-python)\n"
+    
+    trees = getargvalue('--trees')
+    if len(sys.argv) >= 4 or (trees and len(sys.argv) >= 2):
         
         # Get basic configuration from the command line
         try:
-            datapath = sys.argv.pop(1)
-            mountpoint = os.path.abspath(sys.argv[1])
-            action = sys.argv.pop(-1)
+            if trees:
+                trees = load_trees(trees, key)
+                datapath = None
+                mountpoint = os.path.abspath(sys.argv[1])
+                action = 'trees'
+            else:
+                datapath = sys.argv.pop(1)
+                mountpoint = os.path.abspath(sys.argv[1])
+                action = sys.argv.pop(-1)
+        except IOError, e:
+            print "Warning: %s" % (e)
+            print
+            print usage
+            sys.exit()
         except:
             print "Warning: missing arguments"
             print
@@ -73,7 +159,7 @@ def main(key):
             sys.exit()
         
         # Check action
-        if action != 'encrypt' and action != 'decrypt':
+        if action != 'encrypt' and action != 'decrypt' and not trees:
             print "Warning: action can be only encrypt or decrypt, you used '%s'" % (action)
             print
             print usage
@@ -82,30 +168,118 @@ def main(key):
         # Process options
         allowall = getargv('--allowall')
         log = getargv('--log')
+        loglevel = getargvalue('--loglevel', 'debug')
+        backend = getargvalue('--backend', 'auto')
+        blocksize = getargvalue('--blocksize')
+        compression = getargvalue('--compress')
+        pathcache = getargvalue('--pathcache', '65536')
+        attrcache = getargvalue('--attrcache', '65536')
+        attrttl = getargvalue('--attrttl', '1.0')
+        workers = getargvalue('--workers', str(multiprocessing.cpu_count()))
+        cryptothreads = getargvalue('--cryptothreads', str(multiprocessing.cpu_count()))
+        blockcache = getargvalue('--blockcache', '64')
+        dircache = getargvalue('--dircache', '32')
+        metacache = getargvalue('--metacache', '32')
+        readahead = getargvalue('--readahead', '16')
+        index = getargvalue('--index')
+        threads = getargvalue('--async')
+        entrytimeout = getargvalue('--entrytimeout')
+        attrtimeout = getargvalue('--attrtimeout')
+        negativetimeout = getargvalue('--negativetimeout')
+        maxread = getargvalue('--maxread')
+        try:
+            (include, exclude) = getpatterns()
+        except IOError, e:
+            print "Warning: %s" % (e)
+            print
+            print usage
+            sys.exit()
+        try:
+            if blocksize is not None:
+                blocksize = int(blocksize)
+            pathcache = int(pathcache)
+            attrcache = int(attrcache)
+            attrttl = float(attrttl)
+            workers = int(workers)
+            cryptothreads = int(cryptothreads)
+            blockcache = int(float(blockcache) * 1024 * 1024)
+            dircache = int(float(dircache) * 1024 * 1024)
+            metacache = int(float(metacache) * 1024 * 1024)
+            readahead = int(readahead)
+            if threads is not None:
+                threads = int(threads)
+            
+            # Kernel options, the ones not given keep the defaults of the server
+            kernel = {}
+            if entrytimeout is not None:
+                kernel['entry_timeout'] = float(entrytimeout)
+            if attrtimeout is not None:
+                kernel['attr_timeout'] = float(attrtimeout)
+            if negativetimeout is not None:
+                kernel['negative_timeout'] = float(negativetimeout)
+            if maxread is not None:
+                kernel['max_read'] = int(float(maxread) * 1024)
+        except ValueError:
+            print "Warning: --blocksize, --pathcache, --attrcache, --attrttl, --workers, --cryptothreads, --blockcache, --dircache, --metacache, --readahead, --async, --entrytimeout, --attrtimeout, --negativetimeout and --maxread must be numbers"
+            print
+            print usage
+            sys.exit()
+        
+        # Values teFS can't use would leave it half built
+        error = checkblocksize(blocksize) or checkbackend(backend) or checkcompression(compression)
+        if error:
+            print "Warning: %s" % (error)
+            print
+            print usage
+            sys.exit()
         
+        if loglevel not in LEVELS:
+            print "Warning: --loglevel can be only debug, warning or error, you used '%s'" % (loglevel)
+            print
+            print usage
+            sys.exit()
         
         # Configure debugger
         debugger = {}
-        debugger['screen'] = (sys.stdout, ['*'] )
+        debugger['screen'] = (sys.stdout, ['*'], LEVELS[loglevel] )
         if action=='encrypt':
-            debugger['log'] = (open("log/tefs_encrypt.log","a"), ['*'] )
+            debugger['log'] = (open("log/tefs_encrypt.log","a"), ['*'], LEVELS[loglevel] )
+        elif action=='decrypt':
+            debugger['log'] = (open("log/tefs_decrypt.log","a"), ['*'], LEVELS[loglevel] )
         else:
-            debugger['log'] = (open("log/tefs_decrypt.log","a"), ['*'] )
+            debugger['log'] = (open("log/tefs_trees.log","a"), ['*'], LEVELS[loglevel] )
         
         if log:
             if action == 'encrypt':
                 fich = open ("log/tefs_encrypt.out", "a")
-            else:
+            elif action == 'decrypt':
                 fich = open ("log/tefs_decrypt.out", "a")
+            else:
+                fich = open ("log/tefs_trees.out", "a")
             
             sys.stdout = fich
             sys.stderr = fich
             debugger.pop('screen')
         
         # Build teFS and make it to work
-        server = teFS(key, datapath, action, mountpoint, allowall, debugger = debugger, version="%prog " + fuse.__version__, usage = usage, dash_s_do = 'setsingle')
+        if trees:
+            server = teFSmulti(trees, mountpoint, allowall, debugger = debugger, backend = backend, blocksize = blocksize, compression = compression, pathcache = pathcache, attrcache = attrcache, attrttl = attrttl, workers = workers, cryptothreads = cryptothreads, blockcache = blockcache, dircache = dircache, metacache = metacache, readahead = readahead, index = index, include = include, exclude = exclude, version="%prog " + fuse.__version__, usage = usage, dash_s_do = 'setsingle')
+        else:
+            server = teFS(key, datapath, action, mountpoint, allowall, debugger = debugger, backend = backend, blocksize = blocksize, compression = compression, pathcache = pathcache, attrcache = attrcache, attrttl = attrttl, workers = workers, cryptothreads = cryptothreads, blockcache = blockcache, dircache = dircache, readahead = readahead, index = index, include = include, exclude = exclude, version="%prog " + fuse.__version__, usage = usage, dash_s_do = 'setsingle')
+        server.multithreaded = True
         server.parse(values = server, errex = 1)
-        server.main()
+        
+        # kill -USR1 writes the statistics to the log
+        server.dump_on_signal(signal.SIGUSR1)
+        if threads:
+            # The same teFS served by our own loop (it takes -f and the mount options from the command line)
+            options = server.fuse_args.optlist
+            AsyncServer(server, mountpoint, threads, options, **kernel).serve(server.fuse_args.getmod('foreground'))
+        else:
+            # fuse-python takes the kernel options as mount options
+            for option in kernel:
+                server.fuse_args.add(option, str(kernel[option]))
+            server.main()
     else:
         print usage
 
@@ -0,0 +1,174 @@
+#########################################################################
+#                                                                       #
+# Name:      Metrics                                                    #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Metrics                                                    #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Live performance metrics of teFS: calls, errors, bytes and latency of every operation
+
+Latencies are kept in a histogram of powers of two microseconds, so
+recording a call costs a few additions whatever the number of calls.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['Metrics', 'measured', 'StatsDumper']
+
+import os
+import time
+import fcntl
+import signal
+import threading
+import functools
+
+# Buckets of the latency histograms: bucket N counts the calls under 2**N microseconds (the last one counts the rest)
+BUCKETS = 32
+
+
+class Operation(object):
+    '''
+    Counters of one operation
+    '''
+    
+    __slots__ = ('calls', 'errors', 'bytes', 'seconds', 'slowest', 'buckets')
+    
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.buckets = [0] * BUCKETS
+    
+    def percentile(self, fraction):
+        '''
+        Upper bound in seconds of the latency of the given fraction of the calls
+        '''
+        wanted = self.calls * fraction
+        count = 0
+        for (bucket, calls) in enumerate(self.buckets):
+            count += calls
+            if count >= wanted and calls:
+                return min(2 ** bucket / 1000000.0, self.slowest)
+        return self.slowest
+    
+    def stats(self):
+        '''
+        Return a dictionary with the statistics of the operation
+        '''
+        if self.calls:
+            average = self.seconds / self.calls
+        else:
+            average = 0.0
+        
+        # Histogram as (upper bound in microseconds, calls) leaving out the empty buckets
+        histogram = [[2 ** bucket, calls] for (bucket, calls) in enumerate(self.buckets) if calls]
+        return {'calls': self.calls, 'errors': self.errors, 'bytes': self.bytes, 'seconds': self.seconds, 'average': average, 'slowest': self.slowest, 'p50': self.percentile(0.5), 'p99': self.percentile(0.99), 'histogram': histogram}
+
+
+class Metrics(object):
+    '''
+    Operations measured by teFS, safe to use from many threads
+    '''
+    
+    def __init__(self):
+        self.started = time.time()
+        self.__operations = {}
+        self.__lock = threading.Lock()
+    
+    def record(self, name, elapsed, size=0, error=False):
+        '''
+        Count one call of the operation which took elapsed seconds and processed size bytes
+        '''
+        bucket = min(int(elapsed * 1000000).bit_length(), BUCKETS - 1)
+        with self.__lock:
+            operation = self.__operations.get(name)
+            if operation is None:
+                operation = self.__operations[name] = Operation()
+            operation.calls += 1
+            operation.bytes += size
+            operation.seconds += elapsed
+            operation.buckets[bucket] += 1
+            if elapsed > operation.slowest:
+                operation.slowest = elapsed
+            if error:
+                operation.errors += 1
+    
+    def stats(self):
+        '''
+        Return a dictionary with the statistics of every operation
+        '''
+        with self.__lock:
+            return dict([(name, operation.stats()) for (name, operation) in self.__operations.iteritems()])
+
+
+def measured(name, size=None):
+    '''
+    Decorator for the methods of an object with a 'metrics' attribute: every call is recorded under the
+    name, size tells the bytes of the answer (by default none). Exceptions and negative answers (-errno)
+    are counted as errors
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kargs):
+            start = time.time()
+            answer = None
+            error = True
+            try:
+                answer = method(self, *args, **kargs)
+                error = isinstance(answer, int) and answer < 0
+                return answer
+            finally:
+                if size and not error:
+                    self.metrics.record(name, time.time() - start, size(answer), False)
+                else:
+                    self.metrics.record(name, time.time() - start, 0, error)
+        return wrapper
+    return decorator
+
+
+class StatsDumper(object):
+    '''
+    Mixin writing the statistics (stats()) to the log (warning()) every time a signal arrives
+    '''
+    
+    # Pipe where the signals arrive (see dump_on_signal())
+    __signals = None
+    
+    def dump_on_signal(self, signum):
+        '''
+        Write the statistics to the log when the signal arrives (must be called from the main thread, before main()).
+        FUSE keeps the main thread busy, so the signal only writes a byte to a pipe and a thread waits for it
+        '''
+        (reader, writer) = os.pipe()
+        flags = fcntl.fcntl(writer, fcntl.F_GETFL)
+        fcntl.fcntl(writer, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.signal(signum, lambda number, frame: None)
+        signal.set_wakeup_fd(writer)
+        self.__signals = reader
+    
+    def watch_signals(self):
+        '''
+        Start the thread waiting for the signals, if dump_on_signal() was called (from fsinit())
+        '''
+        if self.__signals is not None:
+            watcher = threading.Thread(target=self.__dump, name="teFS-signals")
+            watcher.daemon = True
+            watcher.start()
+    
+    def __dump(self):
+        '''
+        Dump the statistics every time a signal arrives
+        '''
+        while os.read(self.__signals, 64):
+            self.warning("Statistics: %s", self.stats())
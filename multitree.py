@@ -0,0 +1,255 @@
+#########################################################################
+#                                                                       #
+# Name:      MultiTree                                                  #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    MultiTree                                                  #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Several source trees served from one teFS daemon
+
+Every tree is a teFS with its own key, algorithm and action, shown as a
+directory at the root of the mount. The trees share the caches (one
+memory budget for all of them, the keys of every tree are kept apart),
+the readahead threads, the pool ciphering big reads and the limit of
+reads processed at the same time.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['teFSmulti', 'load_trees']
+
+import os
+import time
+import json
+import stat
+import errno
+import threading
+import fuse
+from fuse import Fuse
+from tefs import teFS, teFSlisting, teFSreport, READAHEAD_THREADS, STATS_PATH
+from cache import LRUCache, CacheView
+from readahead import Prefetcher
+from parallel import WorkerPool
+from debugger import Debugger
+from metrics import StatsDumper
+
+
+def weigh(value):
+    '''
+    Rough memory used by an entry of the caches of names, paths, attributes and versions: names and paths
+    are kept with a key about as long as them, attributes and versions are small objects keyed by a path
+    '''
+    if isinstance(value, basestring):
+        return 2 * len(value) + 96
+    return 512
+
+
+def load_trees(path, key):
+    '''
+    Read the trees from the file, one per line: NAME ACTION KEY PATH (KEY '-' is the given key, 'none' means
+    no encryption at all). Returns a list of (name, key, datapath, action)
+    '''
+    trees = []
+    names = set()
+    for line in open(path):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        
+        # The path goes last, it may have spaces
+        fields = line.split(None, 3)
+        if len(fields) != 4:
+            raise IOError,"Wrong line in '%s', it should be NAME ACTION KEY PATH: %s" % (path, line)
+        (name, action, treekey, datapath) = fields
+        if '/' in name or name in ('.', '..') or name in names:
+            raise IOError,"Tree name '%s' is not valid or it is repeated" % (name)
+        if action != 'encrypt' and action != 'decrypt':
+            raise IOError,"Action of tree '%s' can be only encrypt or decrypt, you gave me '%s'" % (name, action)
+        if treekey == '-':
+            treekey = key
+        elif treekey == 'none':
+            treekey = None
+        names.add(name)
+        trees.append((name, treekey, datapath, action))
+    
+    if not trees:
+        raise IOError,"There are no trees in '%s'" % (path)
+    return trees
+
+
+class teFSmulti(Fuse, Debugger, StatsDumper):
+    '''
+    teFS serving several trees, every one at a directory of the root
+    '''
+    
+    def __init__(self, trees, mountpoint, allowall=False, debugger={}, backend='auto', blocksize=None, pathcache=65536, attrcache=65536, attrttl=1.0, workers=None, blockcache=64*1024*1024, readahead=16, include=None, exclude=None, dircache=32*1024*1024, metacache=32*1024*1024, index=None, cryptothreads=None, compression=None, *args, **kargs):
+        '''
+        Build a teFS for every tree, a list of (name, key, datapath, action). Sizes and budgets of the caches
+        are for all the trees together, index is the prefix of the index of names of every tree. Names, paths,
+        attributes and versions of opened files share one cache of up to metacache bytes
+        '''
+        # Set debugger
+        self.set_debug(debugger)
+        self.started = time.time()
+        
+        # Caches of all the trees: names, paths, attributes and versions are charged to one budget (their
+        # entries are kept apart by kind), listings and blocks have their own ones
+        meta = LRUCache(2 * pathcache + 2 * attrcache, metacache, weigh)
+        caches = {}
+        caches['names'] = meta
+        caches['paths'] = meta
+        caches['dirs'] = LRUCache(pathcache, dircache, teFSlisting.weigh)
+        caches['attrs'] = meta
+        caches['opened'] = meta
+        caches['blocks'] = LRUCache(None, blockcache)
+        
+        # Threads of all the trees
+        shared = {'prefetcher': None, 'pool': None, 'workers': None}
+        if readahead and blockcache:
+            shared['prefetcher'] = Prefetcher(READAHEAD_THREADS, error=self.error)
+        if cryptothreads and cryptothreads > 1:
+            shared['pool'] = WorkerPool(cryptothreads - 1)
+        if workers:
+            shared['workers'] = threading.BoundedSemaphore(workers)
+        
+        # Build the trees, the mount point is protected in every one of them
+        self.__names = []
+        self.__trees = {}
+        for (name, key, datapath, action) in trees:
+            for cache in caches:
+                shared[cache] = CacheView(caches[cache], (name, cache))
+            if index:
+                treeindex = "%s.%s" % (index, name)
+            else:
+                treeindex = None
+            self.__trees[name] = teFS(key, datapath, action, mountpoint, allowall, debugger=debugger, backend=backend, blocksize=blocksize, compression=compression, pathcache=pathcache, attrcache=attrcache, attrttl=attrttl, workers=workers, blockcache=blockcache, readahead=readahead, include=include, exclude=exclude, dircache=dircache, index=treeindex, cryptothreads=cryptothreads, shared=dict(shared))
+            self.__names.append(name)
+        self.debug("teFS serving %s trees at %s: %s\n" % (len(self.__names), mountpoint, ", ".join(self.__names)), color='blue')
+        
+        # Call parent fo finish the work
+        return super(teFSmulti,self).__init__(*args, **kargs)
+    
+    def locate(self, vpath):
+        '''
+        Find out the tree of the virtual path, returns (teFS, path inside the tree). The teFS is None for the root and unknown trees
+        '''
+        parts = vpath.split("/", 2)
+        tree = self.__trees.get(parts[1])
+        if len(parts) == 3:
+            return (tree, "/%s" % (parts[2]))
+        return (tree, "/")
+    
+    def root(self):
+        '''
+        Attributes of the root: a read-only directory with a directory for every tree
+        '''
+        st = fuse.Stat()
+        st.st_mode = stat.S_IFDIR | 0555
+        st.st_ino = 0
+        st.st_dev = 0
+        st.st_nlink = 2 + len(self.__names)
+        st.st_uid = os.getuid()
+        st.st_gid = os.getgid()
+        st.st_size = 0
+        st.st_atime = self.started
+        st.st_mtime = self.started
+        st.st_ctime = self.started
+        return st
+    
+    def fsinit(self):
+        '''
+        Called by FUSE once the filesystem is mounted (and in background)
+        '''
+        for name in self.__names:
+            self.__trees[name].fsinit()
+        self.watch_signals()
+    
+    def fsdestroy(self):
+        '''
+        Called by FUSE when the filesystem is unmounted
+        '''
+        for name in self.__names:
+            self.__trees[name].fsdestroy()
+    
+    def stats(self):
+        '''
+        Return the statistics of the operations of every tree and of the shared caches as JSON (served at the
+        root as the statistics file, with a section for every tree)
+        '''
+        trees = dict([(name, self.__trees[name].metrics.stats()) for name in self.__names])
+        return json.dumps({'uptime': time.time() - self.started, 'trees': trees, 'caches': self.__trees[self.__names[0]].cache_stats()}, sort_keys=True) + "\n"
+    
+    def getattr(self, vpath):
+        if vpath == "/":
+            return self.root()
+        
+        # The statistics file of the daemon
+        if vpath == STATS_PATH:
+            return teFSreport(self.stats()).st
+        (tree, path) = self.locate(vpath)
+        if tree is None:
+            return -errno.ENOENT
+        return tree.getattr(path)
+    
+    def readdir(self, vpath, offset):
+        '''
+        The root lists the trees, the rest of directories are listed by their tree
+        '''
+        if vpath != "/":
+            (tree, path) = self.locate(vpath)
+            if tree is not None:
+                for entry in tree.readdir(path, offset):
+                    yield entry
+            return
+        
+        for (position, name) in enumerate(['.', '..'] + self.__names):
+            if position + 1 > offset:
+                yield fuse.Direntry(name, offset=position + 1, type=stat.S_IFDIR >> 12)
+    
+    def open(self, vpath, flags):
+        if vpath == STATS_PATH:
+            if (flags & 3) != os.O_RDONLY:
+                return -errno.EACCES
+            return teFSreport(self.stats())
+        (tree, path) = self.locate(vpath)
+        if tree is None:
+            return -errno.ENOENT
+        return tree.open(path, flags)
+    
+    def release(self, vpath, flags, fh=None):
+        if isinstance(fh, teFSreport):
+            return 0
+        (tree, path) = self.locate(vpath)
+        return tree.release(path, flags, fh)
+    
+    def fgetattr(self, vpath, fh=None):
+        if vpath == "/":
+            return self.root()
+        if isinstance(fh, teFSreport):
+            return fh.st
+        (tree, path) = self.locate(vpath)
+        if tree is None:
+            return -errno.ENOENT
+        return tree.fgetattr(path, fh)
+    
+    def read(self, vpath, length, offset, fh=None):
+        
+        # The statistics file of the daemon
+        if isinstance(fh, teFSreport):
+            return fh.data[offset:offset + length]
+        if fh is None and vpath == STATS_PATH:
+            return self.stats()[offset:offset + length]
+        
+        (tree, path) = self.locate(vpath)
+        if tree is None:
+            return -errno.ENOENT
+        return tree.read(path, length, offset, fh)
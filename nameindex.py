@@ -0,0 +1,182 @@
+#########################################################################
+#                                                                       #
+# Name:      NameIndex                                                  #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    NameIndex                                                  #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Persistent index of translated names, kept in a SQLite database
+
+Every directory listed is saved with its modification time and inode
+and the real and virtual name of its entries, so after a remount the
+listings of the directories which didn't change are not translated
+again. The layouts of compressed files are kept too, so files which
+didn't change are not compressed again only to know their size. The
+database is opened with the first lookup (after FUSE went to
+background) and it is only a cache: it is emptied when it was built
+with other settings and losing it costs only time.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['NameIndex']
+
+import os
+import threading
+
+# SQLite comes with Python 2.5 and later, but it may be left out
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Version of the tables
+INDEX_VERSION = '2'
+
+# Tables of the index
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS directories (id INTEGER PRIMARY KEY, path BLOB UNIQUE, mtime REAL, ino INTEGER)",
+    "CREATE TABLE IF NOT EXISTS names (directory INTEGER, position INTEGER, real BLOB, virtual BLOB, kind INTEGER)",
+    "CREATE INDEX IF NOT EXISTS names_position ON names (directory, position)",
+    "CREATE INDEX IF NOT EXISTS names_virtual ON names (directory, virtual)",
+    "CREATE TABLE IF NOT EXISTS layouts (path BLOB PRIMARY KEY, ino INTEGER, mtime REAL, size INTEGER, sizes BLOB)",
+]
+
+# Types of the entries: (is directory) -> kind and back
+KINDS = {None: None, True: 1, False: 0}
+ISDIR = {None: None, 1: True, 0: False}
+
+
+class NameIndex(object):
+    '''
+    Index of the names of every directory listed, safe to use from many threads
+    '''
+    
+    def __init__(self, path, settings):
+        '''
+        Prepare the index saved at path, settings is a dictionary which must be the same used when it was built
+        '''
+        if not sqlite3:
+            raise IOError,"SQLite (sqlite3) is not available in this system"
+        self.path = path
+        self.settings = dict([(str(name), str(value)) for (name, value) in settings.iteritems()])
+        self.settings['version'] = INDEX_VERSION
+        self.__lock = threading.Lock()
+        self.__db = None
+        self.__pid = None
+    
+    def connect(self):
+        '''
+        Open the database of this process (connections don't survive a fork), the lock must be held
+        '''
+        if self.__pid == os.getpid():
+            return self.__db
+        
+        # Open it, it is only a cache: no need to wait for the disk on every change
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.text_factory = str
+        db.execute("PRAGMA synchronous=OFF")
+        for statement in SCHEMA:
+            db.execute(statement)
+        
+        # Built with other settings, start again
+        if dict(db.execute("SELECT name, value FROM settings").fetchall()) != self.settings:
+            db.execute("DELETE FROM names")
+            db.execute("DELETE FROM directories")
+            db.execute("DELETE FROM layouts")
+            db.execute("DELETE FROM settings")
+            db.executemany("INSERT INTO settings (name, value) VALUES (?, ?)", self.settings.items())
+        db.commit()
+        
+        self.__db = db
+        self.__pid = os.getpid()
+        return db
+    
+    def listing(self, realpath, key):
+        '''
+        Get the entries of the directory as a list of (real name, is directory, virtual name),
+        None if it is not in the index or it changed (key is (modification time, inode))
+        '''
+        with self.__lock:
+            db = self.connect()
+            row = db.execute("SELECT id, mtime, ino FROM directories WHERE path = ?", (realpath,)).fetchone()
+            if row is None or (row[1], row[2]) != key:
+                return None
+            rows = db.execute("SELECT real, kind, virtual FROM names WHERE directory = ? ORDER BY position", (row[0],)).fetchall()
+        return [(real, ISDIR[kind], virtual) for (real, kind, virtual) in rows]
+    
+    def realname(self, realpath, vname):
+        '''
+        Get the real name of the virtual name inside the directory, None if it is not in the index
+        '''
+        with self.__lock:
+            db = self.connect()
+            row = db.execute("SELECT names.real FROM directories, names WHERE directories.path = ? AND names.directory = directories.id AND names.virtual = ?", (realpath, vname)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+    
+    def save(self, realpath, key, entries):
+        '''
+        Remember the entries, list of (real name, is directory, virtual name), of the directory
+        '''
+        with self.__lock:
+            db = self.connect()
+            try:
+                row = db.execute("SELECT id FROM directories WHERE path = ?", (realpath,)).fetchone()
+                if row is None:
+                    directory = db.execute("INSERT INTO directories (path, mtime, ino) VALUES (?, ?, ?)", (realpath, key[0], key[1])).lastrowid
+                else:
+                    directory = row[0]
+                    db.execute("UPDATE directories SET mtime = ?, ino = ? WHERE id = ?", (key[0], key[1], directory))
+                    db.execute("DELETE FROM names WHERE directory = ?", (directory,))
+                db.executemany("INSERT INTO names (directory, position, real, virtual, kind) VALUES (?, ?, ?, ?, ?)", [(directory, position, real, virtual, KINDS[isdir]) for (position, (real, isdir, virtual)) in enumerate(entries)])
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+    
+    def layout(self, realpath, key):
+        '''
+        Get the index of blocks saved for the compressed file, None if it is not in the index or the file
+        changed (key is (inode, modification time, size))
+        '''
+        with self.__lock:
+            db = self.connect()
+            row = db.execute("SELECT ino, mtime, size, sizes FROM layouts WHERE path = ?", (realpath,)).fetchone()
+        if row is None or tuple(row[:3]) != tuple(key):
+            return None
+        return row[3]
+    
+    def save_layout(self, realpath, key, sizes):
+        '''
+        Remember the index of blocks of the compressed file (key is (inode, modification time, size))
+        '''
+        with self.__lock:
+            db = self.connect()
+            try:
+                db.execute("INSERT OR REPLACE INTO layouts (path, ino, mtime, size, sizes) VALUES (?, ?, ?, ?, ?)", (realpath, key[0], key[1], key[2], sqlite3.Binary(sizes)))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+    
+    def close(self):
+        '''
+        Close the database of this process
+        '''
+        with self.__lock:
+            if self.__pid == os.getpid():
+                self.__db.close()
+            self.__db = None
+            self.__pid = None
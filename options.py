@@ -0,0 +1,90 @@
+#########################################################################
+#                                                                       #
+# Name:      Options                                                    #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Options                                                    #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Command line helpers shared by the teFS commands
+
+They live apart from main.py so the other commands can use them without
+importing the mount command (and its psyco warning on stdout).
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['getargv', 'getargvalue', 'getargvalues', 'getpatterns', 'checkblocksize', 'checkbackend', 'checkcompression']
+
+import sys
+from fileformat import MIN_BLOCKSIZE, MAX_BLOCKSIZE
+from engine import BACKENDS, available_backends
+from compression import CODECS, available_codecs
+
+def getargv(name):
+    if name in sys.argv:
+        sys.argv.pop(sys.argv.index(name))
+        return True
+    else:
+        return False
+    
+def getargvalue(name, default=None):
+    prefix = "%s=" % (name)
+    for arg in sys.argv:
+        if arg.startswith(prefix):
+            sys.argv.pop(sys.argv.index(arg))
+            return arg[len(prefix):]
+    return default
+    
+def getargvalues(name):
+    prefix = "%s=" % (name)
+    values = [arg[len(prefix):] for arg in sys.argv if arg.startswith(prefix)]
+    sys.argv[:] = [arg for arg in sys.argv if not arg.startswith(prefix)]
+    return values
+    
+def getpatterns():
+    include = getargvalues('--include')
+    exclude = getargvalues('--exclude')
+    for filename in getargvalues('--excludefrom'):
+        for line in open(filename):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                exclude.append(line)
+    return (include, exclude)
+    
+def checkblocksize(blocksize):
+    '''
+    Return the warning for a block size teFS can't use, None if it is fine (or not given)
+    '''
+    if blocksize is not None and (blocksize < MIN_BLOCKSIZE or blocksize > MAX_BLOCKSIZE):
+        return "--blocksize must be between %s and %s, you used %s" % (MIN_BLOCKSIZE, MAX_BLOCKSIZE, blocksize)
+    return None
+    
+def checkbackend(backend):
+    '''
+    Return the warning for a cipher backend which doesn't exist or isn't installed, None if it is fine
+    '''
+    if backend == 'auto' or backend in available_backends():
+        return None
+    if backend in BACKENDS:
+        return "backend '%s' is not available in this system, use auto or one of: %s" % (backend, ", ".join(available_backends()))
+    return "--backend can be only auto, %s or %s, you used '%s'" % (", ".join(BACKENDS[:-1]), BACKENDS[-1], backend)
+    
+def checkcompression(compression):
+    '''
+    Return the warning for a codec which doesn't exist or isn't installed, None if it is fine (or not given)
+    '''
+    if compression is None or compression in available_codecs():
+        return None
+    if compression in CODECS:
+        return "compression '%s' is not available in this system (install its Python module), use one of: %s" % (compression, ", ".join(available_codecs()))
+    names = sorted(CODECS, key=CODECS.get)
+    return "--compress can be only %s or %s, you used '%s'" % (", ".join(names[:-1]), names[-1], compression)
@@ -0,0 +1,107 @@
+#########################################################################
+#                                                                       #
+# Name:      Parallel                                                   #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Parallel                                                   #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Pool of threads ciphering the parts of one big read at the same time
+
+The cipher backends release the GIL while they work, so the groups of
+blocks of a read are ciphered on several cores. The calling thread does
+the first part itself and waits for the rest.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['WorkerPool']
+
+import os
+import sys
+import threading
+import Queue
+
+
+class WorkerPool(object):
+    '''
+    Threads running the parts of jobs, safe to use from many threads. Threads are started
+    with the first job (after FUSE went to background or the process was forked)
+    '''
+    
+    def __init__(self, threads):
+        '''
+        Prepare the pool
+        '''
+        self.threads = threads
+        self.__lock = threading.Lock()
+        self.__queue = None
+        self.__pid = None
+    
+    def start(self):
+        '''
+        Start the threads of this process (the lock must be held)
+        '''
+        self.__queue = Queue.Queue()
+        self.__pid = os.getpid()
+        for i in xrange(self.threads):
+            worker = threading.Thread(target=self.worker, args=(self.__queue,), name="teFS-crypto-%s" % (i))
+            worker.daemon = True
+            worker.start()
+    
+    def worker(self, queue):
+        '''
+        Run the queued parts
+        '''
+        while True:
+            (function, index) = queue.get()
+            function(index)
+    
+    def map(self, function, items):
+        '''
+        Call the function for every item and return the results in order. The caller runs the first item,
+        the pool the rest. When every item finished, the first exception found (if any) is raised again
+        '''
+        
+        # Threads don't survive a fork, start new ones in this process
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self.start()
+        
+        results = [None] * len(items)
+        errors = []
+        pending = [len(items) - 1]
+        lock = threading.Lock()
+        done = threading.Event()
+        
+        def run(index):
+            try:
+                results[index] = function(items[index])
+            except Exception:
+                errors.append(sys.exc_info())
+            if index:
+                with lock:
+                    pending[0] -= 1
+                    if not pending[0]:
+                        done.set()
+        
+        # Queue the rest and do the first one here
+        for index in xrange(1, len(items)):
+            self.__queue.put((run, index))
+        if items:
+            run(0)
+        if pending[0] > 0:
+            done.wait()
+        
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
@@ -0,0 +1,129 @@
+#########################################################################
+#                                                                       #
+# Name:      Policy                                                     #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Policy                                                     #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Path policy for teFS: which paths are served and which are not
+
+Both matchers are built once, so checking a path costs one step per
+directory of the path, no matter how many paths or patterns were given.
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['PrefixSet', 'GlobFilter']
+
+import re
+import fnmatch
+
+
+class PrefixSet(object):
+    '''
+    Set of paths kept as a tree of their directories, it answers if a path is one of them or is inside one of them
+    '''
+    
+    def __init__(self, paths=[]):
+        '''
+        Build the tree with the given paths
+        '''
+        self.__root = {}
+        for path in paths:
+            self.add(path)
+    
+    def add(self, path):
+        '''
+        Add a path to the set
+        '''
+        node = self.__root
+        for step in path.split("/"):
+            if step:
+                node = node.setdefault(step, {})
+        
+        # None marks the end of a path
+        node[None] = True
+    
+    def covers(self, path):
+        '''
+        Return True if the path is in the set or inside one of the paths of the set
+        '''
+        node = self.__root
+        if None in node:
+            return True
+        for step in path.split("/"):
+            if step:
+                node = node.get(step)
+                if node is None:
+                    return False
+                if None in node:
+                    return True
+        return False
+
+
+class GlobFilter(object):
+    '''
+    Include and exclude glob patterns. Patterns without a slash are matched against the name
+    of every directory in the path, patterns with a slash against the path from the root of the tree.
+    Excluded paths are never served (neither what is inside them), when include patterns are given
+    only the regular files matching one of them are served (every directory is served to reach them)
+    '''
+    
+    def __init__(self, include=[], exclude=[]):
+        '''
+        Compile all the patterns of each kind in a single regular expression
+        '''
+        (self.__include_names, self.__include_paths) = self.compile(include)
+        (self.__exclude_names, self.__exclude_paths) = self.compile(exclude)
+        self.__include = bool(include)
+    
+    def compile(self, patterns):
+        '''
+        Build the regular expressions (names, paths) for the patterns, None when there is no pattern of that kind
+        '''
+        names = [pattern for pattern in patterns if "/" not in pattern]
+        paths = ["/%s" % (pattern.strip("/")) for pattern in patterns if "/" in pattern]
+        return (self.regex(names), self.regex(paths))
+    
+    def regex(self, patterns):
+        '''
+        Join the patterns in one regular expression
+        '''
+        if not patterns:
+            return None
+        return re.compile("|".join(["(?:%s)" % (fnmatch.translate(pattern)) for pattern in patterns]))
+    
+    def allowed(self, path, isdir):
+        '''
+        Answer if the path (from the root of the tree) is served
+        '''
+        
+        # Check every directory of the path and the path itself against the excluded patterns
+        prefix = ""
+        name = ""
+        for name in path.split("/"):
+            if name:
+                prefix += "/%s" % (name)
+                if self.__exclude_names and self.__exclude_names.match(name):
+                    return False
+                if self.__exclude_paths and self.__exclude_paths.match(prefix):
+                    return False
+        
+        # Regular files must match an included pattern if there is any
+        if self.__include and not isdir:
+            if self.__include_names and self.__include_names.match(name):
+                return True
+            if self.__include_paths and self.__include_paths.match(prefix):
+                return True
+            return False
+        
+        return True
@@ -0,0 +1,109 @@
+#########################################################################
+#                                                                       #
+# Name:      Readahead                                                  #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Readahead                                                  #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+Background prefetch of the blocks coming next in sequential reads
+'''
+
+__version__ = "201109111103"
+
+__all__ = ['Prefetcher']
+
+import threading
+import Queue
+
+
+class Prefetcher(object):
+    '''
+    Small pool of threads running tasks in background. Tasks have a key so the same
+    work is never queued twice, and the queue is bounded: when it is full new tasks
+    are dropped (prefetching is only a hint)
+    '''
+    
+    def __init__(self, threads, size=64, error=None):
+        '''
+        Prepare the pool (threads are started with the first task, after FUSE went to background)
+        '''
+        self.threads = threads
+        self.__error = error
+        self.__queue = Queue.Queue(size)
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__workers = []
+    
+    def start(self):
+        '''
+        Start the threads of the pool
+        '''
+        for i in xrange(self.threads):
+            worker = threading.Thread(target=self.worker, name="teFS-prefetch-%s" % (i))
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+    
+    def stop(self):
+        '''
+        Stop the threads of the pool once they finish the queued tasks
+        '''
+        with self.__lock:
+            workers = self.__workers
+            self.__workers = []
+        for worker in workers:
+            self.__queue.put((None, None, None))
+        for worker in workers:
+            worker.join()
+    
+    def submit(self, key, function, *args):
+        '''
+        Queue the function unless a task with the same key is already waiting
+        '''
+        with self.__lock:
+            if key in self.__pending:
+                return
+            if not self.__workers:
+                self.start()
+            self.__pending[key] = threading.Event()
+            try:
+                self.__queue.put_nowait((key, function, args))
+            except Queue.Full:
+                self.__pending.pop(key)
+    
+    def wait(self, key):
+        '''
+        If a task with the key is waiting or running, wait until it finishes. Returns True if there was such task
+        '''
+        with self.__lock:
+            done = self.__pending.get(key)
+        if done is None:
+            return False
+        done.wait()
+        return True
+    
+    def worker(self):
+        '''
+        Run the queued tasks
+        '''
+        while True:
+            (key, function, args) = self.__queue.get()
+            if function is None:
+                break
+            try:
+                function(*args)
+            except Exception, e:
+                if self.__error:
+                    self.__error("Prefetch error: %s\n" % (e))
+            finally:
+                with self.__lock:
+                    self.__pending.pop(key).set()
@@ -0,0 +1,427 @@
+#!/usr/bin/python
+#########################################################################
+#                                                                       #
+# Name:      SyncPlan                                                   #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    SyncPlan                                                   #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+teFS sync planner: digests of the encrypted mirror, block by block, and
+the list of files and byte ranges which must be uploaded.
+
+build keeps a manifest with the digest of every unit (1MB by default)
+of every encrypted file as the mount shows it, reading through teFS
+only the files whose size or modification time changed since the last
+run. scan does the same on the remote side with the encrypted files
+already there (no teFS nor key needed). plan compares both manifests
+and prints what must be sent, so a nightly sync reads only the data
+which changed.
+'''
+
+__version__ = "201109111103"
+
+__all__ = []
+
+# Import the rest of libraries
+import os
+import sys
+import time
+import json
+import stat
+import hashlib
+import multiprocessing
+from itertools import imap
+from options import getargv, getargvalue, getpatterns, checkblocksize, checkbackend, checkcompression
+from tefs import teFS
+from transcode import walk
+
+# Bytes of the encrypted files covered by every digest
+DIGEST_UNIT = 1048576
+
+# Save the manifest after this number of files, so an interrupted run doesn't start again from zero
+MANIFEST_EVERY = 1000
+
+# Version of the manifest
+MANIFEST_VERSION = 1
+
+# Entry of a file which couldn't be digested and was never digested before: plan neither sends nor deletes it
+UNKNOWN = (None, None, None, None)
+
+# teFS used by this process (every process of the pool builds its own one)
+worker_tefs = None
+
+
+def start_worker(key, datapath, manifest, options):
+    '''
+    Build the teFS of this process (scanning a mirror, key is False and there is no teFS)
+    '''
+    global worker_tefs
+    if key is not False:
+        worker_tefs = teFS(key, datapath, 'encrypt', manifest, **options)
+
+
+def digest_file(task):
+    '''
+    Digest every unit of the encrypted file, as teFS shows it (vpath) or as it is in the mirror (real path).
+    Returns (vpath, size of the source, modification time, size, digests, error)
+    '''
+    (vpath, path, unit) = task
+    tefs = worker_tefs
+    try:
+        digests = []
+        
+        # The virtual file, read through teFS
+        if tefs is not None:
+            fh = tefs.open(vpath, os.O_RDONLY)
+            if isinstance(fh, int):
+                raise IOError,"File '%s' is not allowed" % (vpath)
+            try:
+                st = fh.st
+                (realsize, mtime, size) = (st.realsize, st.st_mtime, st.st_size)
+                offset = 0
+                while offset < size:
+                    buf = tefs.read(vpath, unit, offset, fh)
+                    if not buf:
+                        raise IOError,"File '%s' is shorter than expected (%s of %s bytes)" % (vpath, offset, size)
+                    digests.append(hashlib.md5(buf).hexdigest())
+                    offset += len(buf)
+            finally:
+                tefs.release(vpath, os.O_RDONLY, fh)
+        
+        # A file of the mirror
+        else:
+            st = os.stat(path)
+            (realsize, mtime, size) = (st.st_size, st.st_mtime, st.st_size)
+            f = open(path, 'rb')
+            try:
+                buf = f.read(unit)
+                while buf:
+                    digests.append(hashlib.md5(buf).hexdigest())
+                    buf = f.read(unit)
+            finally:
+                f.close()
+        
+        return (vpath, realsize, mtime, size, digests, None)
+    except Exception,e:
+        return (vpath, None, None, None, None, "%s" % (e))
+
+
+def scan(mirror):
+    '''
+    Walk the mirror, yields (vpath, real path, stat) for every regular file
+    '''
+    for (folder, dirs, names) in os.walk(mirror):
+        dirs.sort()
+        for name in sorted(names):
+            
+            # Temporal files of transcode.py
+            if name.endswith('.tefs-tmp'):
+                continue
+            path = os.path.join(folder, name)
+            vpath = "/%s" % (os.path.relpath(path, mirror))
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                yield (vpath, path, st)
+
+
+def load_manifest(path):
+    '''
+    Read a manifest, returns (settings, files) or (None, {}) if it can't be read
+    '''
+    try:
+        f = open(path, 'rb')
+        try:
+            manifest = json.load(f, encoding='latin-1')
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return (None, {})
+    
+    if manifest.get('version') != MANIFEST_VERSION:
+        return (None, {})
+    
+    # Paths are saved as latin-1 so any name survives, bring them back to byte strings
+    files = dict([(vpath.encode('latin-1'), tuple(known)) for (vpath, known) in manifest.get('files', {}).iteritems()])
+    return (manifest.get('settings'), files)
+
+
+def save_manifest(path, settings, files):
+    '''
+    Write the manifest (to a temporal file first, so it is never left half written)
+    '''
+    temporal = "%s.tmp" % (path)
+    f = open(temporal, 'wb')
+    try:
+        json.dump({'version': MANIFEST_VERSION, 'settings': settings, 'files': files}, f, encoding='latin-1')
+    finally:
+        f.close()
+    os.rename(temporal, path)
+
+
+def ranges(local, remote, unit):
+    '''
+    Compare the digests of a file on both sides, returns the list of (start, end) byte ranges to send
+    '''
+    (size, digests) = (local[2], local[3])
+    if remote is None:
+        if size:
+            return [(0, size)]
+        return []
+    
+    # Units which differ or are missing on the remote side, consecutive ones together
+    answer = []
+    theirs = remote[3]
+    for (index, digest) in enumerate(digests):
+        if index < len(theirs) and theirs[index] == digest:
+            continue
+        start = index * unit
+        end = min(start + unit, size)
+        if answer and answer[-1][1] == start:
+            answer[-1] = (answer[-1][0], end)
+        else:
+            answer.append((start, end))
+    return answer
+
+
+def plan(local_path, remote_path, paths):
+    '''
+    Print what must be done to make the remote mirror equal to the local one, one line per file with tabs:
+    send PATH START-END[,START-END...], size PATH SIZE (the remote file must be cut or grow), delete PATH.
+    With paths, only the paths of the files to send are printed. Local files which couldn't be digested are left
+    alone, remote ones are sent whole
+    '''
+    (local_settings, local) = load_manifest(local_path)
+    (remote_settings, remote) = load_manifest(remote_path)
+    if local_settings is None:
+        raise IOError,"Can't read the manifest '%s'" % (local_path)
+    if remote_settings is not None and remote_settings.get('unit') != local_settings.get('unit'):
+        raise IOError,"Manifests were built with different units (%s and %s bytes)" % (local_settings.get('unit'), remote_settings.get('unit'))
+    unit = local_settings['unit']
+    
+    counters = {'files': 0, 'bytes': 0, 'deleted': 0, 'unknown': 0}
+    for vpath in sorted(local):
+        known = local[vpath]
+        theirs = remote.get(vpath)
+        
+        # Unknown files: nothing to do with a local one, a remote one is like a missing one
+        if known[3] is None:
+            counters['unknown'] += 1
+            continue
+        if theirs is not None and theirs[3] is None:
+            theirs = None
+        send = ranges(known, theirs, unit)
+        resized = theirs is not None and theirs[2] != known[2]
+        if not send and not resized:
+            continue
+        
+        # Show it
+        if paths:
+            if send:
+                print vpath
+        else:
+            if send:
+                print "send\t%s\t%s" % (vpath, ",".join(["%s-%s" % (start, end) for (start, end) in send]))
+            if resized or theirs is None:
+                print "size\t%s\t%s" % (vpath, known[2])
+        counters['files'] += 1
+        counters['bytes'] += sum([end - start for (start, end) in send])
+    
+    # Files which are not in the local mirror anymore
+    for vpath in sorted(set(remote) - set(local)):
+        if not paths:
+            print "delete\t%s" % (vpath)
+        counters['deleted'] += 1
+    
+    return counters
+
+
+def main(key):
+    usage  = ""
+    usage += "Usage: %s SOURCE MANIFEST [options] build\n" % (sys.argv[0])
+    usage += "       %s MIRROR MANIFEST [options] scan\n" % (sys.argv[0])
+    usage += "       %s LOCAL REMOTE [options] plan\n" % (sys.argv[0])
+    usage += "Actions:\n"
+    usage += "    build           Digest the encrypted mirror of SOURCE as the mount shows it (only changed files are read)\n"
+    usage += "    scan            Digest the encrypted files of MIRROR (on the remote side, no key needed)\n"
+    usage += "    plan            Print the files and byte ranges of the LOCAL manifest which differ from the REMOTE one\n"
+    usage += "Options:\n"
+    
+    # ALLOWALL/INCLUDE/EXCLUDE/BACKEND/BLOCKSIZE/COMPRESS: same as in main.py, they must be the same used with the mount
+    usage += "    --allowall      Allow everything, doesn't take any control over allowed folders\n"
+    usage += "    --include=GLOB  Digest only the files matching the pattern (every directory is walked)\n"
+    usage += "    --exclude=GLOB  Skip the files and directories matching the pattern\n"
+    usage += "    --excludefrom=FILE  Read exclude patterns from the file, one per line\n"
+    usage += "    --backend=NAME  Cipher backend: auto, openssl or pycrypto (default: auto)\n"
+    usage += "    --blocksize=N   Block size in bytes from 4096 to 1048576 (default: legacy 32 bytes)\n"
+    usage += "    --compress=CODEC  Compress the blocks with zlib, lz4 or zstd before encrypting them\n"
+    
+    # UNIT: bytes of the encrypted files covered by every digest, both sides must use the same one
+    usage += "    --unit=N        Bytes covered by every digest (default: 1048576)\n"
+    
+    # PROCESSES: files are digested by a pool of processes
+    usage += "    --processes=N   Files processed at the same time (default: number of CPUs)\n"
+    
+    # PATHS: plan prints only the paths of the files to send (for rsync --files-from)
+    usage += "    --paths         Plan: print only the paths of the files to send\n"
+    
+    if len(sys.argv) == 4 or (len(sys.argv) > 4 and sys.argv[3].startswith('-')):
+        
+        # Get basic configuration from the command line
+        first = os.path.abspath(sys.argv.pop(1))
+        second = os.path.abspath(sys.argv.pop(1))
+        action = sys.argv.pop(-1)
+        
+        # Check action
+        if action not in ('build', 'scan', 'plan'):
+            print "Warning: action can be only build, scan or plan, you used '%s'" % (action)
+            print
+            print usage
+            sys.exit()
+        
+        # Process options
+        allowall = getargv('--allowall')
+        paths = getargv('--paths')
+        backend = getargvalue('--backend', 'auto')
+        blocksize = getargvalue('--blocksize')
+        compression = getargvalue('--compress')
+        unit = getargvalue('--unit', str(DIGEST_UNIT))
+        processes = getargvalue('--processes', str(multiprocessing.cpu_count()))
+        try:
+            (include, exclude) = getpatterns()
+        except IOError, e:
+            print "Warning: %s" % (e)
+            print
+            print usage
+            sys.exit()
+        try:
+            if blocksize is not None:
+                blocksize = int(blocksize)
+            unit = int(unit)
+            processes = int(processes)
+        except ValueError:
+            print "Warning: --blocksize, --unit and --processes must be numbers"
+            print
+            print usage
+            sys.exit()
+        
+        # Values teFS can't use would leave it half built
+        error = checkblocksize(blocksize) or checkbackend(backend) or checkcompression(compression)
+        if error:
+            print "Warning: %s" % (error)
+            print
+            print usage
+            sys.exit()
+        
+        # Unknown options
+        if len(sys.argv) > 1:
+            print "Warning: unknown options %s" % (", ".join(sys.argv[1:]))
+            print
+            print usage
+            sys.exit()
+        
+        # Compare two manifests
+        if action == 'plan':
+            try:
+                counters = plan(first, second, paths)
+            except IOError, e:
+                print >>sys.stderr, "Error: %s" % (e)
+                sys.exit(1)
+            print >>sys.stderr, "%s files to send (%.1f MB), %s to delete, %s unknown" % (counters['files'], counters['bytes'] / 1048576.0, counters['deleted'], counters['unknown'])
+            return
+        
+        # Every file is read once from start to end: no block or listings cache, no readahead
+        options = {'allowall': allowall, 'debugger': {'screen': (sys.stderr, ['*'])}, 'backend': backend, 'blocksize': blocksize, 'compression': compression, 'blockcache': 0, 'dircache': 0, 'readahead': 0, 'workers': None, 'include': include, 'exclude': exclude}
+        
+        # Load the previous manifest (only valid for the same source, format and unit)
+        if action == 'build':
+            if key:
+                algorithm = key.split("$")[0]
+            else:
+                algorithm = None
+            settings = {'source': first, 'algorithm': algorithm, 'blocksize': blocksize, 'compression': compression, 'include': include, 'exclude': exclude, 'unit': unit}
+        else:
+            settings = {'source': first, 'unit': unit}
+        (known_settings, previous) = load_manifest(second)
+        if known_settings != settings:
+            previous = {}
+        files = {}
+        
+        # Find out the files to process, skip the ones which didn't change since the last run
+        if action == 'build':
+            tefs = teFS(key, first, 'encrypt', second, **options)
+            found = walk(tefs, '/', None)
+            worker_key = key
+        else:
+            tefs = None
+            found = scan(first)
+            worker_key = False
+        start = time.time()
+        pending = []
+        skipped = 0
+        for (vpath, path, st) in found:
+            if tefs is not None:
+                realsize = st.realsize
+            else:
+                realsize = st.st_size
+            known = previous.get(vpath)
+            if known and known[0] == realsize and known[1] == st.st_mtime:
+                files[vpath] = known
+                skipped += 1
+            else:
+                pending.append((vpath, path, unit))
+        
+        # Process the files
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, start_worker, (worker_key, first, second, options))
+            results = pool.imap_unordered(digest_file, pending, 16)
+        else:
+            pool = None
+            start_worker(worker_key, first, second, options)
+            results = imap(digest_file, pending)
+        
+        counters = {'done': 0, 'errors': 0, 'bytes': 0}
+        try:
+            for (vpath, realsize, mtime, size, digests, error) in results:
+                if error:
+                    print >>sys.stderr, "%s: %s" % (vpath, error)
+                    counters['errors'] += 1
+                    
+                    # Keep what was known of it, a read error must not look like a deleted file to plan
+                    files[vpath] = previous.get(vpath, UNKNOWN)
+                    continue
+                files[vpath] = (realsize, mtime, size, digests)
+                counters['done'] += 1
+                counters['bytes'] += size
+                if counters['done'] % MANIFEST_EVERY == 0:
+                    save_manifest(second, settings, files)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            
+            # Files which disappeared are not saved
+            save_manifest(second, settings, files)
+        
+        # Show the summary
+        elapsed = max(time.time() - start, 0.001)
+        print >>sys.stderr, "%s files digested (%.1f MB at %.1f MB/s), %s unchanged, %s errors" % (counters['done'], counters['bytes'] / 1048576.0, counters['bytes'] / 1048576.0 / elapsed, skipped, counters['errors'])
+        if counters['errors']:
+            sys.exit(1)
+    else:
+        print usage
+
+if __name__ == '__main__':
+    # Must be the same key used by main.py to mount the filesystem
+    key = 'AESECB$CIt16CXA9j73Yx1jCCMH6CXvS8DwHQuR'
+    #key = 'BlowfishECB$ASFFQWER'
+    #key = None
+    main(key)
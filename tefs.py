@@ -23,29 +23,75 @@ __all__ = ['teFS']
 
 # Import the rest of libraries
 import os
+import io
+import time
+import json
+import hmac
+import hashlib
+import threading
 import errno
 import base64
 import stat
 import fuse
 from fuse import Fuse
-from Crypto.Cipher import AES, ARC2, Blowfish, CAST, DES
+from engine import CipherEngine
+from fileformat import BlockFormat, StreamFormat, CompressedFormat, spread, gather, HEADER, INDEX_ENTRY, STREAM_NONCE, LEGACY_BLOCKSIZE, MIN_BLOCKSIZE, MAX_BLOCKSIZE, COMPRESSED_BLOCKSIZE
+from compression import Codec
+from cache import LRUCache
+from readahead import Prefetcher
+from parallel import WorkerPool
+from policy import PrefixSet, GlobFilter
+from nameindex import NameIndex
 from debugger import Debugger, lineno
+from metrics import Metrics, StatsDumper, measured
+
+# scandir gives the type of the entries without a stat (os.scandir or the scandir module)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Set API version which was used to develop teFS
 fuse.fuse_python_api = (0, 2)
 
-class teFS(Fuse, Debugger):
+# Size of the chunks of blocks saved in the cache of blocks
+BLOCKCACHE_CHUNK = 65536
+
+# Threads transforming blocks ahead of sequential reads
+READAHEAD_THREADS = 2
+
+# Bytes of a read before its blocks are ciphered in parallel, and smallest part given to a thread
+PARALLEL_MIN = 262144
+PARALLEL_PART = 65536
+
+# Directory entries read and translated together
+READDIR_BATCH = 1024
+
+# Hidden virtual file at the root of the mount with the statistics as JSON
+STATS_PATH = '/.tefs-stats'
+
+# Bytes read at once to digest a file for its nonce (stream format)
+DIGEST_CHUNK = 1048576
+
+
+class teFS(Fuse, Debugger, StatsDumper):
     '''
     teFS (Transparent Encrypted Filesystem)
     '''
     
-    def __init__(self, keyc, datapath, action, mountpoint, allowall=False, debugger={}, *args,**kargs):
+    def __init__(self, keyc, datapath, action, mountpoint, allowall=False, debugger={}, backend='auto', blocksize=None, pathcache=65536, attrcache=65536, attrttl=1.0, workers=None, blockcache=64*1024*1024, readahead=16, include=None, exclude=None, dircache=32*1024*1024, index=None, cryptothreads=None, shared=None, compression=None, *args,**kargs):
         '''
         Inicialize the system
         '''
         # Set debugger
         self.set_debug(debugger)
         
+        # Calls, bytes and latency of every operation
+        self.metrics = Metrics()
+        
         try:
             # Get allowall option
             if allowall:
@@ -53,40 +99,53 @@ class teFS(Fuse, Debugger):
             self.__allowall = allowall
             
             # List of paths to avoid
-            self.__avoid = []
-            self.__avoid.append("/dev")
-            self.__avoid.append("/proc")
-            self.__avoid.append("/sys")
+            self.__avoid = PrefixSet(["/dev", "/proc", "/sys"])
+            
+            # Include and exclude globs (None when there is none)
+            if include or exclude:
+                self.__globs = GlobFilter(include or [], exclude or [])
+            else:
+                self.__globs = None
             
             # Instance constants
             self.flags = 1
-            self.packet = 100000
             self.padding = 0
-            self.blocksize = 32 # 4096
+            
+            # Check the block size (without it the legacy format is used)
+            if blocksize is not None:
+                if blocksize < MIN_BLOCKSIZE or blocksize > MAX_BLOCKSIZE:
+                    raise IOError,"Block size is '%s' and should be between %s and %s" % (blocksize, MIN_BLOCKSIZE, MAX_BLOCKSIZE)
             
             # Uncompact the key and the algorithm
             if keyc:
                 (algorithm,key) = keyc.split("$")
                 
-                # Choose some options depending on the algorithm (block size is dependent from packet, now defined on 100000)
-                if   algorithm == 'AESECB':         self.padding = 16; # self.block={'100000':133356}
-                elif algorithm == 'ARC2ECB':        self.padding = 8
-                elif algorithm == 'BlowfishECB':    self.padding = 8;  # self.block={'100000':133344}
-                elif algorithm == 'CASTECB':        self.padding = 8
-                elif algorithm == 'DESECB':         self.padding = 8
+                # Resolve the algorithm once, the engine checks the key and chooses the backend
+                engine = CipherEngine(algorithm, key, backend)
                 
-                # Integrity of the key
-                if algorithm == 'AES':
-                    # The block size for the cipher object; must be 16, 24, or 32 for AES
-                    if len(key) not in (16, 24, 32):
-                        raise IOError,"Key length is '%s' and should be 16, 24 or 32" % (len(self.__key))
+                # Padding is required by block modes (ECB)
+                self.padding = engine.padding
             else:
                 algorithm = None
                 key = None
+                engine = None
             
-            # Adjust blocksize depending on padding
-            if self.padding:
-                self.blocksize = ( self.blocksize / self.padding ) * self.padding
+            # Format of the encrypted files: stream for CTR algorithms, compressed blocks if a codec was given, else
+            # legacy (32 bytes blocks, no header) unless a block size was given
+            if engine and engine.stream:
+                if blocksize:
+                    self.warning("%s ciphers contents as a stream, the block size is ignored\n", algorithm)
+                if compression:
+                    self.warning("%s ciphers contents as a stream, they are not compressed\n", algorithm)
+                self.__format = StreamFormat(algorithm)
+            elif compression and algorithm:
+                self.__format = CompressedFormat(blocksize or COMPRESSED_BLOCKSIZE, self.padding, algorithm, Codec(compression))
+            elif blocksize and algorithm:
+                self.__format = BlockFormat(blocksize, self.padding, algorithm, 1)
+            else:
+                self.__format = BlockFormat(blocksize or LEGACY_BLOCKSIZE, self.padding, algorithm)
+            self.__legacy = BlockFormat(LEGACY_BLOCKSIZE, self.padding, algorithm)
+            self.blocksize = getattr(self.__format, 'blocksize', None)
             
             # Integrity error for action
             if action != 'encrypt' and action != 'decrypt':
@@ -96,25 +155,95 @@ class teFS(Fuse, Debugger):
             self.__algorithm = algorithm
             # Encryption key
             self.__key = key
+            # Cipher engine
+            self.__engine = engine
             # Save action
             self.__encrypt = (action == 'encrypt')
             # Save path from where to start
             self.__datapath = os.path.abspath(datapath)
             
-            # Last file
-            self.__last_filename = None
-            self.__last_content = None
-            
-            # Get the mount point
+            # Get the mount point (nothing inside it is served)
             self.__mountpoint = mountpoint
+            self.__mounted = PrefixSet([mountpoint])
+            
+            # Path translation caches: names (both ways), full paths and modification time of directories
+            self.__names = LRUCache(pathcache)
+            self.__paths = LRUCache(pathcache)
+            
+            # Directory listings cache: transformed listings, valid while the directory keeps its modification time and inode
+            self.__dirs = LRUCache(pathcache, dircache, teFSlisting.weigh)
+            
+            # Persistent index of names: listings of the directories which didn't change since the last mount are not translated again
+            if index:
+                index = os.path.abspath(index)
+                if PrefixSet([self.__datapath]).covers(index) or self.__mounted.covers(index):
+                    raise IOError,"Index '%s' can't be inside the served tree nor the mount point" % (index)
+                fingerprint = hmac.new(key or '', "teFS name index", hashlib.sha256).hexdigest()
+                settings = {'datapath': self.__datapath, 'action': action, 'algorithm': algorithm, 'key': fingerprint}
+                
+                # Layouts of compressed files depend on how blocks are compressed
+                if self.__format.compressed:
+                    settings['compression'] = "%s:%s:%s" % (self.__format.codec.name, self.__format.codec.level, self.__format.blocksize)
+                self.__index = NameIndex(index, settings)
+            else:
+                self.__index = None
+            
+            # Attributes cache: stat information of real paths, checked again after attrttl seconds
+            self.__attrs = LRUCache(attrcache)
+            self.__attrttl = attrttl
+            
+            # Version of every file the last time it was opened: the kernel keeps the pages it cached while it doesn't change
+            self.__opened = LRUCache(attrcache)
+            
+            # Cache of transformed blocks, grouped in chunks of about BLOCKCACHE_CHUNK bytes
+            self.__blocks = LRUCache(None, blockcache)
+            
+            # Readahead: up to readahead chunks are transformed in background while a file is read sequentially
+            self.__readahead = readahead
+            if readahead and blockcache:
+                self.__prefetcher = Prefetcher(READAHEAD_THREADS, error=self.error)
+            else:
+                self.__prefetcher = None
+            
+            # Big reads are ciphered by the thread serving them and cryptothreads-1 more
+            if cryptothreads and cryptothreads > 1:
+                self.__pool = WorkerPool(cryptothreads - 1)
+            else:
+                self.__pool = None
+            
+            # Limit of reads processed at the same time when FUSE is multithreaded (None means no limit)
+            if workers:
+                self.__workers = threading.BoundedSemaphore(workers)
+            else:
+                self.__workers = None
+            
+            # Trees served by one daemon share the caches and the threads (see multitree.py): the caches
+            # are views with the keys of this tree kept apart, prefetcher, pool and workers are the same ones
+            if shared:
+                self.__names = shared['names']
+                self.__paths = shared['paths']
+                self.__dirs = shared['dirs']
+                self.__attrs = shared['attrs']
+                self.__opened = shared['opened']
+                self.__blocks = shared['blocks']
+                if self.__prefetcher:
+                    self.__prefetcher = shared['prefetcher']
+                if self.__pool:
+                    self.__pool = shared['pool']
+                if self.__workers:
+                    self.__workers = shared['workers']
             
             # Show startup information
-            if algorithm:
-                self.debug("teFS started, using %s encryption algorithm:\n%s ->%s-> %s\n" % (algorithm, self.__datapath, action, self.__mountpoint), color='blue')
+            if algorithm and self.__format.compressed:
+                self.debug("teFS started, using %s encryption algorithm (%s backend, format v%s, blocks of %s bytes compressed with %s):\n%s ->%s-> %s\n" % (algorithm, engine.backend, self.__format.version, self.blocksize, self.__format.codec.name, self.__datapath, action, self.__mountpoint), color='blue')
+            elif algorithm and self.__format.stream:
+                self.debug("teFS started, using %s encryption algorithm (%s backend, format v%s, stream):\n%s ->%s-> %s\n" % (algorithm, engine.backend, self.__format.version, self.__datapath, action, self.__mountpoint), color='blue')
+            elif algorithm:
+                self.debug("teFS started, using %s encryption algorithm (%s backend, format v%s, blocks of %s bytes):\n%s ->%s-> %s\n" % (algorithm, engine.backend, self.__format.version, self.blocksize, self.__datapath, action, self.__mountpoint), color='blue')
             else:
                 self.debug("teFS started, using no encryption at all\n", color='blue')
         except Exception,e:
-            self.debug("ERROR:%s\n" % (e))
+            self.debug("ERROR:%s\n", e)
         
         # Call parent fo finish the work
         return super(teFS,self).__init__(*args, **kargs)
@@ -160,18 +289,8 @@ class teFS(Fuse, Debugger):
         # If we got an encryption key
         if self.__key:
             
-            # Start ciphering system
-            if   self.__algorithm == 'AESCFB':      cipher = AES.new(self.__key, AES.MODE_CFB)
-            elif self.__algorithm == 'AESECB':      cipher = AES.new(self.__key, AES.MODE_ECB)
-            elif self.__algorithm == 'ARC2CFB':     cipher = ARC2.new(self.__key, ARC2.MODE_CFB)
-            elif self.__algorithm == 'ARC2ECB':     cipher = ARC2.new(self.__key, ARC2.MODE_ECB)
-            elif self.__algorithm == 'BlowfishCFB': cipher = Blowfish.new(self.__key, Blowfish.MODE_CFB)
-            elif self.__algorithm == 'BlowfishECB': cipher = Blowfish.new(self.__key, Blowfish.MODE_ECB)
-            elif self.__algorithm == 'CASTCFB':     cipher = CAST.new(self.__key, CAST.MODE_CFB)
-            elif self.__algorithm == 'CASTECB':     cipher = CAST.new(self.__key, CAST.MODE_ECB)
-            elif self.__algorithm == 'DESCFB':      cipher = DES.new(self.__key, DES.MODE_CFB)
-            elif self.__algorithm == 'DESECB':      cipher = DES.new(self.__key, DES.MODE_ECB)
-            else: raise IOError,"Specified encryption algorithm is unkown: %s" % (self.__algorithm)
+            # Cipher engine (contexts are reused by every thread)
+            cipher = self.__engine
             
             # Add padding to the string if required
             if self.padding:
@@ -184,7 +303,7 @@ class teFS(Fuse, Debugger):
             
             # Security check
             if len(encoded) != len(string):
-                self.error("Encrypt => Normal and decoded string are different size: %s -> %s\n" % (len(encoded), len(string)))
+                self.error("Encrypt => Normal and decoded string are different size: %s -> %s\n", len(encoded), len(string))
             
             # Check if is a file
             if isfile:
@@ -214,18 +333,8 @@ class teFS(Fuse, Debugger):
         # If we got an encryption key
         if self.__key:
             
-            # Start ciphering system
-            if   self.__algorithm == 'AESCFB':      cipher = AES.new(self.__key, AES.MODE_CFB)
-            elif self.__algorithm == 'AESECB':      cipher = AES.new(self.__key, AES.MODE_ECB)
-            elif self.__algorithm == 'ARC2CFB':     cipher = ARC2.new(self.__key, ARC2.MODE_CFB)
-            elif self.__algorithm == 'ARC2ECB':     cipher = ARC2.new(self.__key, ARC2.MODE_ECB)
-            elif self.__algorithm == 'BlowfishCFB': cipher = Blowfish.new(self.__key, Blowfish.MODE_CFB)
-            elif self.__algorithm == 'BlowfishECB': cipher = Blowfish.new(self.__key, Blowfish.MODE_ECB)
-            elif self.__algorithm == 'CASTCFB':     cipher = CAST.new(self.__key, CAST.MODE_CFB)
-            elif self.__algorithm == 'CASTECB':     cipher = CAST.new(self.__key, CAST.MODE_ECB)
-            elif self.__algorithm == 'DESCFB':      cipher = DES.new(self.__key, DES.MODE_CFB)
-            elif self.__algorithm == 'DESECB':      cipher = DES.new(self.__key, DES.MODE_ECB)
-            else: raise IOError,"Specified decrypting algorithm is unkown: %s" % (self.__algorithm)
+            # Cipher engine (contexts are reused by every thread)
+            cipher = self.__engine
             
             # If is a file
             if isfile:
@@ -253,7 +362,7 @@ class teFS(Fuse, Debugger):
             
             # Security check
             if len(encoded) != len(string):
-                self.error("Decrypt => Normal and encoded string are different size: %s -> %s\n" % (len(encoded), len(string)))
+                self.error("Decrypt => Normal and encoded string are different size: %s -> %s\n", len(encoded), len(string))
             
             # Unpad the string
             if self.padding:
@@ -269,130 +378,452 @@ class teFS(Fuse, Debugger):
         # Return the string
         return string
     
-    def realpath(self, virtualpath):
+    def encrypt_blocks(self, string, count, fmt):
         '''
-        Build the virtual path
+        Encrypt the first count full blocks of the string with one cipher call (ECB blocks are independent),
+        returns a bytearray
         '''
         
-        # Start up realpath
-        realpath = self.__datapath
+        # Nothing to do
+        if not count:
+            return bytearray()
         
-        # Make the worker
-        if self.__encrypt:
+        # Full blocks always get one byte of padding
+        size = count * fmt.blocksize
+        padded = spread(string, count, fmt.plain_blocksize, fmt.blocksize, chr(fmt.blocksize - fmt.plain_blocksize), self.__engine.slack)
+        
+        # Encrypt all of them at once, in place
+        self.__engine.encrypt_into(padded, size)
+        del padded[size:]
+        return padded
+    
+    def decrypt_blocks(self, string, count, fmt):
+        '''
+        Decrypt the first count full blocks of the bytearray with one cipher call (ECB blocks are independent),
+        they are decrypted in place and the rest of the bytearray is not touched. Returns a new bytearray
+        '''
+        
+        # Nothing to do
+        if not count:
+            return bytearray()
+        
+        # The cipher needs some spare bytes after the blocks, copy them only if there are not enough
+        size = count * fmt.blocksize
+        padded = string
+        if len(padded) < size + self.__engine.slack:
+            padded = padded[:size]
+            padded.extend(bytearray(self.__engine.slack))
+        
+        # Decrypt all of them at once, in place
+        self.__engine.decrypt_into(padded, size)
+        
+        # Check the padding of every block
+        padder = chr(fmt.blocksize - fmt.plain_blocksize)
+        if padded[fmt.blocksize - 1:size:fmt.blocksize] != padder * count:
+            raise IOError,"Wrong padding in the given blocks!"
+        
+        # Remove the padding
+        return gather(padded, count, fmt.plain_blocksize, fmt.blocksize)
+    
+    def realname(self, vname):
+        '''
+        Translate a virtual name to the real one, None when it can't be translated (it doesn't exist)
+        '''
+        
+        # Look in the cache
+        rname = self.__names.get((True, vname))
+        if rname is None:
             
-            # Virtual path is encrypted, decrypt it to get the name of the original path
-            worker = self.decrypt
+            # Virtual names are encrypted when encrypting, decrypted when decrypting
+            try:
+                if self.__encrypt:
+                    rname = self.decrypt(vname)
+                else:
+                    rname = self.encrypt(vname)
+            except Exception:
+                return None
             
-        else:
+            # Names which are not a name once translated don't exist either
+            if not rname or rname in ('.', '..') or '/' in rname or '\0' in rname:
+                return None
+            
+            # Remember both ways
+            self.__names.set((True, vname), rname)
+            self.__names.set((False, rname), vname)
+        
+        return rname
+    
+    def virtualname(self, rname):
+        '''
+        Translate a real name to the virtual one
+        '''
+        
+        # Look in the cache
+        vname = self.__names.get((False, rname))
+        if vname is None:
             
-            # Virtual path is decrypted, encrypt it to get the name of the original path
-            worker = self.encrypt
+            # Virtual names are encrypted when encrypting, decrypted when decrypting
+            if self.__encrypt:
+                vname = self.encrypt(rname)
+            else:
+                vname = self.decrypt(rname)
+            
+            # Remember both ways
+            self.__names.set((False, rname), vname)
+            self.__names.set((True, vname), rname)
+        
+        return vname
+    
+    def virtualnames(self, rnames):
+        '''
+        Translate a list of real names to the virtual ones, the names missing in the cache are ciphered
+        together with one cipher call when the algorithm allows it (ECB). Names which can't be translated get None
+        '''
+        
+        # Look in the cache
+        vnames = [self.__names.get((False, rname)) for rname in rnames]
+        missing = [i for (i, vname) in enumerate(vnames) if vname is None]
+        if not missing:
+            return vnames
+        
+        # Stream modes need a new context for every name
+        if not self.__key or not self.padding or len(missing) == 1:
+            for i in missing:
+                try:
+                    vnames[i] = self.virtualname(rnames[i])
+                except Exception,e:
+                    self.error("EXCEPTION at line %s: %s\n", lineno(), e)
+            return vnames
+        
+        # Virtual names are encrypted when encrypting, decrypted when decrypting
+        if self.__encrypt:
+            translated = self.encrypt_names([rnames[i] for i in missing])
+        else:
+            translated = self.decrypt_names([rnames[i] for i in missing])
+        
+        # Remember both ways
+        for (i, vname) in zip(missing, translated):
+            if vname is not None:
+                vnames[i] = vname
+                self.__names.set((False, rnames[i]), vname)
+                self.__names.set((True, vname), rnames[i])
+        
+        return vnames
+    
+    def encrypt_names(self, names):
+        '''
+        Encrypt a list of names with one cipher call, the result is the same as encrypt() for every name
+        '''
+        
+        # Pad every name and encrypt all of them at once (ECB blocks are independent)
+        padded = [self.pad(name)[0] for name in names]
+        encoded = self.__engine.encrypt(''.join(padded))
+        
+        # Split, encode and make them path compliant
+        answer = []
+        position = 0
+        for string in padded:
+            answer.append(base64.b64encode(encoded[position:position + len(string)]).replace("/", "_"))
+            position += len(string)
+        return answer
+    
+    def decrypt_names(self, names):
+        '''
+        Decrypt a list of names with one cipher call, names which are not valid get None
+        '''
+        
+        # Decode every name, only the ones with full blocks can be decrypted
+        encoded = []
+        for name in names:
+            try:
+                string = base64.b64decode(name.replace("_", "/"))
+            except TypeError:
+                string = ''
+            if not string or len(string) % self.padding:
+                self.error("Name '%s' was not encrypted by teFS\n", name)
+                string = None
+            encoded.append(string)
+        
+        # Decrypt all of them at once (ECB blocks are independent)
+        decoded = self.__engine.decrypt(''.join([string for string in encoded if string]))
+        
+        # Split and unpad them
+        answer = []
+        position = 0
+        for (name, string) in zip(names, encoded):
+            if string is None:
+                answer.append(None)
+                continue
+            try:
+                answer.append(self.unpad(decoded[position:position + len(string)]))
+            except Exception,e:
+                self.error("Unpad error: %s - Name:%s\n" % (e, name))
+                answer.append(None)
+            position += len(string)
+        return answer
+    
+    @measured('realpath')
+    def realpath(self, virtualpath):
+        '''
+        Build the real path from the virtual one, None if some name in it can't be translated
+        '''
+        return self.translate(virtualpath)
+    
+    def translate(self, virtualpath):
+        '''
+        Build the real path from the virtual one (without measuring it, it calls itself for the parents)
+        '''
         
-        # For each step in the path
-        for step in virtualpath.split("/")[1:]:
+        # Look in the cache
+        realpath = self.__paths.get(virtualpath)
+        if realpath is None:
             
-            # If this is root
-            if realpath == '/':
-                
-                # Realpath will start empty
-                realpath = ''
+            # Get the real path of the parent (every prefix gets cached as well)
+            (parent, step) = virtualpath.rsplit("/", 1)
+            if parent:
+                realpath = self.translate(parent)
+                if realpath is None:
+                    return None
+            else:
+                realpath = self.__datapath
             
             # Add the next directory
-            realpath += "/%s" % (worker(step))
+            if step:
+                
+                # Look in the index of names before ciphering
+                rname = None
+                if self.__index:
+                    rname = self.__index.realname(realpath, step)
+                if rname is None:
+                    rname = self.realname(step)
+                    if rname is None:
+                        return None
+                
+                # If this is root realpath will start empty
+                if realpath == '/':
+                    realpath = ''
+                realpath += "/%s" % (rname)
+            
+            # Remember it
+            self.__paths.set(virtualpath, realpath)
         
         #self.debug("REALPATH: %s\n" % (realpath),color='blue')
         return realpath
     
-    def allowed(self,rpath,vpath):
+    def expire(self, vpath, known, names):
+        '''
+        Forget the translations of the entries removed from a directory since its last listing
+        '''
+        for rname in known - names:
+            vname = self.__names.pop((False, rname))
+            if vname is not None:
+                self.__names.pop((True, vname))
+                self.__paths.pop("%s/%s" % (vpath.rstrip("/"), vname))
+    
+    def fsdestroy(self):
+        '''
+        Called by FUSE when the filesystem is unmounted, stop the background threads and write the queued log
+        '''
+        if self.__prefetcher:
+            self.__prefetcher.stop()
+        if self.__index:
+            self.__index.close()
+        
+        # Write what is still queued in the log
+        self.flush_log()
+    
+    def fsinit(self):
+        '''
+        Called by FUSE once the filesystem is mounted (and in background), start waiting for the signals
+        '''
+        self.watch_signals()
+    
+    def cache_stats(self):
+        '''
+        Return the statistics of the caches
+        '''
+        return {'names': self.__names.stats(), 'paths': self.__paths.stats(), 'dirs': self.__dirs.stats(), 'attrs': self.__attrs.stats(), 'blocks': self.__blocks.stats()}
+    
+    def stats(self):
+        '''
+        Return the statistics of the operations and the caches as JSON
+        '''
+        return json.dumps({'uptime': time.time() - self.metrics.started, 'operations': self.metrics.stats(), 'caches': self.cache_stats()}, sort_keys=True) + "\n"
+    
+    def allowed(self,rpath,vpath,isdir=None):
         '''
         Will answer True/False if the path is allowed to be encrypted or not.
-        This method will avoid specific paths defined in the constructor.
-        This method will avoid everything what is not a regular file or a directory.
+        This method will avoid our own mount point, the specific paths defined in the constructor and the excluded globs.
+        This method will avoid everything what is not a regular file or a directory
+        (isdir says which one it is when the caller already knows it, then no stat is needed).
         '''
         
+        # Paths with names which couldn't be translated don't exist
+        if rpath is None:
+            return False
+        
         # If allow all was set, don't do any checks here
         if self.__allowall:
             return True
         
-        # Inicialize
-        allowed = True
-        
         # Are we working on our own folder? Check real and virtual path
-        len_rpath = len(rpath)
-        len_vpath = len(vpath)
-        len_mountpoint = len(self.__mountpoint)
-        for (path, len_path) in [(rpath, len_rpath), (vpath, len_vpath)]:
-            
-            # If path is longer means it contains some subdirectory in it
-            if len_path > len_mountpoint:
-                
-                # Add the slash at the end and compare
-                temp = "%s/" % (self.__mountpoint)
-                if temp == path[0:len_mountpoint+1]:
-                    
-                    #  The path contains a string to avoid, not allowed
-                    allowed = False
-                    break
-            else:
-                
-                # If it is the same size or smaller, compare straight
-                if self.__mountpoint == path:
-                    
-                    #  The path has to be a avoid, not allowed
-                    allowed = False
-                    break
+        if self.__mounted.covers(rpath) or self.__mounted.covers(vpath):
+            return False
         
-        # If the path is still allowed
-        if allowed:
-            
-            # For each avoidable path
-            for avoid in self.__avoid:
-                
-                # Calculate the size of the string to avoid
-                len_avoid = len(avoid)
-                
-                # If path is longer means it contains some subdirectory in it
-                if len_rpath > len_avoid:
-                    
-                    # Add the slash at the end and compare
-                    temp = "%s/" % (avoid)
-                    if temp == rpath[0:len_avoid+1]:
-                        
-                        #  The path contains a string to avoid, not allowed
-                        allowed = False
-                        break
-                else:
-                    
-                    # If it is the same size or smaller, compare straight
-                    if avoid == rpath:
-                        
-                        #  The path has to be a avoid, not allowed
-                        allowed = False
-                        break
+        # The path contains a string to avoid, not allowed
+        if self.__avoid.covers(rpath):
+            return False
         
         # Get the mode and make sure we work only with regular files and directories, nothing else!
-        if allowed:
-            
+        if isdir is None:
             try:
-                # Get the information of the realpath
-                path_mode = os.stat(rpath).st_mode
-                
-                # Check is a regular file or is a directory
-                allowed = stat.S_ISREG(path_mode) or stat.S_ISDIR(path_mode)
-                
+                # Get the information of the realpath (attributes are cached)
+                path_mode = self.getstat(rpath).st_mode
             except:
-                
                 # Some problem while getting the stat of the file, probably permission or wrong path specified
-                allowed = False
+                return False
+            
+            # Check is a regular file or is a directory
+            if stat.S_ISDIR(path_mode):
+                isdir = True
+            elif stat.S_ISREG(path_mode):
+                isdir = False
+            else:
+                return False
+        
+        # Include and exclude globs work with the plain path from the root of the tree
+        if self.__globs:
+            if self.__encrypt:
+                return self.__globs.allowed(rpath[len(self.__datapath):], isdir)
+            else:
+                return self.__globs.allowed(vpath, isdir)
         
         # Return the result
-        return allowed
+        return True
+    
+    def getstat(self, realpath, fresh=False):
+        '''
+        Get the attributes of the real path from the cache, checking them again when they are too old (or always if fresh)
+        '''
+        
+        # Still fresh
+        st = self.__attrs.get(realpath)
+        if st is not None and not fresh and time.time() - st.checked < self.__attrttl:
+            return st
+        
+        # Stat again, the content information is kept if the file didn't change
+        st = teFSstat(realpath, self.probe, st)
+        self.__attrs.set(realpath, st)
+        return st
     
+    def probe(self, realpath, realsize, version=None):
+        '''
+        Find out the format of a regular file and its virtual size, returns (format, size). The version
+        of the file (see teFSstat.key()) lets the layouts of compressed files come from the index
+        '''
+        
+        # Encrypting, all files use the format of the filesystem (the compressed one must know the size of every block)
+        if self.__encrypt:
+            if self.__format.compressed:
+                fmt = self.measure(realpath, realsize, version)
+                return (fmt, fmt.encrypted_size(realsize))
+            return (self.__format, self.__format.encrypted_size(realsize))
+        
+        # Decrypting with no key, nothing to calculate
+        if not self.__key:
+            return (self.__format, realsize)
+        
+        # Stream format, the header has a fixed size (it is checked when the file is read)
+        if self.__format.stream:
+            return (self.__format, self.__format.plain_size(realsize))
+        
+        # Decrypting, look for the header
+        f = open(realpath, 'rb')
+        try:
+            string = f.read(HEADER.size)
+            
+            # Compressed file, the index of the blocks follows the header
+            header = CompressedFormat.unpack(string)
+            if header:
+                (codec, algorithm, blocksize, plainsize, blocks) = header
+                if algorithm != self.__algorithm:
+                    raise IOError,"File '%s' was encrypted with %s and teFS is using %s" % (realpath, algorithm, self.__algorithm)
+                sizes = CompressedFormat.index(f.read(blocks * INDEX_ENTRY.size), blocks)
+                return (CompressedFormat(blocksize, self.padding, algorithm, Codec(codec), sizes), plainsize)
+            
+            header = BlockFormat.unpack(string)
+            if header:
+                
+                # The file brings its own format
+                (version, algorithm, blocksize, plainsize) = header
+                if algorithm != self.__algorithm:
+                    raise IOError,"File '%s' was encrypted with %s and teFS is using %s" % (realpath, algorithm, self.__algorithm)
+                return (BlockFormat(blocksize, self.padding, algorithm, version), plainsize)
+            
+            # Legacy file
+            fmt = self.__legacy
+            if not self.padding:
+                return (fmt, realsize)
+            
+            # Decrypt the last block to know how much padding it has (the trailing byte is not trusted)
+            size = realsize - fmt.meta
+            if size <= 0:
+                return (fmt, 0)
+            block = (size - 1) / fmt.blocksize
+            f.seek(block * fmt.blocksize)
+            content = f.read(size - block * fmt.blocksize)
+            return (fmt, block * fmt.plain_blocksize + len(self.decrypt(content, True, False)))
+        finally:
+            f.close()
+    
+    def measure(self, realpath, realsize, version=None):
+        '''
+        Compress every block of the real file to know its size in the compressed format, returns the layout of the file.
+        With an index, the layout of a file which didn't change since it was measured (same version) is taken from it
+        '''
+        fmt = self.__format
+        blocks = [fmt.blocksize] * (realsize / fmt.blocksize)
+        if realsize % fmt.blocksize:
+            blocks.append(realsize % fmt.blocksize)
+        
+        # Measured already
+        if self.__index and version:
+            try:
+                sizes = self.__index.layout(realpath, version)
+                if sizes is not None:
+                    return CompressedFormat(fmt.blocksize, fmt.padding, fmt.algorithm, fmt.codec, CompressedFormat.index(sizes, len(blocks)))
+            except Exception,e:
+                self.error("Index of layouts: %s\n", e)
+        
+        start = time.time()
+        f = open(realpath, 'rb')
+        try:
+            layout = fmt.measure(f.read(size) for size in blocks)
+        except:
+            self.metrics.record('compress', time.time() - start, 0, True)
+            raise
+        finally:
+            f.close()
+        self.metrics.record('compress', time.time() - start, realsize)
+        
+        # Remember it for the next times (reads check every block against it anyway)
+        if self.__index and version:
+            try:
+                self.__index.save_layout(realpath, version, layout.entries())
+            except Exception,e:
+                self.error("Index of layouts: %s\n", e)
+        return layout
+    
+    @measured('getattr')
     def getattr(self, vpath):
         '''
         Get the attrs from the real path
         '''
         
+        # The statistics file
+        if vpath == STATS_PATH:
+            return teFSreport(self.stats()).st
+        
         # Find out the real path
         realpath = self.realpath(vpath)
         # If allowed
@@ -400,12 +831,14 @@ class teFS(Fuse, Debugger):
             
             #self.debug("getattr: %s (%s)\n" % (vpath,realpath))
             try:
-                st = teFSstat(realpath, self.__encrypt, self.padding, self.blocksize, self.debug)
+                # Sizes are calculated the first time they are used, get any error here
+                st = self.getstat(realpath)
+                st.st_size
                 #self.debug("%s => st: %s\n" % (realpath, st.st_size))
                 
             except Exception,e:
                 # Error, answer with file does not exists
-                self.error("EXCEPTION at line %s: %s\n" % (lineno(), e))
+                self.error("EXCEPTION at line %s: %s\n", lineno(), e)
                 return -errno.ENOENT
             
         else:
@@ -418,22 +851,92 @@ class teFS(Fuse, Debugger):
     
     def readdir(self, vpath, offset):
         '''
-        Get a directory listing
+        Get a directory listing (see directory()), measured until the last entry is given (the entries are counted as bytes)
+        '''
+        start = time.time()
+        count = 0
+        error = False
+        try:
+            for entry in self.directory(vpath, offset):
+                count += 1
+                yield entry
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.record('readdir', time.time() - start, count, error)
+    
+    def directory(self, vpath, offset):
+        '''
+        Get a directory listing. Entries are numbered, so FUSE can ask for the rest of a big listing
+        starting from the offset of the last entry it got. Listings are served from the cache while the
+        directory doesn't change, otherwise they are streamed in batches
         '''
         
         # Start with virtual directories . and ..
-        vdir=['.', '..']
+        for (position, name) in ((1, '.'), (2, '..')):
+            if position > offset:
+                yield fuse.Direntry(name, offset=position, type=stat.S_IFDIR >> 12)
         
         # Find out the real path
         realpath = self.realpath(vpath)
         
-        # If is allowed
-        if self.allowed(realpath,vpath):
+        # If is not allowed, nothing else to show
+        if not self.allowed(realpath,vpath):
+            return
+        
+        # The listing is valid while the directory keeps its modification time and inode
+        #self.debug("readdir: %s (%s)\n" % (vpath,realpath))
+        st = self.getstat(realpath)
+        key = (st.st_mtime, st.st_ino)
+        listing = self.__dirs.get(realpath)
+        
+        # Read the whole directory unless it is in the cache, FUSE is asking for the rest of a
+        # listing which couldn't be cached or there is no cache
+        if listing is None or listing.key != key:
+            if offset or self.__dirs.budget == 0:
+                for (position, processed, kind) in self.entries(realpath, vpath, offset, set(), key):
+                    yield fuse.Direntry(processed, offset=position, type=kind)
+                return
+            
+            # Build the listing (positions start after . and ..)
+            names = set()
+            entries = []
+            for (position, processed, kind) in self.entries(realpath, vpath, 0, names, key):
+                entries.extend([None] * (position - 3 - len(entries)))
+                entries.append((processed, kind))
             
-            # Read the content of the directory
-            #self.debug("readdir: %s (%s)\n" % (vpath,realpath))
-            dirs = os.listdir(realpath)
-            for n in dirs:
+            # Forget translations of removed entries if the directory changed and remember the new listing
+            if listing is not None:
+                self.expire(vpath, listing.names, names)
+            listing = teFSlisting(key, frozenset(names), entries)
+            self.__dirs.set(realpath, listing)
+        
+        # Give the entries after the offset
+        entries = listing.entries
+        for index in xrange(max(offset - 2, 0), len(entries)):
+            if entries[index] is not None:
+                (processed, kind) = entries[index]
+                yield fuse.Direntry(processed, offset=index + 3, type=kind)
+    
+    def entries(self, realpath, vpath, offset, names, key):
+        '''
+        Read the real directory and yield (position, virtual name, type) for the allowed entries after the offset.
+        Every real name found is added to names, the virtual path of every entry is remembered in the cache of paths
+        '''
+        position = 2
+        for batch in self.batches(realpath, offset, key):
+            
+            # Remember every name and jump over the entries already given
+            names.update([name for (name, isdir, processed) in batch])
+            if position + len(batch) <= offset:
+                position += len(batch)
+                continue
+            
+            for (n, isdir, processed) in batch:
+                position += 1
+                if position <= offset or processed is None:
+                    continue
                 
                 # If we are not at root
                 if realpath != '/':
@@ -441,26 +944,106 @@ class teFS(Fuse, Debugger):
                 else:
                     path = "/%s" % (n)
                 
+                # Build temporal virtual path
+                tvpath = "%s/%s" % (vpath.rstrip("/"), processed)
+                
+                # If the entry is allowed (its type is already known unless it was something else or there is no scandir)
                 try:
-                    if self.__encrypt:
-                        processed = self.encrypt(n)
-                    else:
-                        processed = self.decrypt(n)
-                    
-                    # Build temporal virtual path
-                    tvpath = "%s/%s" % (vpath, processed)
-                    
-                    # If the subdirectory is allowed
-                    if self.allowed(path, tvpath):
-                        vdir.append(processed)
-                    
+                    if self.allowed(path, tvpath, isdir):
+                        
+                        # Next lookups of this entry will find its real path in the cache
+                        self.__paths.set(tvpath, path)
+                        if isdir is None:
+                            yield (position, processed, 0)
+                        elif isdir:
+                            yield (position, processed, stat.S_IFDIR >> 12)
+                        else:
+                            yield (position, processed, stat.S_IFREG >> 12)
                 except Exception,e:
-                    self.error("EXCEPTION at line %: %s\n" % (lineno(), e))
+                    self.error("EXCEPTION at line %s: %s\n", lineno(), e)
+    
+    def batches(self, realpath, offset, key):
+        '''
+        Yield lists of up to READDIR_BATCH (real name, is directory, virtual name) with the entries of the real directory,
+        from the index of names if the directory didn't change (key is its modification time and inode). The names of
+        the batches before the offset are not translated (their virtual name is None)
+        '''
+        
+        # Straight from the index
+        if self.__index:
+            found = self.__index.listing(realpath, key)
+            if found is not None:
+                for start in xrange(0, len(found), READDIR_BATCH):
+                    yield found[start:start + READDIR_BATCH]
+                return
+        
+        # Read the directory and translate the names of every batch together
+        position = 2
+        found = []
+        for batch in self.scan(realpath):
+            if position + len(batch) <= offset:
+                vnames = [None] * len(batch)
+            else:
+                vnames = self.virtualnames([name for (name, isdir) in batch])
+                
+                # The index keeps the types so the next listings need no stat (allowed() would stat them anyway)
+                if self.__index:
+                    batch = [(name, self.kind(realpath, name, isdir)) for (name, isdir) in batch]
+            position += len(batch)
+            batch = [(name, isdir, vname) for ((name, isdir), vname) in zip(batch, vnames)]
+            found.extend(batch)
+            yield batch
         
-        # Build the list for the system
-        #self.debug("vdir: %s\n" % (vdir))
-        for r in vdir:
-            yield fuse.Direntry(r)
+        # Save the whole listing in the index
+        if self.__index and not offset:
+            try:
+                self.__index.save(realpath, key, found)
+            except Exception,e:
+                self.error("Index of names: %s\n", e)
+    
+    def kind(self, realpath, name, isdir):
+        '''
+        Find out if the entry of the real directory is a directory (True), a regular file (False) or something else (None)
+        '''
+        if isdir is not None:
+            return isdir
+        try:
+            mode = self.getstat("%s/%s" % (realpath.rstrip("/"), name)).st_mode
+        except Exception:
+            return None
+        if stat.S_ISDIR(mode):
+            return True
+        elif stat.S_ISREG(mode):
+            return False
+        return None
+    
+    def scan(self, realpath):
+        '''
+        Yield lists of up to READDIR_BATCH (name, is directory) with the entries of the real directory.
+        The type comes from the directory itself when possible (no stat), it is None for anything which
+        is not a regular file or a directory
+        '''
+        batch = []
+        if scandir:
+            for entry in scandir(realpath):
+                if entry.is_dir():
+                    batch.append((entry.name, True))
+                elif entry.is_file():
+                    batch.append((entry.name, False))
+                else:
+                    batch.append((entry.name, None))
+                if len(batch) == READDIR_BATCH:
+                    yield batch
+                    batch = []
+        else:
+            # Without scandir the type will be found out by allowed()
+            for name in os.listdir(realpath):
+                batch.append((name, None))
+                if len(batch) == READDIR_BATCH:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
     
     def flag2mode(self, flags):
         '''
@@ -472,166 +1055,628 @@ class teFS(Fuse, Debugger):
             m = m.replace('w', 'a', 1)
         return m
     
+    @measured('open')
     def open(self, vpath, flags):
         '''
-        Open the file said by path using the given flags
+        Open the file said by path using the given flags, the handle is kept until release()
         '''
         
+        # This is a readonly filesystem
+        if (flags & 3) != os.O_RDONLY:
+            return -errno.EACCES
+        
+        # The statistics file keeps what it had when it was opened
+        if vpath == STATS_PATH:
+            return teFSreport(self.stats())
+        
         # Find out the real path
         realpath = self.realpath(vpath)
         #self.debug("open: %s with flags %s (%s)\n" % (vpath,flags,realpath))
         
-        # Open the file
-        link = os.open(realpath,flags)
-        if link:
-            os.close(link)
-            return 0
-        else:
+        # If not allowed, answer with file does not exists
+        if not self.allowed(realpath, vpath):
             return -errno.ENOENT
-#        if (flags & 3) != os.O_RDONLY:
-#            return -errno.EACCES
-    
-    def read_and_encrypt(self, realpath, vlength, voffset):
-        
-        # Repair offset if required
-        rsize = os.stat(realpath).st_size
-        vsize = teFSstat(realpath, self.__encrypt, self.padding, self.blocksize, self.debug).st_size
-        
-        # Calculate blocksize and offset depending on padding
-        if self.padding:    real_blocksize = self.blocksize-1
-        else:               real_blocksize = self.blocksize
-        
-        # Find out the real and virtual block positions
-        last_vposition = min(vsize, voffset + vlength)       # Find out last possible virtual position
-        block_ini = voffset / self.blocksize                # Position where first block starts
-        block_end = last_vposition / self.blocksize         # Position where last block starts
-        # Find out the real and virtual positions inside blocks
-        virtual_ini = voffset % self.blocksize              # Position inside the first block where to start
-        virtual_end = last_vposition % self.blocksize       # Position inside the last block where to stop
-        #real_ini=block_ini*real_blocksize+virtual_ini   # Position where to start in the real file
-        #real_end=block_end*real_blocksize+virtual_end   # Position where to end in the real file
-        
-        # Open the file
-        f = open(realpath, "r")
-        
-        # Get the content of the file
-        #elf.debug("Bring blocks from %s to %s\n" % (block_ini,block_end),color='yellow')
-        answer = ''
-        for block in range(block_ini, block_end + 1):
-            
-            # Bring the next block
-            #self.debug("Reading from:%s length:%s bytes\n" % (block*real_blocksize,real_blocksize),color='blue')
-            f.seek(block * real_blocksize)
-            content = f.read(real_blocksize)
-            
-            # Encrypt/Decrypt the block
-            lastblock = ((block + 1) * real_blocksize > rsize)
-            try:
-                buf = self.encrypt(content, True, lastblock)
-            except:
-                self.error("*** Encrypting ERROR -> len(content):%s\n" % (len(content)))
-                raise
-            
-            # If this is the first block calculate where to start giving information
-            if block != block_ini:    ini = 0               # First position form the block
-            else:                   ini = virtual_ini     # Get the begging where the user requested
-            
-            # If this is the last block, calculate where to stop giving information
-            if block != block_end:    end = self.blocksize  # Last position from the block
-            else:                   end = virtual_end     # Get the ending where user requested
+        
+        # Open the file (checking it again, the cached pages of the kernel depend on it)
+        fh = teFSfile(realpath, vpath, self.getstat(realpath, True))
+        
+        # The kernel keeps the pages it has of the file if it didn't change since the last open, else it drops them
+        version = fh.st.key()
+        fh.keep_cache = (self.__opened.get(realpath) == version)
+        self.__opened.set(realpath, version)
+        return fh
+    
+    def release(self, vpath, flags, fh=None):
+        '''
+        Close the handle built by open()
+        '''
+        if fh is not None:
+            fh.close()
+        return 0
+    
+    def fgetattr(self, vpath, fh=None):
+        '''
+        Get the attrs of an open file
+        '''
+        if fh is not None:
+            return fh.st
+        return self.getattr(vpath)
+    
+    def encrypt_range(self, fh, block_ini, block_end):
+        '''
+        Read and encrypt the blocks from block_ini to block_end (both included)
+        '''
+        fmt = fh.st.format
+        lastblock_index = fmt.lastblock(fh.st.realsize)
+        
+        # Bring all the blocks at once
+        start = time.time()
+        content = fh.pread(block_ini * fmt.plain_blocksize, (block_end - block_ini + 1) * fmt.plain_blocksize)
+        self.metrics.record('disk', time.time() - start, len(content))
+        
+        # Encrypt the blocks
+        #self.debug("Encrypt blocks from %s to %s\n" % (block_ini,block_end),color='yellow')
+        start = time.time()
+        try:
+            if fmt.compressed:
+                
+                # Compressed format: block by block, every one must take what the index says
+                del content[max(fh.st.realsize - block_ini * fmt.plain_blocksize, 0):]
+                parts = []
+                for (block, i) in enumerate(xrange(0, len(content), fmt.plain_blocksize), block_ini):
+                    (data, stored) = fmt.squeeze(str(content[i:i + fmt.plain_blocksize]))
+                    if block >= len(fmt.sizes) or fmt.entry(data, stored) != fmt.sizes[block]:
+                        raise IOError,"File '%s' changed while it was read" % (fh.vpath)
+                    parts.append(self.encrypt(data, True))
+                buf = ''.join(parts)
+            elif self.padding:
+                
+                # ECB: every full block with one call, then the last block of the file if it was requested
+                full = min(block_end + 1, lastblock_index) - block_ini
+                buf = self.encrypt_blocks(content, full, fmt)
+                if block_end == lastblock_index:
+                    buf += self.encrypt(str(content[full * fmt.plain_blocksize:]), True, fmt.meta)
+            else:
+                
+                # Stream modes: block by block
+                buf = ''.join([self.encrypt(str(content[i:i + fmt.plain_blocksize]), True) for i in xrange(0, len(content), fmt.plain_blocksize)])
+        except:
+            self.metrics.record('encrypt', time.time() - start, 0, True)
+            self.error("*** Encrypting ERROR -> len(content):%s\n", len(content))
+            raise
+        
+        self.metrics.record('encrypt', time.time() - start, len(content))
+        return buf
+    
+    def decrypt_range(self, fh, block_ini, block_end):
+        '''
+        Read and decrypt the blocks from block_ini to block_end (both included)
+        '''
+        fmt = fh.st.format
+        lastblock_index = fmt.lastblock(fh.st.st_size)
+        
+        # Bring all the blocks at once
+        start = time.time()
+        content = fh.pread(fmt.header + fmt.offset(block_ini), fmt.offset(block_end + 1) - fmt.offset(block_ini))
+        self.metrics.record('disk', time.time() - start, len(content))
+        
+        # Decrypt the blocks
+        #self.debug("Decrypt blocks from %s to %s\n" % (block_ini,block_end),color='yellow')
+        start = time.time()
+        try:
+            if fmt.compressed:
+                
+                # Compressed format: block by block, at the place the index says
+                parts = []
+                for block in xrange(block_ini, block_end + 1):
+                    data = self.decrypt(str(content[fmt.offset(block) - fmt.offset(block_ini):fmt.offset(block + 1) - fmt.offset(block_ini)]), True)
+                    size = min(fmt.plain_blocksize, fh.st.st_size - block * fmt.plain_blocksize)
+                    if not fmt.stored(block):
+                        data = fmt.codec.decompress(data, size)
+                    if len(data) != size:
+                        raise IOError,"Block %s of '%s' is damaged" % (block, fh.vpath)
+                    parts.append(data)
+                buf = ''.join(parts)
+            elif self.padding:
+                
+                # ECB: every full block with one call, then the last block of the file if it was requested
+                full = min(block_end + 1, lastblock_index) - block_ini
+                buf = self.decrypt_blocks(content, full, fmt)
+                if block_end == lastblock_index:
+                    
+                    # Remove the trailing metadata of the legacy format
+                    last = content[full * fmt.blocksize:]
+                    buf += self.decrypt(str(last[:len(last) - len(last) % self.padding]), True, False)
+            else:
+                
+                # Stream modes: block by block
+                buf = ''.join([self.decrypt(str(content[i:i + fmt.blocksize]), True) for i in xrange(0, len(content), fmt.blocksize)])
+        except:
+            self.metrics.record('decrypt', time.time() - start, 0, True)
+            self.error("*** Decrypting ERROR -> len(content):%s - blocks:%s-%s\n", len(content), block_ini, block_end)
+            raise
+        
+        self.metrics.record('decrypt', time.time() - start, len(content))
+        return buf
+    
+    def chunking(self, fh):
+        '''
+        Blocks are cached in chunks (small blocks are grouped), returns (blocks per chunk, index of the last block)
+        '''
+        st = fh.st
+        fmt = st.format
+        if self.__encrypt:
+            lastblock_index = fmt.lastblock(st.realsize)
+        else:
+            lastblock_index = fmt.lastblock(st.st_size)
+        return (max(1, BLOCKCACHE_CHUNK / fmt.blocksize), lastblock_index)
+    
+    def chunkkey(self, fh, chunk):
+        '''
+        Key of a chunk in the cache of blocks
+        '''
+        st = fh.st
+        return (st.st_dev, st.st_ino, st.st_mtime, st.realsize, chunk)
+    
+    def load_chunk(self, fh, chunk):
+        '''
+        Transform a chunk of blocks and save it in the cache
+        '''
+        
+        # Choose the worker
+        if self.__encrypt:
+            worker = self.encrypt_range
+        else:
+            worker = self.decrypt_range
+        
+        # Transform the blocks of the chunk
+        (group, lastblock_index) = self.chunking(fh)
+        buf = worker(fh, chunk * group, min(chunk * group + group - 1, lastblock_index))
+        self.__blocks.set(self.chunkkey(fh, chunk), buf)
+        return buf
+    
+    def prefetch(self, fh, chunk):
+        '''
+        Load a chunk in background unless the file was closed in the meanwhile
+        '''
+        if fh.fd is not None:
+            self.load_chunk(fh, chunk)
+    
+    def transform(self, fh, block_ini, block_end):
+        '''
+        Get the blocks from block_ini to block_end encrypted or decrypted, using the cache of blocks.
+        Returns (list of buffers, first block in the first buffer), the buffers are not joined
+        '''
+        
+        # Without cache, transform just what was requested (big ranges in groups at the same time)
+        if not self.__blocks.budget:
+            if self.__encrypt:
+                worker = self.encrypt_range
+            else:
+                worker = self.decrypt_range
+            groups = self.split(block_ini, block_end, fh.st.format.blocksize)
+            if len(groups) == 1:
+                return ([worker(fh, block_ini, block_end)], block_ini)
+            return (self.__pool.map(lambda group: worker(fh, group[0], group[1]), groups), block_ini)
+        
+        # Get every chunk from the cache
+        (group, lastblock_index) = self.chunking(fh)
+        first = block_ini / group
+        answer = []
+        missing = []
+        for chunk in xrange(first, block_end / group + 1):
+            key = self.chunkkey(fh, chunk)
+            buf = self.__blocks.get(key)
             
-            # Save the data
-            answer += buf[ini:end]
-            #self.debug("%2s => ini:%s end:%s buf:%s  answer:%s\n" % (block,ini,end,len(buf),len(answer)))
+            # If the chunk is being prefetched, wait for it instead of doing the same work
+            if buf is None and self.__prefetcher and self.__prefetcher.wait(key):
+                buf = self.__blocks.get(key)
+            if buf is None:
+                missing.append(chunk)
+            answer.append(buf)
         
-        # Close the file
-        f.close()
+        # Transform the rest (at the same time if they are enough)
+        if self.__pool and len(missing) > 1 and len(missing) * group * fh.st.format.blocksize >= PARALLEL_MIN:
+            loaded = self.__pool.map(lambda chunk: self.load_chunk(fh, chunk), missing)
+        else:
+            loaded = [self.load_chunk(fh, chunk) for chunk in missing]
+        for (chunk, buf) in zip(missing, loaded):
+            answer[chunk - first] = buf
         
-        # Return the requested result
-        #self.debug("ANSWER:%s\n\n" % (len(answer)))
-        return answer
+        # Read ahead if the file is being read sequentially
+        if fh.window and self.__prefetcher:
+            self.readahead(fh, block_end / group + 1, min(block_end / group + fh.window, lastblock_index / group))
+        
+        return (answer, (block_ini / group) * group)
     
-    def read_and_decrypt(self, realpath, rlength, roffset):
-        
-        # Repair offset if required
-        vsize = os.stat(realpath).st_size
-        rsize = teFSstat(realpath, self.__encrypt, self.padding, self.blocksize, self.debug).st_size
-        
-        # Calculate blocksize and offset depending on padding
-        if self.padding:    real_blocksize = self.blocksize - 1
-        else:               real_blocksize = self.blocksize
-        
-        # Find out the real and virtual block positions
-        last_rposition = min(rsize,roffset + rlength)       # Find out last possible virtual position
-        block_ini = roffset / real_blocksize                # Position where first block starts
-        block_end = last_rposition / real_blocksize         # Position where last block starts
-        # Find out the real and virtual positions inside blocks
-        real_ini = roffset % real_blocksize                 # Position inside the first block where to start
-        real_end = last_rposition % real_blocksize          # Position inside the last block where to stop
-        #virtual_ini=block_ini*self.blocksize+real_ini   # Position where to start in the real file
-        #virtual_end=block_end*self.blocksize+real_end   # Position where to end in the real file
-        
-        # Open the file
-        f = open(realpath, "r")
-        
-        # Get the content of the file
-        #self.debug("Bring blocks from %s to %s\n" % (block_ini,block_end),color='yellow')
-        answer = ''
-        for block in range(block_ini, block_end+1):
-            
-            # Bring the next block
-            #self.debug("Reading from:%s length:%s bytes\n" % (block*real_blocksize,real_blocksize),color='blue')
-            f.seek(block * self.blocksize)
-            content = f.read(self.blocksize)
-            
-            # Encrypt/Decrypt the block
-            lastblock = ((block + 1) * self.blocksize > vsize)
-            try:
-                buf = self.decrypt(content, True, lastblock)
-            except:
-                self.error("*** Encrypting ERROR -> len(content):%s - lastblock:%s\n" % (len(content), lastblock))
-                raise
+    def split(self, first, last, unit):
+        '''
+        Split the items from first to last (both included), of unit bytes each, in groups to cipher at the same time.
+        Returns a list of (first, last), only one group if the range is small or there is no pool
+        '''
+        count = last - first + 1
+        if not self.__pool or count * unit < PARALLEL_MIN:
+            return [(first, last)]
+        groups = min(self.__pool.threads + 1, count * unit / PARALLEL_PART)
+        size = (count + groups - 1) / groups
+        return [(start, min(start + size - 1, last)) for start in xrange(first, last + 1, size)]
+    
+    def readahead(self, fh, chunk_ini, chunk_end):
+        '''
+        Transform in background the chunks from chunk_ini to chunk_end (both included) which are not in the cache yet
+        '''
+        for chunk in xrange(max(chunk_ini, fh.prefetched), chunk_end + 1):
+            key = self.chunkkey(fh, chunk)
+            if key not in self.__blocks:
+                self.__prefetcher.submit(key, self.prefetch, fh, chunk)
+        fh.prefetched = max(fh.prefetched, chunk_end + 1)
+    
+    def read_and_encrypt(self, fh, vlength, voffset):
+        
+        # Get sizes and format of the file
+        st = fh.st
+        fmt = st.format
+        rsize = st.realsize
+        vsize = st.st_size
+        
+        # Find out the last possible virtual position
+        last_vposition = min(vsize, voffset + vlength)
+        if voffset >= last_vposition:
+            return ''
+        
+        # The answer is built in place
+        answer = bytearray(last_vposition - voffset)
+        position = 0
+        
+        # Get the header if it was requested
+        if voffset < fmt.header:
+            header = fmt.pack(rsize)[voffset:last_vposition]
+            answer[0:len(header)] = header
+            position = len(header)
+        
+        # Virtual positions inside the blocks area
+        block_vini = max(voffset, fmt.header) - fmt.header
+        block_vend = last_vposition - fmt.header
+        if block_vend > block_vini:
             
-            # If this is the first block calculate where to start giving information
-            if block != block_ini:    ini = 0               # First position form the block
-            else:                   ini = real_ini        # Get the begging where the user requested
+            # Find out the blocks to process (trailing metadata belongs to the last block)
+            lastblock_index = fmt.lastblock(rsize)
+            block_ini = min(fmt.locate(block_vini), lastblock_index)
+            block_end = min(fmt.locate(block_vend - 1), lastblock_index)
             
-            # If this is the last block, calculate where to stop giving information
-            if block != block_end:    end = real_blocksize  # Last position from the block
-            else:                   end = real_end        # Get the ending where user requested
+            # Encrypt the blocks
+            (buffers, first) = self.transform(fh, block_ini, block_end)
             
-            # Save the data
-            answer += buf[ini:end]
-            #self.debug("%2s => ini:%s end:%s buf:%s  answer:%s\n" % (block,ini,end,len(buf),len(answer)))
+            # Save the part of the blocks the user requested
+            position = self.extract(answer, position, buffers, block_vini - fmt.offset(first))
         
-        # Close the file
-        f.close()
+        # Return the requested result (shorter if the file shrank)
+        if position < len(answer):
+            del answer[position:]
+        return answer
+    
+    def read_and_decrypt(self, fh, rlength, roffset):
         
-        # Return the requested result
-        #self.debug("ANSWER:%s\n\n" % (len(answer)))
+        # Get sizes and format of the file
+        st = fh.st
+        fmt = st.format
+        rsize = st.st_size
+        
+        # Find out the last possible position
+        last_rposition = min(rsize, roffset + rlength)
+        if roffset >= last_rposition:
+            return ''
+        
+        # Find out the blocks to process
+        block_ini = roffset / fmt.plain_blocksize
+        block_end = (last_rposition - 1) / fmt.plain_blocksize
+        
+        # Decrypt the blocks
+        (buffers, first) = self.transform(fh, block_ini, block_end)
+        
+        # Save the part of the blocks the user requested in place
+        answer = bytearray(last_rposition - roffset)
+        position = self.extract(answer, 0, buffers, roffset - first * fmt.plain_blocksize)
+        
+        # Return the requested result (shorter if the file shrank)
+        if position < len(answer):
+            del answer[position:]
         return answer
     
-    def read(self, vpath, length, offset):
+    def nonce(self, fh):
         '''
-        Read the content of the file at the given path trying to return as many bytes as said by length and starting from offset
+        Nonce of a file in the stream format. Encrypting, it comes from the key, the size and modification time of
+        the real file and a digest of its content, taken the first time the version of the file (see teFSstat.key())
+        is read and kept with its attributes: the mirror changes only when the content or its version does, not with
+        metadata, and two contents never share a keystream, unless the file is changed while it is open (the handle
+        keeps the nonce it got). Decrypting, it is read from the header
         '''
-        # Find out the real path
-        realpath = self.realpath(vpath)
+        if fh.nonce is not None:
+            return fh.nonce
         
-        # Process the result
-        try:
+        # Known already for this version of the file (reads without handle get the cached attributes too)
+        st = fh.st
+        if st.nonce is None:
             if self.__encrypt:
-                return self.read_and_encrypt(realpath, length, offset)
+                
+                # Digest the whole content (the same way the offline tools read it)
+                start = time.time()
+                digest = hashlib.sha256()
+                done = 0
+                while done < st.realsize:
+                    content = fh.pread(done, min(DIGEST_CHUNK, st.realsize - done))
+                    if not content:
+                        break
+                    digest.update(content)
+                    done += len(content)
+                self.metrics.record('disk', time.time() - start, done)
+                
+                identity = "%s:%r:%s" % (st.realsize, st.st_mtime, digest.hexdigest())
+                st.nonce = hmac.new(self.__key, identity, hashlib.sha256).digest()[:STREAM_NONCE]
             else:
-                return self.read_and_decrypt(realpath, length, offset)
-        except Exception,e:
-            self.error("EXCEPT inside read_and_***(). exception detected at line %s: %s\n" % (lineno(), e))
-            raise
+                header = StreamFormat.unpack(fh.pread(0, st.format.header))
+                if header is None:
+                    raise IOError,"File '%s' is not in the stream format" % (fh.vpath)
+                (algorithm, nonce) = header
+                if algorithm != self.__algorithm:
+                    raise IOError,"File '%s' was encrypted with %s and teFS is using %s" % (fh.vpath, algorithm, self.__algorithm)
+                st.nonce = nonce
+        fh.nonce = st.nonce
+        return fh.nonce
+    
+    def read_stream(self, fh, length, offset):
+        '''
+        Read from a file in the stream format: the bytes are read in place and ciphered straight at their offset
+        '''
+        
+        # Get sizes and format of the file
+        st = fh.st
+        fmt = st.format
+        nonce = self.nonce(fh)
+        
+        # Find out the last possible virtual position
+        last = min(st.st_size, offset + length)
+        if offset >= last:
+            return ''
+        
+        # The answer is built in place (with the spare bytes the cipher needs)
+        answer = bytearray(last - offset + self.__engine.slack)
+        position = 0
+        
+        # Encrypting, the virtual file starts with the header and the content is the real file
+        if self.__encrypt:
+            if offset < fmt.header:
+                header = fmt.pack(nonce)[offset:last]
+                answer[0:len(header)] = header
+                position = len(header)
+            start = max(offset, fmt.header) - fmt.header
+            roffset = start
+            worker = 'encrypt'
+        
+        # Decrypting, the content of the real file starts after the header
+        else:
+            start = offset
+            roffset = fmt.header + offset
+            worker = 'decrypt'
+        
+        # Bring the bytes
+        begin = time.time()
+        size = fh.readinto(answer, position, roffset, last - offset - position)
+        self.metrics.record('disk', time.time() - begin, size)
+        
+        # Cipher them where they are, big reads in parts at the same time (cut at cipher blocks of the stream)
+        begin = time.time()
+        unit = self.__engine.cipher_blocksize
+        parts = []
+        for (first, last) in self.split(start / unit, (start + size - 1) / unit, unit):
+            parts.append((position + max(first * unit - start, 0), position + min((last + 1) * unit - start, size)))
+        if len(parts) == 1:
+            self.__engine.stream_into(answer, position, position + size, nonce, start)
+        else:
+            self.__pool.map(lambda part: self.__engine.stream_into(answer, part[0], part[1], nonce, start + part[0] - position), parts)
+        self.metrics.record(worker, time.time() - begin, size)
+        
+        # Return the requested result (shorter if the file shrank)
+        del answer[position + size:]
+        return answer
+    
+    def extract(self, answer, position, buffers, skip):
+        '''
+        Copy the buffers, without their first skip bytes, to the answer starting at position until it is full.
+        Returns the position where the copy finished
+        '''
+        view = memoryview(answer)
+        for buf in buffers:
+            
+            # Jump over the bytes which were not requested
+            if skip >= len(buf):
+                skip -= len(buf)
+                continue
+            
+            # Copy straight from the buffer to its place in the answer
+            size = min(len(buf) - skip, len(answer) - position)
+            view[position:position + size] = memoryview(buf)[skip:skip + size]
+            position += size
+            skip = 0
+            if position == len(answer):
+                break
+        return position
+    
+    @measured('read', len)
+    def read(self, vpath, length, offset, fh=None):
+        '''
+        Read the content of the file at the given path trying to return as many bytes as said by length and starting from offset.
+        The answer is a bytearray built in place (FUSE copies it from its buffer, no string is built)
+        '''
+        
+        # The statistics file
+        if isinstance(fh, teFSreport):
+            return fh.data[offset:offset + length]
+        if fh is None and vpath == STATS_PATH:
+            return self.stats()[offset:offset + length]
+        
+        # Without handle, open the file only for this read
+        if fh is None:
+            realpath = self.realpath(vpath)
+            if realpath is None:
+                return -errno.ENOENT
+            handle = teFSfile(realpath, vpath, self.getstat(realpath))
+        else:
+            handle = fh
+        
+        # Detect sequential reads
+        handle.sequential(offset, length, self.__readahead)
+        
+        # Wait for a free worker
+        if self.__workers:
+            self.__workers.acquire()
+        
+        # Process the result
+        try:
+            try:
+                if handle.st.format.stream:
+                    return self.read_stream(handle, length, offset)
+                elif self.__encrypt:
+                    return self.read_and_encrypt(handle, length, offset)
+                else:
+                    return self.read_and_decrypt(handle, length, offset)
+            except Exception,e:
+                self.error("EXCEPT inside read_and_***(). exception detected at line %s: %s\n", lineno(), e)
+                raise
+        finally:
+            if self.__workers:
+                self.__workers.release()
+            if fh is None:
+                handle.close()
 
 
-class teFSstat(fuse.Stat):
+class teFSfile(object):
+    '''
+    Open file: keeps the real file open and its attributes from open() to release()
+    '''
+    
+    # Read through the page cache of the kernel, open() says if the pages cached before are still valid
+    direct_io = False
+    keep_cache = False
     
-    def __init__(self, path, encrypting, padding, blocksize, debug):
+    def __init__(self, realpath, vpath, st):
+        
+        # Paths
+        self.realpath = realpath
+        self.vpath = vpath
+        
+        # Attributes when the file was opened (sizes and block geometry)
+        self.st = st
+        st.st_size
+        
+        # Sequential access detection: where the next read should start, readahead window (in chunks) and first chunk not prefetched yet
+        self.next_offset = 0
+        self.window = 0
+        self.prefetched = 0
+        
+        # Nonce of the file (stream format)
+        self.nonce = None
+        
+        # Open the real file (seek and read must go together when several threads use the handle)
+        self.fd = os.open(realpath, os.O_RDONLY)
+        self.file = io.FileIO(self.fd, 'r', closefd=False)
+        self.lock = threading.Lock()
+    
+    def sequential(self, offset, length, maximum):
+        '''
+        Check if this read continues the previous one, the readahead window grows while it does
+        '''
+        if offset == self.next_offset:
+            self.window = min(max(self.window * 2, 1), maximum)
+        else:
+            self.window = 0
+            self.prefetched = 0
+        self.next_offset = offset + length
+        return self.window
+    
+    def pread(self, offset, length):
+        '''
+        Read length bytes starting at offset (less if the end of the file is reached) straight into a new bytearray
+        '''
+        buf = bytearray(length)
+        done = self.readinto(buf, 0, offset, length)
+        
+        # Cut it if the file was shorter
+        if done < length:
+            del buf[done:]
+        return buf
+    
+    def readinto(self, buf, position, offset, length):
+        '''
+        Read length bytes starting at offset (less if the end of the file is reached) into the bytearray at position,
+        returns the bytes read
+        '''
+        view = memoryview(buf)
+        done = 0
+        try:
+            with self.lock:
+                if self.fd is None:
+                    raise IOError,"File '%s' is closed" % (self.vpath)
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while done < length:
+                    size = self.file.readinto(view[position + done:position + length])
+                    if not size:
+                        break
+                    done += size
+        finally:
+            # The view must be released before the bytearray is resized
+            del view
+        return done
+    
+    def close(self):
+        '''
+        Close the real file
+        '''
+        with self.lock:
+            if self.fd is not None:
+                self.file.close()
+                os.close(self.fd)
+                self.fd = None
+
+
+class teFSreport(object):
+    '''
+    Open statistics file: a read-only regular file with the given content
+    '''
+    
+    # The kernel must not cache it, every open gives new content
+    direct_io = True
+    keep_cache = False
+    
+    def __init__(self, data):
+        self.data = data
+        
+        # Attributes of the virtual file
+        now = time.time()
+        self.st = fuse.Stat()
+        self.st.st_mode = stat.S_IFREG | 0444
+        self.st.st_ino = 0
+        self.st.st_dev = 0
+        self.st.st_nlink = 1
+        self.st.st_uid = os.getuid()
+        self.st.st_gid = os.getgid()
+        self.st.st_size = len(data)
+        self.st.st_atime = now
+        self.st.st_mtime = now
+        self.st.st_ctime = now
+    
+    def close(self):
+        pass
+
+
+class teFSstat(object):
+    '''
+    Attributes of a file as seen through teFS (FUSE only reads the st_* attributes)
+    '''
+    
+    __slots__ = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid', 'st_atime', 'st_mtime', 'st_ctime', 'realsize', 'checked', 'nonce', '_path', '_probe', '_format', '_size')
+    
+    def __init__(self, path, probe, previous=None):
         
         # Get stat info
         st = os.stat(path)
@@ -646,36 +1691,54 @@ class teFSstat(fuse.Stat):
         self.st_atime = st.st_atime
         self.st_mtime = st.st_mtime
         self.st_ctime = st.st_ctime
-        self.st_size = st.st_size
         
-        # Recalculate size if required
-        if (stat.S_ISREG(self.st_mode)) and padding:
-            
-            if encrypting:
-                
-                # Add padding for all blocks
-                padders_in_blocks = (st.st_size / (blocksize-1))
-                padders_left_in_block = padding - ((st.st_size % (blocksize - 1)) % padding)
-                
-                # Update size
-                self.st_size += ( 1 + padders_in_blocks + padders_left_in_block )
-                #debug("teFSstat encrypt: %s has %s bytes\noriginal:%s\npadding:%s\npadders_in_blocks:%s\npadders_left_in_block:%s\n" % (path,self.st_size,st.st_size,padding,padders_in_blocks,padders_left_in_block), color='cyan')
-                
-            else:
-                
-                # Get padder
-                f = open(path,'r')
-                f.seek(-1,2)
-                padder = f.read()
-                f.close()
-                
-                # Calculate padlen
-                padders_in_blocks = ((st.st_size - 1) / blocksize)
-                padders_left_in_block = ord(padder)
-                
-                # Update size
-                self.st_size -= ( 1 + padders_in_blocks + padders_left_in_block )
-                #debug("teFSstat decrypt: %s has %s bytes\npadding:%s\npadders_in_blocks:%s\npadders_left_in_block:%s\n" % (path,self.st_size,padding,padders_in_blocks,padders_left_in_block), color='cyan')
+        # Size of the real file and when it was checked
+        self.realsize = st.st_size
+        self.checked = time.time()
+        
+        # Nonce of the stream format, set the first time the file is read (see teFS.nonce())
+        self.nonce = None
+        
+        # Format and size of the content are calculated when they are used for first time
+        self._path = path
+        self._probe = probe
+        self._format = None
+        self._size = None
+        
+        # Only regular files need to recalculate their size
+        if not stat.S_ISREG(self.st_mode):
+            self._size = st.st_size
+        
+        # Keep the content information if the file didn't change
+        elif previous is not None and previous._size is not None and previous.key() == self.key():
+            self._format = previous._format
+            self._size = previous._size
+            self.nonce = previous.nonce
+    
+    def key(self):
+        '''
+        Identify the version of the real file
+        '''
+        return (self.st_ino, self.st_mtime, self.realsize)
+    
+    def fill(self):
+        '''
+        Find out the format and the size of the content
+        '''
+        (self._format, self._size) = self._probe(self._path, self.realsize, self.key())
+        self._probe = None
+    
+    @property
+    def st_size(self):
+        if self._size is None:
+            self.fill()
+        return self._size
+    
+    @property
+    def format(self):
+        if self._size is None:
+            self.fill()
+        return self._format
     
     def __str__(self):
         '''
@@ -695,3 +1758,23 @@ class teFSstat(fuse.Stat):
         string += "}"
         return string
 
+
+class teFSlisting(object):
+    '''
+    Transformed listing of a directory: the entries are (virtual name, type) by position (None for
+    the positions which are not shown), names has the real names found in the directory
+    '''
+    
+    __slots__ = ('key', 'names', 'entries', 'weight')
+    
+    def __init__(self, key, names, entries):
+        self.key = key
+        self.names = names
+        self.entries = entries
+        
+        # Rough memory used by the listing (names and virtual names have the same length more or less)
+        self.weight = 128 + sum([2 * len(name) + 96 for name in names])
+    
+    @staticmethod
+    def weigh(listing):
+        return listing.weight
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+#########################################################################
+#                                                                       #
+# Name:      Transcode                                                  #
+#                                                                       #
+# Project:   Transparent Encrypted Filesystem                           #
+# Module:    Transcode                                                  #
+# Started:   20110904                                                   #
+#                                                                       #
+# Important: WHEN EDITING THIS FILE, USE SPACES TO INDENT - NOT TABS!   #
+#                                                                       #
+#########################################################################
+#                                                                       #
+# Juan Miguel Taboada Godoy <juanmi@centrologic.com>                    #
+#                                                                       #
+#########################################################################
+'''
+teFS offline transcoder: writes the encrypted (or decrypted) mirror of a
+tree straight to a target directory, without mounting anything.
+
+Names and contents are built by teFS itself (readdir/open/read), so the
+result is byte for byte what the mount shows and both can be mixed. Files
+are processed by a pool of processes and a manifest remembers what was
+written, so running it again only processes the files which changed.
+'''
+
+__version__ = "201109111103"
+
+__all__ = []
+
+# Import the rest of libraries
+import os
+import sys
+import time
+import json
+import stat
+import multiprocessing
+from itertools import imap
+from options import getargv, getargvalue, getpatterns, checkblocksize, checkbackend, checkcompression
+from tefs import teFS
+
+# Size of every read asked to teFS
+TRANSCODE_CHUNK = 1048576
+
+# Save the manifest after this number of files, so an interrupted run doesn't start again from zero
+MANIFEST_EVERY = 1000
+
+# Version of the manifest
+MANIFEST_VERSION = 1
+
+# teFS used by this process (every process of the pool builds its own one)
+worker_tefs = None
+
+
+def start_worker(key, datapath, action, target, options):
+    '''
+    Build the teFS of this process
+    '''
+    global worker_tefs
+    worker_tefs = teFS(key, datapath, action, target, **options)
+
+
+def transcode_file(task):
+    '''
+    Write the virtual file to the target, returns (vpath, realsize, mtime, vsize, error)
+    '''
+    (vpath, target) = task
+    tefs = worker_tefs
+    try:
+        
+        # Open the file as FUSE would do
+        fh = tefs.open(vpath, os.O_RDONLY)
+        if isinstance(fh, int):
+            raise IOError,"File '%s' is not allowed" % (vpath)
+        
+        try:
+            st = fh.st
+            vsize = st.st_size
+            
+            # Write it to a temporal file next to the final one
+            (folder, name) = os.path.split(target)
+            temporal = os.path.join(folder, ".%s.tefs-tmp" % (name))
+            output = open(temporal, 'wb')
+            try:
+                offset = 0
+                while offset < vsize:
+                    buf = tefs.read(vpath, TRANSCODE_CHUNK, offset, fh)
+                    if not buf:
+                        raise IOError,"File '%s' is shorter than expected (%s of %s bytes)" % (vpath, offset, vsize)
+                    output.write(buf)
+                    offset += len(buf)
+            finally:
+                output.close()
+            
+            # Same times as the mount shows, then put it in its place
+            os.utime(temporal, (st.st_atime, st.st_mtime))
+            os.rename(temporal, target)
+        finally:
+            tefs.release(vpath, os.O_RDONLY, fh)
+        
+        return (vpath, st.realsize, st.st_mtime, vsize, None)
+    except Exception,e:
+        return (vpath, None, None, None, "%s" % (e))
+
+
+def walk(tefs, vpath, target, folders=None):
+    '''
+    Walk the virtual tree creating its directories in the target, yields (vpath, target path, stat) for every regular file.
+    Without target nothing is created (the target path is None), folders gets the virtual path of every directory
+    '''
+    
+    # Create the directory
+    if target is not None and not os.path.isdir(target):
+        os.makedirs(target)
+    if folders is not None:
+        folders.add(vpath)
+    
+    # Process its entries
+    for entry in tefs.readdir(vpath, 0):
+        if entry.name in ('.', '..'):
+            continue
+        
+        # Build the paths of the entry
+        tvpath = "%s/%s" % (vpath.rstrip("/"), entry.name)
+        if target is not None:
+            ttarget = os.path.join(target, entry.name)
+        else:
+            ttarget = None
+        st = tefs.getstat(tefs.realpath(tvpath))
+        
+        # Go inside directories, give back regular files
+        if stat.S_ISDIR(st.st_mode):
+            for found in walk(tefs, tvpath, ttarget, folders):
+                yield found
+        elif stat.S_ISREG(st.st_mode):
+            yield (tvpath, ttarget, st)
+
+
+def load_manifest(path, settings):
+    '''
+    Read the manifest, it is ignored if it was written with different settings
+    '''
+    try:
+        f = open(path, 'rb')
+        try:
+            manifest = json.load(f, encoding='latin-1')
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+    
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('settings') != settings:
+        return {}
+    
+    # Paths are saved as latin-1 so any name survives, bring them back to byte strings
+    return dict([(vpath.encode('latin-1'), tuple(known)) for (vpath, known) in manifest.get('files', {}).iteritems()])
+
+
+def save_manifest(path, settings, files):
+    '''
+    Write the manifest (to a temporal file first, so it is never left half written)
+    '''
+    temporal = "%s.tmp" % (path)
+    f = open(temporal, 'wb')
+    try:
+        json.dump({'version': MANIFEST_VERSION, 'settings': settings, 'files': files}, f, encoding='latin-1')
+    finally:
+        f.close()
+    os.rename(temporal, path)
+
+
+def main(key):
+    usage  = ""
+    usage += "Usage: %s SOURCE TARGET [options] {encrypt|decrypt}\n" % (sys.argv[0])
+    usage += "Options:\n"
+    
+    # ALLOWALL: same as in main.py, don't take any control over allowed folders
+    usage += "    --allowall      Allow everything, doesn't take any control over allowed folders\n"
+    
+    # INCLUDE/EXCLUDE: same as in main.py
+    usage += "    --include=GLOB  Write only the files matching the pattern (every directory is written)\n"
+    usage += "    --exclude=GLOB  Skip the files and directories matching the pattern\n"
+    usage += "    --excludefrom=FILE  Read exclude patterns from the file, one per line\n"
+    
+    # BACKEND/BLOCKSIZE/COMPRESS: same as in main.py, they must be the same used with the mount to mix both
+    usage += "    --backend=NAME  Cipher backend: auto, openssl or pycrypto (default: auto)\n"
+    usage += "    --blocksize=N   Block size in bytes from 4096 to 1048576 (default: legacy 32 bytes)\n"
+    usage += "    --compress=CODEC  Compress the blocks with zlib, lz4 or zstd before encrypting them\n"
+    
+    # PROCESSES: files are encrypted/decrypted by a pool of processes
+    usage += "    --processes=N   Files processed at the same time (default: number of CPUs)\n"
+    
+    # MANIFEST: remembers the size and modification time of every source file written to the target
+    usage += "    --manifest=FILE Manifest of processed files (default: TARGET.manifest)\n"
+    
+    # DELETE: remove from the target the files which are not in the source anymore
+    usage += "    --delete        Remove files which disappeared from the source since the last run\n"
+    
+    if len(sys.argv) == 4 or (len(sys.argv) > 4 and sys.argv[3].startswith('-')):
+        
+        # Get basic configuration from the command line
+        datapath = os.path.abspath(sys.argv.pop(1))
+        target = os.path.abspath(sys.argv.pop(1))
+        action = sys.argv.pop(-1)
+        
+        # Check action
+        if action != 'encrypt' and action != 'decrypt':
+            print "Warning: action can be only encrypt or decrypt, you used '%s'" % (action)
+            print
+            print usage
+            sys.exit()
+        
+        # Process options
+        allowall = getargv('--allowall')
+        delete = getargv('--delete')
+        backend = getargvalue('--backend', 'auto')
+        blocksize = getargvalue('--blocksize')
+        compression = getargvalue('--compress')
+        processes = getargvalue('--processes', str(multiprocessing.cpu_count()))
+        manifest_path = getargvalue('--manifest', "%s.manifest" % (target))
+        try:
+            (include, exclude) = getpatterns()
+        except IOError, e:
+            print "Warning: %s" % (e)
+            print
+            print usage
+            sys.exit()
+        try:
+            if blocksize is not None:
+                blocksize = int(blocksize)
+            processes = int(processes)
+        except ValueError:
+            print "Warning: --blocksize and --processes must be numbers"
+            print
+            print usage
+            sys.exit()
+        
+        # Values teFS can't use would leave it half built
+        error = checkblocksize(blocksize) or checkbackend(backend) or checkcompression(compression)
+        if error:
+            print "Warning: %s" % (error)
+            print
+            print usage
+            sys.exit()
+        
+        # Unknown options
+        if len(sys.argv) > 1:
+            print "Warning: unknown options %s" % (", ".join(sys.argv[1:]))
+            print
+            print usage
+            sys.exit()
+        
+        # Every file and directory is read once from start to end: no block or listings cache, no readahead
+        options = {'allowall': allowall, 'debugger': {'screen': (sys.stdout, ['*'])}, 'backend': backend, 'blocksize': blocksize, 'compression': compression, 'blockcache': 0, 'dircache': 0, 'readahead': 0, 'workers': None, 'include': include, 'exclude': exclude}
+        
+        # Load what was done in previous runs (only valid for the same source, action, key and format)
+        if key:
+            algorithm = key.split("$")[0]
+        else:
+            algorithm = None
+        settings = {'source': datapath, 'action': action, 'algorithm': algorithm, 'blocksize': blocksize, 'compression': compression, 'include': include, 'exclude': exclude}
+        previous = load_manifest(manifest_path, settings)
+        files = {}
+        
+        # teFS of this process walks the tree
+        tefs = teFS(key, datapath, action, target, **options)
+        
+        # Find out the files to process, skip the ones which didn't change since the last run
+        counters = {'done': 0, 'skipped': 0, 'errors': 0, 'bytes': 0}
+        start = time.time()
+        pending = []
+        seen = set()
+        folders = set()
+        for (vpath, ttarget, st) in walk(tefs, '/', target, folders):
+            seen.add(vpath)
+            known = previous.get(vpath)
+            if known and known[0] == st.realsize and known[1] == st.st_mtime:
+                try:
+                    if os.path.getsize(ttarget) == known[2]:
+                        files[vpath] = known
+                        counters['skipped'] += 1
+                        continue
+                except OSError:
+                    pass
+            pending.append((vpath, ttarget))
+        
+        # Process the files
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, start_worker, (key, datapath, action, target, options))
+            results = pool.imap_unordered(transcode_file, pending, 16)
+        else:
+            pool = None
+            start_worker(key, datapath, action, target, options)
+            results = imap(transcode_file, pending)
+        
+        complete = False
+        try:
+            for (vpath, realsize, mtime, vsize, error) in results:
+                if error:
+                    tefs.error("%s: %s\n" % (vpath, error))
+                    counters['errors'] += 1
+                    continue
+                
+                # Remember it
+                files[vpath] = (realsize, mtime, vsize)
+                counters['done'] += 1
+                counters['bytes'] += vsize
+                if counters['done'] % MANIFEST_EVERY == 0:
+                    save_manifest(manifest_path, settings, dict(previous.items() + files.items()))
+            
+            # Remove the files which are not in the source anymore
+            for vpath in set(previous) - seen:
+                if delete:
+                    try:
+                        os.unlink(os.path.join(target, vpath.lstrip("/")))
+                    except OSError:
+                        pass
+                else:
+                    files[vpath] = previous[vpath]
+            
+            # And the directories which are not in the source anymore (deepest first, only when they were left empty)
+            if delete:
+                for (folder, dirs, names) in os.walk(target, topdown=False):
+                    vpath = "/%s" % (os.path.relpath(folder, target))
+                    if folder != target and vpath not in folders:
+                        try:
+                            os.rmdir(folder)
+                        except OSError:
+                            pass
+            complete = True
+        finally:
+            
+            # Close the pool and save the manifest, even when interrupted (then what was known is kept)
+            if pool:
+                pool.terminate()
+                pool.join()
+            if complete:
+                save_manifest(manifest_path, settings, files)
+            else:
+                save_manifest(manifest_path, settings, dict(previous.items() + files.items()))
+        
+        # Show the summary
+        elapsed = max(time.time() - start, 0.001)
+        tefs.debug("%s files written (%.1f MB at %.1f MB/s), %s unchanged, %s errors\n" % (counters['done'], counters['bytes'] / 1048576.0, counters['bytes'] / 1048576.0 / elapsed, counters['skipped'], counters['errors']), color='blue')
+        if counters['errors']:
+            sys.exit(1)
+    else:
+        print usage
+
+if __name__ == '__main__':
+    # Must be the same key used by main.py to mount the filesystem
+    key = 'AESECB$CIt16CXA9j73Yx1jCCMH6CXvS8DwHQuR'
+    #key = 'BlowfishECB$ASFFQWER'
+    #key = None
+    main(key)